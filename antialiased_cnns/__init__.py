@@ -11,3 +11,5 @@ from .densenet import *
 from .mobilenet import *
 from .resnet import *
 from .vgg import *
+from .profiling import *
+from .cost import *
@@ -0,0 +1,254 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+import copy
+import json
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+from .blurpool import BlurPool, BlurPool1D
+
+__all__ = ['cost_model', 'CostReport', 'check_cost_model']
+
+# costs are computed from the module hyperparameters and the shapes flowing through them;
+# shapes are found by running the model on the 'meta' device, which does no computation
+# and allocates no memory
+
+
+def _prod(v):
+    return int(np.prod(v)) if len(v) else 1
+
+
+def _tuple(v, n):
+    return tuple(v) if isinstance(v, (list, tuple)) else (v,)*n
+
+
+def _macs(module, in_shape, out_shape):
+    """Multiply-accumulates of one call. Max/ReLU/padding/dropout count as zero; batchnorm as
+    one per element (scale and shift folded, as at inference)."""
+    if isinstance(module, nn.modules.conv._ConvNd):
+        return _prod(out_shape) * (module.in_channels // module.groups) * _prod(module.kernel_size)
+    if isinstance(module, nn.Linear):
+        return _prod(out_shape) * module.in_features
+    if isinstance(module, BlurPool):
+        return 0 if module.filt_size==1 else _prod(out_shape) * module.filt_size**2
+    if isinstance(module, BlurPool1D):
+        return 0 if module.filt_size==1 else _prod(out_shape) * module.filt_size
+    if isinstance(module, nn.modules.batchnorm._BatchNorm):
+        return _prod(in_shape)
+    if isinstance(module, (nn.AvgPool1d, nn.AvgPool2d, nn.AvgPool3d)):
+        return _prod(out_shape) * _prod(_tuple(module.kernel_size, len(out_shape)-2))
+    if isinstance(module, (nn.AdaptiveAvgPool1d, nn.AdaptiveAvgPool2d, nn.AdaptiveAvgPool3d)):
+        return _prod(in_shape)
+    return 0
+
+
+def _transient_bytes(module, in_shape, element_size):
+    """Bytes of the padded copy BlurPool makes of its input before filtering"""
+    if isinstance(module, (BlurPool, BlurPool1D)) and not (module.filt_size==1 and module.pad_off==0):
+        padded = list(in_shape)
+        if isinstance(module, BlurPool): # pad_sizes are (left, right, top, bottom)
+            padded[-1] += module.pad_sizes[0] + module.pad_sizes[1]
+            padded[-2] += module.pad_sizes[2] + module.pad_sizes[3]
+        else:
+            padded[-1] += module.pad_sizes[0] + module.pad_sizes[1]
+        return _prod(padded) * element_size
+    return 0
+
+
+def _is_conv_like(module):
+    # the modules whose MACs torch's FlopCounterMode also counts (as 2 flops each)
+    return isinstance(module, (nn.modules.conv._ConvNd, nn.Linear)) or \
+        (isinstance(module, (BlurPool, BlurPool1D)) and module.filt_size > 1)
+
+
+class _LiveBytes(object):
+    """Tracks the bytes of tensor storages alive during a (meta) forward pass"""
+    def __init__(self):
+        from torch.utils._python_dispatch import TorchDispatchMode
+        from torch.utils._pytree import tree_flatten
+        tracker = self
+        self.live = 0
+        self.peak = 0
+        self.storages = set()
+
+        class Mode(TorchDispatchMode):
+            def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+                out = func(*args, **(kwargs or {}))
+                for t in tree_flatten(out)[0]:
+                    if isinstance(t, torch.Tensor):
+                        tracker.allocate(t)
+                return out
+
+        self.mode = Mode()
+
+    def allocate(self, t):
+        storage = t.untyped_storage()
+        key = storage._cdata
+        if key in self.storages: # in-place op or view
+            return
+        self.storages.add(key)
+        self.live += storage.nbytes()
+        self.peak = max(self.peak, self.live)
+        weakref.finalize(t, self.free, key, storage.nbytes())
+
+    def free(self, key, nbytes):
+        if key in self.storages:
+            self.storages.discard(key)
+            self.live -= nbytes
+
+
+class CostReport(object):
+    """Result of cost_model(). layers has one entry per call of a leaf module (BlurPool counts
+    as a leaf). Memory is in bytes:
+      output_bytes - size of the layer's output
+      transient_bytes - temporary buffers inside the layer (BlurPool's padded input)
+      activation_bytes - distinct tensors flowing between layers in a training forward,
+                         i.e. roughly what is kept for the backward pass
+      peak_inference_bytes - peak memory of all live activations during an inference forward"""
+    def __init__(self, layers, input_size, params, activation_bytes, peak_inference_bytes):
+        self.layers = layers
+        self.input_size = list(input_size)
+        self.params = params
+        self.macs = sum(layer['macs'] for layer in layers)
+        self.conv_macs = sum(layer['macs'] for layer in layers if layer['conv_like'])
+        self.activation_bytes = activation_bytes
+        self.peak_inference_bytes = peak_inference_bytes
+
+    def by_type(self):
+        groups = OrderedDict()
+        for layer in self.layers:
+            g = groups.setdefault(layer['type'], OrderedDict([('type', layer['type']), ('count', 0),
+                ('macs', 0), ('params', 0), ('output_bytes', 0), ('transient_bytes', 0)]))
+            g['count'] += 1
+            for k in ['macs', 'params', 'output_bytes', 'transient_bytes']:
+                g[k] += layer[k]
+        return sorted(groups.values(), key=lambda g: -g['macs'])
+
+    def totals(self):
+        return OrderedDict([('macs', self.macs), ('conv_macs', self.conv_macs), ('params', self.params),
+            ('activation_bytes', self.activation_bytes), ('peak_inference_bytes', self.peak_inference_bytes)])
+
+    def table(self, per_layer=False):
+        fmt = '%-36s %-18s %12s %10s %10s %10s'
+        lines = [fmt%('layer' if per_layer else 'type', 'output', 'GMACs', 'params(M)', 'out_MB', 'tmp_MB')]
+        rows = self.layers if per_layer else self.by_type()
+        for row in rows:
+            lines.append(fmt%(row['name'] if per_layer else row['type'],
+                'x'.join(str(v) for v in row['output_shape']) if per_layer else '%d layers'%row['count'],
+                '%.4f'%(row['macs']/1e9), '%.3f'%(row['params']/1e6),
+                '%.2f'%(row['output_bytes']/2.**20), '%.2f'%(row['transient_bytes']/2.**20)))
+        lines.append('total: %.3f GMACs, %.2fM params, %.1f MB activations (training), %.1f MB peak (inference)'
+                     %(self.macs/1e9, self.params/1e6, self.activation_bytes/2.**20, self.peak_inference_bytes/2.**20))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return OrderedDict([('input_size', self.input_size), ('totals', self.totals()),
+            ('by_type', self.by_type()), ('layers', self.layers)])
+
+    def to_json(self, path=None):
+        out = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(out)
+        return out
+
+
+def cost_model(model, input_size=(1,3,224,224), dtype=torch.float32):
+    """Predicts MACs, parameters and activation memory of model, per layer and in total, for
+    an input of input_size, without running it on real data. Works for every constructor in
+    this package (and torchvision's), for any filter_size/pool_only/width/groups setting."""
+    meta = copy.deepcopy(model).to(device='meta', dtype=dtype).eval()
+    names = dict((module, name) for name, module in meta.named_modules())
+    leaves = []
+    inside = set()
+    for module in meta.modules():
+        if module not in inside and (isinstance(module, (BlurPool, BlurPool1D)) or len(list(module.children()))==0):
+            leaves.append(module)
+            inside.update(m for m in module.modules() if m is not module)
+
+    layers = []
+    flowing = [] # keeps every activation alive so storages are counted once
+    counted_params = set()
+
+    def hook(module, inputs, output):
+        inp = inputs[0]
+        if module not in counted_params:
+            counted_params.add(module)
+            params = sum(p.numel() for p in module.parameters())
+        else: # shared module called again
+            params = 0
+        flowing.extend([inp, output])
+        layers.append(OrderedDict([
+            ('name', names[module]),
+            ('type', type(module).__name__),
+            ('input_shape', list(inp.shape)),
+            ('output_shape', list(output.shape)),
+            ('macs', _macs(module, inp.shape, output.shape)),
+            ('conv_like', _is_conv_like(module)),
+            ('params', params),
+            ('output_bytes', output.numel()*output.element_size()),
+            ('transient_bytes', _transient_bytes(module, inp.shape, inp.element_size())),
+        ]))
+
+    handles = [leaf.register_forward_hook(hook) for leaf in leaves]
+    x = torch.zeros(input_size, device='meta', dtype=dtype)
+    try:
+        meta(x)
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    storages = {}
+    for t in flowing:
+        storages[t.untyped_storage()._cdata] = t.untyped_storage().nbytes()
+    # BlurPool's padded input is saved by its conv for the backward pass as well
+    activation_bytes = sum(storages.values()) + sum(layer['transient_bytes'] for layer in layers)
+    del flowing[:]
+
+    # peak live memory of an inference pass, input included
+    tracker = _LiveBytes()
+    with torch.no_grad(), tracker.mode:
+        tracker.allocate(x)
+        out = meta(x)
+        del out
+    params = sum(p.numel() for p in model.parameters())
+    return CostReport(layers, input_size, params, activation_bytes, tracker.peak)
+
+
+def check_cost_model(model, input_size=(1,3,224,224), device='cpu', rtol=0.01, mem_rtol=0.15):
+    """Compares cost_model() predictions with measurements on a real forward pass: parameter
+    count, conv/linear/BlurPool MACs (counted by torch's FlopCounterMode) and, on CUDA, peak
+    inference memory. Returns {quantity: (predicted, measured)}; raises AssertionError if a
+    quantity is off by more than its relative tolerance."""
+    from torch.utils.flop_counter import FlopCounterMode
+    report = cost_model(model, input_size)
+    model = model.to(device).eval()
+    x = torch.randn(input_size, device=device)
+
+    results = OrderedDict()
+    results['params'] = (report.params, sum(p.numel() for p in model.parameters()))
+    with torch.no_grad(), FlopCounterMode(display=False) as counter:
+        model(x)
+    results['conv_macs'] = (report.conv_macs, counter.get_total_flops()//2)
+
+    if torch.device(device).type=='cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device) - x.numel()*x.element_size()
+        with torch.no_grad():
+            model(x)
+        torch.cuda.synchronize(device)
+        results['peak_inference_bytes'] = (report.peak_inference_bytes, torch.cuda.max_memory_allocated(device) - base)
+
+    for k, (predicted, measured) in results.items():
+        tol = mem_rtol if k.endswith('bytes') else rtol
+        assert abs(predicted - measured) <= tol*max(abs(measured), 1), \
+            '%s: predicted %s, measured %s'%(k, predicted, measured)
+    return results
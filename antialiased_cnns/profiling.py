@@ -0,0 +1,263 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+import json
+import time
+from collections import OrderedDict
+
+import torch
+from .blurpool import BlurPool, BlurPool1D
+
+__all__ = ['profile_model', 'ModelProfile', 'module_stage']
+
+
+def module_stage(name):
+    """Coarse stage a module belongs to, e.g. 'layer3.1.conv2' -> 'layer3',
+    'features.denseblock2.denselayer4.conv1' -> 'denseblock2', 'features.7.conv.0' -> 'features.7'"""
+    parts = name.split('.')
+    while(parts and parts[0]=='module'): # DataParallel / DistributedDataParallel
+        parts = parts[1:]
+    if(len(parts)==0 or parts[0]==''):
+        return '(model)'
+    if(parts[0]=='features' and len(parts)>1):
+        if(parts[1].startswith('denseblock') or parts[1].startswith('transition')):
+            return parts[1]
+        return 'features.%s'%parts[1]
+    return parts[0]
+
+
+def _tensors(x):
+    if torch.is_tensor(x):
+        return [x]
+    if isinstance(x, (list, tuple)):
+        return [t for v in x for t in _tensors(v)]
+    if isinstance(x, dict):
+        return [t for v in x.values() for t in _tensors(v)]
+    return []
+
+
+def _backward_subgraph(outputs, stop_nodes):
+    """Autograd nodes recorded between a module's inputs and outputs"""
+    stack = [t.grad_fn for t in outputs]
+    seen = set()
+    nodes = []
+    while stack:
+        node = stack.pop()
+        if node is None or node in seen or node in stop_nodes:
+            continue
+        seen.add(node)
+        if not hasattr(node, 'variable'): # skip AccumulateGrad (parameter leaves)
+            nodes.append(node)
+            stack.extend(next_node for next_node, _ in node.next_functions)
+    return nodes
+
+
+class ModelProfile(object):
+    """Per-module results of profile_model(). Times are in ms per iteration and memory in bytes.
+    by_type() and by_stage() sum over leaf modules only, so nothing is counted twice; BlurPool
+    counts as a leaf, including its padding. Work done by containers themselves (residual
+    adds, concatenation, functional activations) is reported as '(other)'."""
+    def __init__(self, layers, input_shape, device, iters):
+        self.layers = layers
+        self.input_shape = list(input_shape)
+        self.device = str(device)
+        self.iters = iters
+
+    def leaves(self):
+        return [layer for layer in self.layers if layer['leaf']]
+
+    def _aggregate(self, key):
+        groups = OrderedDict()
+        for layer in self.leaves():
+            group = groups.setdefault(layer[key], OrderedDict([(key, layer[key]), ('count', 0),
+                ('forward_ms', 0.), ('backward_ms', 0.), ('alloc_bytes', 0), ('output_bytes', 0), ('params', 0)]))
+            group['count'] += 1
+            for k in ['forward_ms', 'backward_ms', 'alloc_bytes', 'output_bytes', 'params']:
+                if layer[k] is not None and group[k] is not None:
+                    group[k] += layer[k]
+                else:
+                    group[k] = None
+        return list(groups.values())
+
+    def _other(self, key, rows):
+        other = OrderedDict([(key, '(other)'), ('count', 0)])
+        for k, v in self.total().items():
+            other[k] = None if v is None or any(r[k] is None for r in rows) else v - sum(r[k] for r in rows)
+        other['output_bytes'] = None
+        return other
+
+    def by_type(self):
+        rows = sorted(self._aggregate('type'), key=lambda g: -g['forward_ms'])
+        return rows + [self._other('type', rows)]
+
+    def by_stage(self):
+        # time a stage by its outermost module, which includes the work its containers do
+        roots = dict((layer['stage'], layer) for layer in self.layers if layer['stage_root'])
+        rows = self._aggregate('stage')
+        for row in rows:
+            if row['stage'] in roots:
+                row.update((k, roots[row['stage']][k]) for k in ['forward_ms', 'backward_ms', 'alloc_bytes', 'output_bytes'])
+        return rows + [self._other('stage', rows)]
+
+    def total(self):
+        root = self.layers[0]
+        return OrderedDict([(k, root[k]) for k in ['forward_ms', 'backward_ms', 'alloc_bytes', 'output_bytes', 'params']])
+
+    def table(self, by='type'):
+        rows = {'type': self.by_type, 'stage': self.by_stage}[by]()
+        total = self.total()
+        fmt = '%-24s %6s %12s %8s %12s %8s %14s %14s'
+        lines = [fmt%(by, 'count', 'forward_ms', '%fwd', 'backward_ms', '%bwd', 'alloc_MB', 'output_MB')]
+
+        def pct(v, t):
+            return '-' if v is None or not t else '%.1f'%(100.*v/t)
+
+        def num(v, scale=1., prec=3):
+            return '-' if v is None else '%.*f'%(prec, v/scale)
+
+        for row in rows + [dict(total, **{by: 'total', 'count': len(self.leaves())})]:
+            lines.append(fmt%(row[by], row['count'],
+                num(row['forward_ms']), pct(row['forward_ms'], total['forward_ms']),
+                num(row['backward_ms']), pct(row['backward_ms'], total['backward_ms']),
+                num(row['alloc_bytes'], 2.**20, 2), num(row['output_bytes'], 2.**20, 2)))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        return OrderedDict([('input_shape', self.input_shape), ('device', self.device), ('iters', self.iters),
+            ('total', self.total()), ('by_type', self.by_type()), ('by_stage', self.by_stage()),
+            ('layers', self.layers)])
+
+    def to_json(self, path=None):
+        out = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(out)
+        return out
+
+
+def profile_model(model, input_shape, device=None, iters=5, warmup=2, backward=True):
+    """Measures forward/backward wall time, allocated memory and output size of every module
+    of model, on a random input of input_shape (e.g. (N,3,224,224)).
+
+    Each module is timed from its forward pre-hook to its forward hook, and its backward from
+    the first to the last of the autograd nodes it recorded. On CUDA the device is synchronized
+    at every hook, so the numbers are per-module latencies rather than end-to-end throughput.
+    Allocated bytes (memory retained after the module's forward, i.e. its output plus the
+    tensors saved for backward) are only available on CUDA.
+
+    The model runs in the mode it is in, but is left as it was found (apart from being moved
+    to device): buffers such as BatchNorm running statistics, the parameters' .grad and the
+    random number generator state are restored afterwards."""
+    if device is None:
+        device = next(model.parameters()).device
+    device = torch.device(device)
+    model = model.to(device)
+    cuda = device.type=='cuda'
+
+    def now():
+        if cuda:
+            torch.cuda.synchronize(device)
+        return time.perf_counter()
+
+    names = OrderedDict((module, name) for name, module in model.named_modules())
+    leaves = set()
+    inside_leaf = set()
+    for module in names:
+        if module not in inside_leaf and (isinstance(module, (BlurPool, BlurPool1D)) or len(list(module.children()))==0):
+            leaves.add(module)
+            inside_leaf.update(m for m in module.modules() if m is not module)
+    stats = OrderedDict((module, {'forward': 0., 'backward': 0., 'alloc': 0, 'output': 0, 'shape': None})
+                        for module in names)
+    state = {'record': False}
+    handles = []
+
+    def pre_hook(module, inputs):
+        module._profile_stop_nodes = set(t.grad_fn for t in _tensors(inputs) if t.grad_fn is not None)
+        module._profile_mem = torch.cuda.memory_allocated(device) if cuda else 0
+        module._profile_start = now()
+
+    def post_hook(module, inputs, output):
+        end = now()
+        if not state['record']:
+            return
+        s = stats[module]
+        s['forward'] += end - module._profile_start
+        if cuda:
+            s['alloc'] += torch.cuda.memory_allocated(device) - module._profile_mem
+        outputs = _tensors(output)
+        s['output'] += sum(t.numel()*t.element_size() for t in outputs)
+        s['shape'] = [list(t.shape) for t in outputs]
+        if backward and torch.is_grad_enabled():
+            nodes = _backward_subgraph(outputs, module._profile_stop_nodes)
+            if nodes:
+                # modules called several times per forward (e.g. a shared ReLU) get one entry per call
+                timing = {'start': None, 'end': None}
+                s.setdefault('calls', []).append(timing)
+
+                def on_start(grad_outputs):
+                    if timing['start'] is None:
+                        timing['start'] = now()
+
+                def on_end(grad_inputs, grad_outputs):
+                    # the last of the module's nodes to finish closes its backward
+                    timing['end'] = now()
+
+                for node in nodes:
+                    node.register_prehook(on_start)
+                    node.register_hook(on_end)
+
+    for module in names:
+        handles.append(module.register_forward_pre_hook(pre_hook))
+        handles.append(module.register_forward_hook(post_hook))
+
+    grads = [(p, p.grad) for p in model.parameters()]
+    buffers = [(b, b.detach().clone()) for b in model.buffers()]
+    try:
+        with torch.random.fork_rng(devices=[device] if cuda else []):
+            x = torch.randn(*input_shape, device=device)
+            for it in range(warmup + iters):
+                state['record'] = it >= warmup
+                model.zero_grad(set_to_none=True)
+                with torch.set_grad_enabled(backward):
+                    out = _tensors(model(x))[0]
+                    if backward:
+                        out.float().sum().backward()
+                for s in stats.values():
+                    s['backward'] += sum(t['end'] - t['start'] for t in s.pop('calls', [])
+                                         if t['start'] is not None and t['end'] is not None)
+    finally:
+        for handle in handles:
+            handle.remove()
+        with torch.no_grad():
+            for buf, saved in buffers:
+                buf.copy_(saved)
+        for p, grad in grads:
+            p.grad = grad
+        for module in names:
+            for attr in ['_profile_stop_nodes', '_profile_mem', '_profile_start']:
+                if hasattr(module, attr):
+                    delattr(module, attr)
+
+    layers = []
+    stages = set()
+    for module, name in names.items():
+        s = stats[module]
+        layers.append(OrderedDict([
+            ('name', name if name else '(model)'),
+            ('type', type(module).__name__),
+            ('stage', module_stage(name)),
+            ('stage_root', bool(name) and module_stage(name) not in stages),
+            ('leaf', module in leaves),
+            ('forward_ms', 1000.*s['forward']/iters),
+            ('backward_ms', 1000.*s['backward']/iters if backward else None),
+            ('alloc_bytes', s['alloc']//iters if cuda else None),
+            ('output_bytes', s['output']//iters),
+            ('output_shape', s['shape']),
+            ('params', sum(p.numel() for p in module.parameters())),
+        ]))
+        if name:
+            stages.add(module_stage(name))
+    return ModelProfile(layers, input_shape, device, iters)
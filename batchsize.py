@@ -0,0 +1,220 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# Batch size search for main.py --auto-batch: runs real steps of the model at growing
+# batch sizes to find the largest one that fits in a memory budget, and the one with the
+# highest throughput. Out-of-memory errors are caught and treated as "does not fit".
+
+import contextlib
+import gc
+import math
+import time
+
+import torch
+import torch.distributed as dist
+
+__all__ = ['find_batch_size', 'mode_input_size', 'split_batch', 'step_rate']
+
+
+def mode_input_size(mode):
+    """Image size each main.py mode feeds the model with: validate_shift crops two 224
+    windows out of a 256 image"""
+    return 256 if mode == 'shift' else 224
+
+
+def _is_oom(e):
+    msg = str(e)
+    return isinstance(e, getattr(torch.cuda, 'OutOfMemoryError', ())) or \
+        'out of memory' in msg or "can't allocate memory" in msg
+
+
+def _state_to_cpu(state):
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        return type(state)((k, _state_to_cpu(v)) for k, v in state.items())
+    elif isinstance(state, (list, tuple)):
+        return type(state)(_state_to_cpu(v) for v in state)
+    return state
+
+
+def _make_step(model, mode, batch_size, device, criterion=None, optimizer=None, num_classes=1000):
+    size = mode_input_size(mode)
+    input = torch.randn(batch_size, 3, size, size, device=device)
+
+    if mode == 'train':
+        target = torch.randint(num_classes, (batch_size,), device=device)
+
+        def step():
+            loss = criterion(model(input), target)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+    elif mode == 'eval':
+        def step():
+            with torch.no_grad():
+                model(input)
+    elif mode == 'shift':
+        def step():
+            with torch.no_grad():
+                model(input[:, :, :224, :224])
+                model(input[:, :, 32:, 32:])
+    else:
+        raise ValueError('unknown mode [%s]' % mode)
+    return step
+
+
+def _trial(model, mode, batch_size, device, budget, criterion, optimizer, warmup, iters):
+    """Runs warmup+iters steps at batch_size. Returns (fits, images/sec, peak bytes)."""
+    cuda = device.type == 'cuda'
+    if cuda:
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    oom = False
+    elapsed = None
+    try:
+        step = _make_step(model, mode, batch_size, device, criterion, optimizer)
+        for _ in range(warmup):
+            step()
+        if cuda:
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        for _ in range(iters):
+            step()
+        if cuda:
+            torch.cuda.synchronize(device)
+        elapsed = time.perf_counter() - start
+    except RuntimeError as e:
+        if not _is_oom(e):
+            raise
+        oom = True
+    # outside the except block, so the traceback no longer pins the step's tensors
+    step = None
+    if optimizer is not None:
+        optimizer.zero_grad(set_to_none=True)
+    gc.collect()
+    peak = torch.cuda.max_memory_allocated(device) if cuda else None
+    if cuda:
+        torch.cuda.empty_cache()
+    if oom:
+        return False, None, peak
+    fits = budget is None or peak is None or peak <= budget
+    return fits, iters*batch_size/max(elapsed, 1e-9), peak
+
+
+@contextlib.contextmanager
+def _preserved(model, optimizer, mode, device):
+    """Puts model in the mode's train/eval state and restores its parameters, buffers,
+    optimizer state and the RNG streams on exit"""
+    was_training = model.training
+    model.train(mode == 'train')
+    model_state = _state_to_cpu(model.state_dict())
+    optimizer_state = _state_to_cpu(optimizer.state_dict()) if optimizer is not None else None
+    try:
+        with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+            yield
+    finally:
+        model.load_state_dict(model_state)
+        if optimizer is not None:
+            optimizer.load_state_dict(optimizer_state)
+            optimizer.zero_grad(set_to_none=True)
+        model.train(was_training)
+
+
+def find_batch_size(model, mode='train', device=None, criterion=None, optimizer=None,
+                    memory_fraction=0.9, max_batch=1024, granularity=8, warmup=2, iters=5, verbose=True):
+    """Searches the batch size for model in the given main.py mode ('train', 'eval' or
+    'shift'). Batch sizes double from 1 until one exceeds memory_fraction of the device
+    memory (or runs out of memory, or reaches max_batch); the largest fitting size is then
+    refined by bisection to a multiple of granularity. Train mode needs criterion and
+    optimizer; parameters, buffers and optimizer state are restored afterwards.
+
+    Returns (max_batch_size, best_batch_size, trials), where best_batch_size has the highest
+    measured images/sec and trials lists every size tried. When torch.distributed is
+    initialized, each rank searches on its own (pass the module inside DistributedDataParallel,
+    so no collectives run during the search) and all ranks then agree on the smallest result."""
+    if device is None:
+        device = next(model.parameters()).device
+    device = torch.device(device)
+    if mode == 'train' and (criterion is None or optimizer is None):
+        raise ValueError('train mode needs a criterion and an optimizer')
+
+    budget = None
+    if device.type == 'cuda':
+        budget = memory_fraction*torch.cuda.get_device_properties(device).total_memory
+
+    trials = []
+
+    def run(batch_size, timed=True):
+        fits, rate, peak = _trial(model, mode, batch_size, device, budget, criterion, optimizer,
+                                  warmup, iters if timed else 1)
+        trials.append({'batch_size': batch_size, 'fits': fits, 'images_per_sec': rate if timed else None,
+                       'peak_bytes': peak})
+        if verbose:
+            print('=> auto-batch [%s] batch %d: %s%s%s' % (mode, batch_size, 'ok' if fits else 'does not fit',
+                  '' if rate is None or not timed else ', %.1f img/s' % rate,
+                  '' if peak is None else ', peak %.0f MB' % (peak/2.**20)))
+        return fits
+
+    with _preserved(model, optimizer, mode, device):
+        lo, hi = 0, None
+        batch_size = 1
+        while batch_size <= max_batch:
+            if not run(batch_size):
+                hi = batch_size
+                break
+            lo = batch_size
+            batch_size *= 2
+        if hi is None:
+            hi = max_batch + 1
+        # refine between the largest fitting power of two and the first failing size
+        while lo > 0 and hi - lo > granularity:
+            mid = (lo + hi) // 2 // granularity * granularity
+            if mid <= lo:
+                break
+            if run(mid, timed=False):
+                lo = mid
+            else:
+                hi = mid
+        if lo > 0 and lo not in [t['batch_size'] for t in trials if t['images_per_sec'] is not None]:
+            run(lo)
+
+    if lo == 0:
+        raise RuntimeError('auto-batch: a batch of 1 does not fit in %.0f%% of device memory' % (100*memory_fraction))
+    timed = [t for t in trials if t['fits'] and t['images_per_sec'] is not None]
+    best = max(timed, key=lambda t: t['images_per_sec'])['batch_size']
+
+    if dist.is_available() and dist.is_initialized():
+        reduce_device = device if dist.get_backend() == 'nccl' else torch.device('cpu')
+        t = torch.tensor([lo, best], dtype=torch.int64, device=reduce_device)
+        dist.all_reduce(t, op=dist.ReduceOp.MIN)
+        lo, best = t.tolist()
+    return lo, best, trials
+
+
+def split_batch(total, max_per_step):
+    """(batch_size, batch_accum) with batch_size <= max_per_step and as few accumulation
+    steps as possible, such that batch_size*batch_accum is total or, if total does not
+    divide, the smallest product above it"""
+    batch_accum = int(math.ceil(1.*total/max_per_step))
+    batch_size = int(math.ceil(1.*total/batch_accum))
+    return batch_size, batch_accum
+
+
+def step_rate(model, batch_size, mode='train', device=None, criterion=None, optimizer=None, warmup=2, iters=5):
+    """Images/sec of model in the given main.py mode at batch_size, on random inputs.
+    Like find_batch_size, train mode needs criterion and optimizer and leaves parameters,
+    buffers and optimizer state as they were (gradients are cleared)."""
+    if device is None:
+        device = next(model.parameters()).device
+    device = torch.device(device)
+    if mode == 'train' and (criterion is None or optimizer is None):
+        raise ValueError('train mode needs a criterion and an optimizer')
+    with _preserved(model, optimizer, mode, device):
+        fits, rate, _ = _trial(model, mode, batch_size, device, None, criterion, optimizer, warmup, iters)
+    if not fits:
+        raise RuntimeError('a batch of %d does not fit in device memory' % batch_size)
+    return rate
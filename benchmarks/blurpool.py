@@ -0,0 +1,81 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# CPU microbenchmark of the BlurPool and BlurPool1D layers alone, over feature-map sizes
+# typical of the models in this package, filter sizes, pad types and thread counts.
+#
+# python benchmarks/blurpool.py --out blurpool.json
+# python benchmarks/blurpool.py --baseline blurpool.json   # exits 1 on regression
+#
+# Latencies are machine-specific, so no baseline is shipped: the first run with --baseline PATH
+# (or one with --out PATH) records it on this machine.
+
+import argparse
+import os
+
+import torch
+
+from common import time_fn, save_results, check_baseline
+import antialiased_cnns
+
+KEY_FIELDS = ['layer', 'shape', 'filter_size', 'pad_type', 'threads', 'backward']
+
+# (N, C, H, W) inputs seen by BlurPool in resnet50/densenet121 at batch 8 and 224x224
+SHAPES_2D = [(8, 64, 112, 112), (8, 256, 56, 56), (8, 512, 28, 28), (8, 1024, 14, 14)]
+SHAPES_1D = [(8, 64, 4096), (8, 256, 1024)]
+
+
+def parse_ints(s):
+    return [int(v) for v in s.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='BlurPool / BlurPool1D microbenchmark')
+    parser.add_argument('--filter-sizes', default='1,2,3,4,5', type=parse_ints)
+    parser.add_argument('--pad-types', default='reflect,zero')
+    parser.add_argument('--threads', default='1,%d'%os.cpu_count(), type=parse_ints)
+    parser.add_argument('--backward', action='store_true', help='also time forward+backward')
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--iters', default=20, type=int)
+    parser.add_argument('--out', default=None, help='write results as JSON')
+    parser.add_argument('--baseline', default=None,
+                        help='results JSON to compare against; created from this run if it does not exist')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='allowed relative slowdown of p50 latency')
+    args = parser.parse_args()
+
+    cases = [('BlurPool', antialiased_cnns.BlurPool, shape) for shape in SHAPES_2D] + \
+            [('BlurPool1D', antialiased_cnns.BlurPool1D, shape) for shape in SHAPES_1D]
+    results = []
+    for layer_name, layer_class, shape in cases:
+        for filter_size in args.filter_sizes:
+            for pad_type in args.pad_types.split(','):
+                layer = layer_class(shape[1], pad_type=pad_type, filt_size=filter_size, stride=2)
+                for backward in ([False, True] if args.backward else [False]):
+                    x = torch.randn(*shape, requires_grad=backward)
+                    def step():
+                        if backward:
+                            layer(x).sum().backward()
+                        else:
+                            with torch.no_grad():
+                                layer(x)
+                    for num_threads in args.threads:
+                        torch.set_num_threads(num_threads)
+                        stats = time_fn(step, warmup=args.warmup, iters=args.iters)
+                        stats.update({'layer': layer_name, 'shape': 'x'.join(map(str, shape)), 'filter_size': filter_size,
+                                      'pad_type': pad_type, 'threads': num_threads, 'backward': backward,
+                                      'gbytes_per_sec': x.numel()*x.element_size()/stats['p50_ms']/1e6})
+                        results.append(stats)
+                        print('{layer:>10} {shape:>16} f={filter_size} {pad_type:>7} t={threads:<3d} bwd={backward:d}  '
+                              'p50 {p50_ms:8.3f}ms  p90 {p90_ms:8.3f}ms  p99 {p99_ms:8.3f}ms  {gbytes_per_sec:6.2f} GB/s'.format(**stats))
+
+    if args.out is not None:
+        save_results(args.out, results, iters=args.iters)
+    if args.baseline is not None:
+        check_baseline(results, args.baseline, KEY_FIELDS, tolerance=args.tolerance, iters=args.iters)
+
+
+if __name__ == '__main__':
+    main()
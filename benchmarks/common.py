@@ -0,0 +1,112 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# Shared helpers for the benchmark scripts: timing, environment info, and comparing a
+# results file against a stored baseline.
+
+import importlib
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+# the scripts import antialiased_cnns from this checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def model_names():
+    """Every model constructor exported by antialiased_cnns"""
+    names = []
+    # the package re-exports the constructors, so antialiased_cnns.alexnet is the function,
+    # not the submodule
+    for module in ['alexnet', 'vgg', 'resnet', 'densenet', 'mobilenet']:
+        module = importlib.import_module('antialiased_cnns.' + module)
+        names += [name for name in module.__all__ if name.islower()]
+    return names
+
+
+def time_fn(fn, warmup=3, iters=20):
+    """Latency statistics of fn() in milliseconds"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iters):
+        t0 = time.perf_counter()
+        fn()
+        times.append(1000.*(time.perf_counter() - t0))
+    times = np.array(times)
+    return {'mean_ms': float(times.mean()), 'p50_ms': float(np.percentile(times, 50)),
+            'p90_ms': float(np.percentile(times, 90)), 'p99_ms': float(np.percentile(times, 99)),
+            'min_ms': float(times.min())}
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss/2.**20 if sys.platform=='darwin' else rss/1024. # bytes on macOS, KB on Linux
+
+
+def env_info():
+    return {'torch': torch.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count(), 'host': platform.node(),
+            'mkldnn': torch.backends.mkldnn.is_available()}
+
+
+def save_results(path, results, **meta):
+    out = dict(meta, env=env_info(), results=results)
+    with open(path, 'w') as f:
+        json.dump(out, f, indent=2)
+
+
+def compare(results, baseline_path, key_fields, metric='p50_ms', tolerance=0.1):
+    """Compares results to those stored in baseline_path, matching entries on key_fields.
+    Returns the list of regressions, i.e. entries whose metric grew by more than tolerance,
+    and the number of entries found in the baseline."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    base = dict((tuple(r[k] for k in key_fields), r) for r in baseline['results'])
+    regressions = []
+    matched = 0
+    for r in results:
+        key = tuple(r[k] for k in key_fields)
+        if key not in base:
+            continue
+        matched += 1
+        ratio = r[metric]/base[key][metric]
+        if ratio > 1. + tolerance:
+            regressions.append((key, base[key][metric], r[metric], ratio))
+    return regressions, matched
+
+
+def check_baseline(results, baseline_path, key_fields, metric='p50_ms', tolerance=0.1, **meta):
+    """Exits non-zero if results regressed against baseline_path. Latencies depend on the
+    machine, so no baseline is shipped: if baseline_path does not exist yet, results are
+    saved there as the baseline for later runs on this machine."""
+    if not os.path.exists(baseline_path):
+        save_results(baseline_path, results, **meta)
+        print('No baseline at %s; saved these results as the baseline'%baseline_path)
+        return
+    regressions, matched = compare(results, baseline_path, key_fields, metric, tolerance)
+    if matched == 0:
+        print('WARNING: no entry of %s matches these results; nothing compared'%baseline_path)
+    report_regressions(regressions, key_fields, metric, tolerance, matched)
+
+
+def report_regressions(regressions, key_fields, metric='p50_ms', tolerance=0.1, matched=None):
+    """Prints regressions and exits non-zero if there are any"""
+    if not regressions:
+        print('No regressions over %d%% in %s%s'%(100*tolerance, metric,
+                                                   '' if matched is None else ' (%d entries compared)'%matched))
+        return
+    print('REGRESSIONS (%s more than %d%% over baseline):'%(metric, 100*tolerance))
+    for key, base, new, ratio in regressions:
+        print('  %s: %.3f -> %.3f (x%.2f)'%(', '.join('%s=%s'%kv for kv in zip(key_fields, key)), base, new, ratio))
+    sys.exit(1)
@@ -0,0 +1,106 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# Checks main.py --jpeg-draft: decode time of full vs reduced-size (draft mode) JPEG decoding,
+# and that top-1 accuracy and shift consistency of a model barely change. Exits with an error
+# if either moves by more than --tolerance points on the evaluated subset.
+#
+# python benchmarks/jpeg_draft.py --data /PTH/TO/ILSVRC2012 -a resnet50_lpf4 --num-images 5000
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.utils.data
+import torchvision.transforms as transforms
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import antialiased_cnns
+from data import DraftLoader, IndexedImageFolder
+from torchvision.datasets.folder import default_loader
+
+
+def create_model(arch, weights=None):
+    if arch.split('_')[-1][:-1] == 'lpf':
+        model = antialiased_cnns.__dict__[arch[:-5]](pretrained=weights is None, filter_size=int(arch[-1]))
+    else:
+        import torchvision.models as models
+        model = models.__dict__[arch](pretrained=weights is None)
+    if weights is not None:
+        model.load_state_dict(torch.load(weights, map_location='cpu')['state_dict'])
+    return model.eval()
+
+
+def decode_time(dataset, loader, num):
+    t0 = time.perf_counter()
+    for i in range(num):
+        dataset.transform(loader(os.path.join(dataset.root, dataset.paths[i].decode())))
+    return 1000.*(time.perf_counter() - t0)/num
+
+
+def crops(input, offsets):
+    """224 crops of each image of input at its own (y, x) offset"""
+    return torch.stack([img[:, y:y+224, x:x+224] for img, (y, x) in zip(input, offsets)])
+
+
+def evaluate(model, dataset, args):
+    """top-1 on the 224 center crop and consistency over --pairs pairs of random 224 crops
+    of each 256 center crop, as in main.py --evaluate-shift; the offsets are seeded, so both
+    decoders see the same ones"""
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, num_workers=args.workers)
+    rng = np.random.RandomState(0)
+    correct, agree, total = 0., 0., 0
+    with torch.no_grad():
+        for input, target in loader:
+            input, target = input.to(args.device), target.to(args.device)
+            correct += (model(input[:, :, 16:240, 16:240]).argmax(1) == target).sum().item()
+            for _ in range(args.pairs):
+                off0, off1 = rng.randint(32, size=(2, input.size(0), 2))
+                agree += (model(crops(input, off0)).argmax(1) == model(crops(input, off1)).argmax(1)).sum().item()
+            total += input.size(0)
+    return 100.*correct/total, 100.*agree/(total*args.pairs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Accuracy and speed of reduced-size JPEG decoding')
+    parser.add_argument('--data', required=True, help='ImageNet root, containing val/')
+    parser.add_argument('-a', '--arch', default='resnet50_lpf4')
+    parser.add_argument('--weights', default=None, help='weights to evaluate (default: pretrained)')
+    parser.add_argument('--num-images', default=5000, type=int, help='size of the evenly spaced val subset')
+    parser.add_argument('--pairs', default=8, type=int, help='random crop pairs per image for consistency')
+    parser.add_argument('--decode-images', default=200, type=int, help='images to time decoding on')
+    parser.add_argument('-b', '--batch-size', default=64, type=int)
+    parser.add_argument('-j', '--workers', default=4, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--tolerance', default=0.3, type=float, help='allowed change of top-1 and consistency, in points')
+    args = parser.parse_args()
+
+    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    transform = transforms.Compose([transforms.Resize(256), transforms.CenterCrop(256), transforms.ToTensor(), normalize])
+    model = create_model(args.arch, args.weights).to(args.device)
+
+    results = {}
+    for name, loader in [('full', default_loader), ('draft', DraftLoader(256))]:
+        dataset = IndexedImageFolder(os.path.join(args.data, 'val'), transform, loader=loader)
+        ms = decode_time(dataset, loader, min(args.decode_images, len(dataset)))
+        subset = torch.utils.data.Subset(dataset, np.linspace(0, len(dataset) - 1, min(args.num_images, len(dataset))).astype(int))
+        top1, consist = evaluate(model, subset, args)
+        results[name] = (top1, consist)
+        print('%-6s decode+resize %.2f ms/img  top-1 %.3f  consistency %.3f'%(name, ms, top1, consist))
+
+    d_top1 = results['draft'][0] - results['full'][0]
+    d_consist = results['draft'][1] - results['full'][1]
+    print('draft - full: top-1 %+.3f, consistency %+.3f'%(d_top1, d_consist))
+    if max(abs(d_top1), abs(d_consist)) > args.tolerance:
+        print('FAILED: change exceeds %.2f points'%args.tolerance)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
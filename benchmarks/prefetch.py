@@ -0,0 +1,130 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# Steady-state allocation and stall benchmark of main.py --prefetch against the default
+# DataLoader(pin_memory=True) + .cuda(non_blocking=True) path, on uint8 batches from an
+# in-memory dataset and a simulated training step of --step-ms.
+#
+# python benchmarks/prefetch.py --batch-size 256 --workers 8 --step-ms 100
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.utils.data
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data import DeviceLoader, uint8_collate
+from loader import PrefetchLoader
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+class RandomImages(torch.utils.data.Dataset):
+    def __init__(self, num, size):
+        self.num = num
+        self.pool = np.random.RandomState(0).randint(0, 256, (16, size, size, 3)).astype(np.uint8)
+
+    def __getitem__(self, index):
+        return self.pool[index % len(self.pool)], index % 1000
+
+    def __len__(self):
+        return self.num
+
+
+def fake_step(device, step_ms, weight):
+    if device.type == 'cuda': # keep the GPU busy for about step_ms, without syncing
+        start = torch.cuda.Event(enable_timing=True)
+        start.record()
+        while True:
+            for _ in range(10):
+                weight = weight @ weight
+                weight /= weight.norm()
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            end.synchronize()
+            if start.elapsed_time(end) >= step_ms:
+                return weight
+    time.sleep(step_ms/1000.)
+    return weight
+
+
+def host_allocs(device):
+    if device.type != 'cuda' or not hasattr(torch.cuda, 'host_memory_stats'):
+        return None
+    return torch.cuda.host_memory_stats().get('num_host_alloc')
+
+
+def run(mode, args, device):
+    dataset = RandomImages(args.batch_size*(args.warmup + args.batches), args.size)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, num_workers=args.workers,
+                                         collate_fn=uint8_collate, pin_memory=(mode == 'pin_memory' and device.type == 'cuda'))
+    device_loader = DeviceLoader(loader, device, MEAN, STD)
+    weight = torch.randn(1024, 1024, device=device)
+
+    if mode == 'prefetch':
+        batches = iter(PrefetchLoader(device_loader, num_buffers=args.num_buffers))
+        host_ptrs = None
+    else:
+        host_ptrs = set()
+
+        def pinned_batches():
+            for batch in loader:
+                host_ptrs.add(batch[0].data_ptr())
+                yield device_loader.prepare(batch)
+        batches = pinned_batches()
+
+    stalls = []
+    for i in range(args.warmup + args.batches):
+        if i == args.warmup:
+            start, allocs0 = time.perf_counter(), host_allocs(device)
+            dev0 = torch.cuda.memory_stats(device).get('allocation.all.allocated', 0) if device.type == 'cuda' else None
+            if host_ptrs is not None:
+                host_ptrs.clear()
+        t0 = time.perf_counter()
+        input, target = next(batches)
+        if i >= args.warmup:
+            stalls.append(time.perf_counter() - t0)
+        weight = fake_step(device, args.step_ms, weight)
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    elapsed = time.perf_counter() - start
+    allocs1 = host_allocs(device)
+
+    result = {'mode': mode, 'batches_per_sec': args.batches/elapsed, 'stall_ms_mean': 1000.*np.mean(stalls),
+              'stall_ms_p90': 1000.*np.percentile(stalls, 90),
+              'host_buffers': args.num_buffers if host_ptrs is None else len(host_ptrs)}
+    if allocs0 is not None and allocs1 is not None:
+        result['pinned_allocs_per_batch'] = (allocs1 - allocs0)/args.batches
+    if dev0 is not None:
+        result['device_allocs_per_batch'] = (torch.cuda.memory_stats(device)['allocation.all.allocated'] - dev0)/args.batches
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='--prefetch vs pin_memory=True loader benchmark')
+    parser.add_argument('-b', '--batch-size', default=256, type=int)
+    parser.add_argument('--size', default=224, type=int, help='image size')
+    parser.add_argument('-j', '--workers', default=4, type=int)
+    parser.add_argument('--num-buffers', default=3, type=int)
+    parser.add_argument('--step-ms', default=50., type=float, help='duration of the simulated training step')
+    parser.add_argument('--warmup', default=5, type=int)
+    parser.add_argument('--batches', default=50, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    for mode in ['pin_memory', 'prefetch']:
+        result = run(mode, args, device)
+        print('  '.join('%s %s'%(k, ('%.3f'%v) if isinstance(v, float) else v) for k, v in result.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# Measures restart time and peak host memory of resuming from a checkpoint, comparing a
+# plain torch.load (the old --resume path) with main.py's mmap + lazy optimizer restore.
+# Each method runs in a fresh process so ru_maxrss reflects only that restore.
+#
+# python benchmarks/resume.py -a resnet101 --device cuda:0
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import antialiased_cnns
+
+METHODS = ['torch_load', 'mmap_lazy']
+
+
+def build(arch, device):
+    model = antialiased_cnns.__dict__[arch](filter_size=4).to(device)
+    optimizer = torch.optim.SGD(model.parameters(), 0.1, momentum=0.9, weight_decay=1e-4)
+    return model, optimizer
+
+
+def make_checkpoint(arch, path):
+    model, optimizer = build(arch, 'cpu')
+    model(torch.randn(2, 3, 64, 64)).sum().backward()
+    optimizer.step() # populate momentum buffers
+    torch.save({'epoch': 1, 'arch': arch, 'state_dict': model.state_dict(),
+                'best_acc1': torch.tensor(0.), 'optimizer': optimizer.state_dict()}, path)
+
+
+def restore(method, arch, path, device):
+    import main
+    model, optimizer = build(arch, device)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    t0 = time.perf_counter()
+    if method == 'torch_load':
+        checkpoint = torch.load(path, map_location=device)
+        model.load_state_dict(checkpoint['state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    else:
+        checkpoint = main.load_checkpoint(path)
+        model.load_state_dict(checkpoint['state_dict'])
+        main.load_optimizer_state_lazily(optimizer, checkpoint['optimizer'])
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    restart = time.perf_counter() - t0
+
+    # the lazily restored state is paid for on the first step; report it separately
+    for p in model.parameters():
+        p.grad = torch.zeros_like(p)
+    t0 = time.perf_counter()
+    optimizer.step()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    first_step = time.perf_counter() - t0
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'method': method, 'restart_s': restart, 'first_step_s': first_step,
+            'peak_rss_mb': peak_rss/1024., 'restore_rss_mb': (peak_rss-base_rss)/1024.}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Checkpoint resume benchmark')
+    parser.add_argument('-a', '--arch', default='resnet101')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--checkpoint', default=None, help='existing checkpoint to restore (default: make one)')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--out', default=None, help='write results as JSON')
+    parser.add_argument('--method', default=None, choices=METHODS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.method is not None: # child process
+        print(json.dumps(restore(args.method, args.arch, args.checkpoint, args.device)))
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.checkpoint
+        if path is None:
+            path = os.path.join(tmp, 'checkpoint.pth.tar')
+            make_checkpoint(args.arch, path)
+        print('checkpoint: %s (%.1f MB)'%(path, os.path.getsize(path)/2.**20))
+
+        results = []
+        for method in METHODS:
+            for _ in range(args.repeat):
+                out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--method', method,
+                    '-a', args.arch, '--device', args.device, '--checkpoint', path])
+                results.append(json.loads(out.decode().strip().split('\n')[-1]))
+                print('{method:>10}: restart {restart_s:.3f}s  first step {first_step_s:.3f}s  '
+                      'peak RSS {peak_rss_mb:.0f} MB (+{restore_rss_mb:.0f} MB)'.format(**results[-1]))
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump({'arch': args.arch, 'device': args.device, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# CPU inference benchmark of every antialiased_cnns constructor across filter sizes, batch
+# sizes and thread counts. Each (model, filter size) runs in its own process, so its peak
+# RSS is not polluted by other models; batch sizes run in increasing order, so the peak RSS
+# recorded after a batch size is the peak of that batch size.
+#
+# python benchmarks/zoo.py --out zoo.json
+# python benchmarks/zoo.py --models resnet18,resnet50 --baseline zoo.json   # exits 1 on regression
+#
+# Latencies are machine-specific, so no baseline is shipped: the first run with --baseline PATH
+# (or one with --out PATH) records it on this machine.
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import torch
+
+from common import model_names, time_fn, peak_rss_mb, save_results, check_baseline
+import antialiased_cnns
+
+KEY_FIELDS = ['model', 'filter_size', 'batch_size', 'threads']
+
+
+def parse_ints(s):
+    return [int(v) for v in s.split(',')]
+
+
+def bench_model(name, filter_size, batch_sizes, threads, size, warmup, iters):
+    torch.manual_seed(0)
+    model = antialiased_cnns.__dict__[name](filter_size=filter_size).eval()
+    results = []
+    for batch_size in sorted(batch_sizes):
+        x = torch.randn(batch_size, 3, size, size)
+        for num_threads in threads:
+            torch.set_num_threads(num_threads)
+            with torch.no_grad():
+                stats = time_fn(lambda: model(x), warmup=warmup, iters=iters)
+            stats.update({'model': name, 'filter_size': filter_size, 'batch_size': batch_size,
+                          'threads': num_threads, 'images_per_sec': 1000.*batch_size/stats['p50_ms'],
+                          'peak_rss_mb': peak_rss_mb()})
+            results.append(stats)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='antialiased_cnns model zoo CPU benchmark')
+    parser.add_argument('--models', default=None, help='comma-separated constructors (default: all)')
+    parser.add_argument('--filter-sizes', default='1,2,3,4,5', type=parse_ints)
+    parser.add_argument('--batch-sizes', default='1,8,32', type=parse_ints)
+    parser.add_argument('--threads', default='1,%d'%os.cpu_count(), type=parse_ints)
+    parser.add_argument('--size', default=224, type=int, help='input resolution')
+    parser.add_argument('--warmup', default=3, type=int)
+    parser.add_argument('--iters', default=20, type=int)
+    parser.add_argument('--out', default=None, help='write results as JSON')
+    parser.add_argument('--baseline', default=None,
+                        help='results JSON to compare against; created from this run if it does not exist')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='allowed relative slowdown of p50 latency')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None: # one (model, filter size) in a fresh process
+        name, filter_size = args.child.split(':')
+        results = bench_model(name, int(filter_size), args.batch_sizes, args.threads, args.size, args.warmup, args.iters)
+        print(json.dumps(results))
+        return
+
+    names = model_names() if args.models is None else args.models.split(',')
+    results = []
+    for name in names:
+        for filter_size in args.filter_sizes:
+            out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', '%s:%d'%(name, filter_size),
+                '--batch-sizes', ','.join(map(str, args.batch_sizes)), '--threads', ','.join(map(str, args.threads)),
+                '--size', str(args.size), '--warmup', str(args.warmup), '--iters', str(args.iters)])
+            for r in json.loads(out.decode().strip().split('\n')[-1]):
+                print('{model:>18} lpf{filter_size} b={batch_size:<3d} t={threads:<3d} p50 {p50_ms:9.2f}ms  '
+                      'p90 {p90_ms:9.2f}ms  p99 {p99_ms:9.2f}ms  {images_per_sec:8.1f} img/s  rss {peak_rss_mb:.0f}MB'.format(**r))
+                results.append(r)
+                sys.stdout.flush()
+
+    if args.out is not None:
+        save_results(args.out, results, size=args.size, iters=args.iters)
+    if args.baseline is not None:
+        check_baseline(results, args.baseline, KEY_FIELDS, tolerance=args.tolerance, size=args.size, iters=args.iters)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# Datasets and data-pipeline helpers for main.py.
+
+import fcntl
+import hashlib
+import json
+import math
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.utils.data
+from PIL import Image
+from torchvision.datasets import VisionDataset
+from torchvision.datasets.folder import IMG_EXTENSIONS, default_loader, find_classes, make_dataset
+
+from antialiased_cnns import BlurPool
+
+__all__ = ['SyntheticDataset', 'IndexedImageFolder', 'DraftLoader', 'uint8_collate', 'DeviceLoader',
+           'ThumbnailLoader', 'CanvasCollate', 'BatchAugment', 'DecodedCache',
+           'IMAGENET_TRAIN_SIZE', 'IMAGENET_VAL_SIZE']
+
+IMAGENET_TRAIN_SIZE = 1281167
+IMAGENET_VAL_SIZE = 50000
+
+
+class SyntheticDataset(torch.utils.data.Dataset):
+    """Stands in for an ImageFolder of num_samples already-normalized image_size crops, without
+    touching the disk. A pool of pool_size images is generated once and indexed cyclically;
+    images and labels are a deterministic function of seed. With device='cuda', the pool
+    lives on the GPU and the DataLoader must use num_workers=0 and pin_memory=False."""
+    def __init__(self, num_samples, image_size=224, num_classes=1000, seed=0, device='cpu', pool_size=64):
+        self.num_samples = num_samples
+        self.image_size = image_size
+        generator = torch.Generator().manual_seed(seed)
+        self.images = torch.randn(pool_size, 3, image_size, image_size, generator=generator).to(device)
+        self.targets = torch.randint(num_classes, (num_samples,), generator=generator).to(device)
+        self.classes = list(range(num_classes))
+
+    def __getitem__(self, index):
+        return self.images[index % len(self.images)], self.targets[index]
+
+    def __len__(self):
+        return self.num_samples
+
+
+def _dir_mtimes(root, classes):
+    """mtime of root and of every directory below the class folders, which changes whenever
+    a file is added, removed or renamed in it"""
+    mtimes = {'.': os.stat(root).st_mtime_ns}
+    for target_class in classes:
+        for dirpath, _, _ in os.walk(os.path.join(root, target_class), followlinks=True):
+            mtimes[os.path.relpath(dirpath, root)] = os.stat(dirpath).st_mtime_ns
+    return mtimes
+
+
+class IndexedImageFolder(VisionDataset):
+    """Same samples, order and labels as torchvision's ImageFolder, but the directory scan is
+    cached in cache_dir as one .npz per root and reused while the directories' mtimes are
+    unchanged. The first process to miss the cache builds it under a file lock; the others
+    (other ranks, other jobs) wait and load it. Paths are kept as one bytes array rather than
+    1.3M Python strings, so loading the index takes milliseconds."""
+    def __init__(self, root, transform=None, target_transform=None, cache_dir=None, loader=default_loader):
+        super(IndexedImageFolder, self).__init__(root, transform=transform, target_transform=target_transform)
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.loader = loader
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'antialiased_cnns', 'imagefolder')
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_path = os.path.join(cache_dir, hashlib.sha1(self.root.encode()).hexdigest()[:16] + '.npz')
+
+        index = self._load()
+        if index is None:
+            with open(self.cache_path + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                index = self._load() # built by another process while we waited
+                if index is None:
+                    index = self._build()
+        self.classes = index['classes']
+        self.class_to_idx = dict((c, i) for i, c in enumerate(self.classes))
+        self.paths = index['paths']
+        self.targets = index['targets']
+
+    def _load(self):
+        if not os.path.exists(self.cache_path):
+            return None
+        with np.load(self.cache_path) as f:
+            meta = json.loads(str(f['meta']))
+            if meta['root'] != self.root or not self._unchanged(meta['mtimes']):
+                return None
+            return {'classes': meta['classes'], 'paths': f['paths'], 'targets': f['targets']}
+
+    def _unchanged(self, mtimes):
+        # one stat per directory, without listing the files
+        try:
+            return all(os.stat(os.path.join(self.root, d)).st_mtime_ns == mtime for d, mtime in mtimes.items())
+        except OSError:
+            return False
+
+    def _build(self):
+        classes, class_to_idx = find_classes(self.root)
+        samples = make_dataset(self.root, class_to_idx, extensions=IMG_EXTENSIONS)
+        prefix = len(self.root) + 1
+        paths = np.array([path[prefix:].encode() for path, _ in samples])
+        targets = np.array([target for _, target in samples], dtype=np.int64)
+        meta = {'root': self.root, 'classes': classes, 'mtimes': _dir_mtimes(self.root, classes)}
+        tmp = self.cache_path + '.tmp.npz'
+        np.savez(tmp, paths=paths, targets=targets, meta=np.array(json.dumps(meta)))
+        os.replace(tmp, self.cache_path)
+        print('=> indexed %d images in %s (cached in %s)'%(len(paths), self.root, self.cache_path))
+        return {'classes': classes, 'paths': paths, 'targets': targets}
+
+    @property
+    def samples(self):
+        return [(os.path.join(self.root, path.decode()), int(target)) for path, target in zip(self.paths, self.targets)]
+
+    def __getitem__(self, index):
+        sample = self.loader(os.path.join(self.root, self.paths[index].decode()))
+        target = int(self.targets[index])
+        if self.transform is not None:
+            sample = self.transform(sample)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return sample, target
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class DraftLoader(object):
+    """Image loader for Resize(size) pipelines. JPEGs are decoded with PIL's draft mode at the
+    smallest DCT scale (1/2, 1/4 or 1/8) whose output still covers the size Resize(size)
+    would produce, so Resize only ever downsamples; other formats load as usual. Accepts a
+    path or a file object, so it serves ImageFolder and the shard datasets alike."""
+    def __init__(self, size=256):
+        self.size = size
+
+    def __call__(self, path):
+        f = open(path, 'rb') if isinstance(path, str) else path
+        try:
+            img = Image.open(f)
+            if img.format == 'JPEG':
+                w, h = img.size
+                scale = 1.*self.size/min(w, h)
+                if scale < 1:
+                    img.draft('RGB', (int(math.ceil(w*scale)), int(math.ceil(h*scale))))
+            return img.convert('RGB')
+        finally:
+            if f is not path:
+                f.close()
+
+
+class DecodedCache(torch.utils.data.Dataset):
+    """Wraps a dataset of deterministic size x size images (e.g. Resize(256) + CenterCrop(256))
+    and keeps each image, decoded to uint8, in a memory-mapped file under cache_dir after it
+    is first read; cache_dir on /dev/shm shares the images through shared memory with the
+    DataLoader workers, the other ranks on the node and later runs. Images are returned as
+    H x W x 3 uint8 arrays, center cropped to crop (the crop of the cached image equals
+    the one the wrapped pipeline would produce), then passed through transform.
+
+    A per-image flag is set after the image is written, so a process that stopped halfway
+    leaves only unflagged images, which are decoded again. The file name depends on the
+    dataset root, length and loader, and size; delete the files to free the memory."""
+    def __init__(self, dataset, cache_dir, size=256, crop=None, transform=None, name='val'):
+        self.dataset = dataset
+        self.size = size
+        self.crop = crop or size
+        self.transform = transform
+        self.targets = dataset.targets
+        loader = getattr(dataset, 'loader', None)
+        key = '%s|%d|%d|%s' % (os.path.abspath(dataset.root), len(dataset), size,
+                               getattr(loader, '__name__', type(loader).__name__))
+        self.path = os.path.join(cache_dir, '%s_%s' % (name, hashlib.sha1(key.encode()).hexdigest()[:16]))
+        os.makedirs(cache_dir, exist_ok=True)
+        if not os.path.exists(self.path + '.flags.npy'):
+            with open(self.path + '.lock', 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.exists(self.path + '.flags.npy'):
+                    self._create()
+        self._images = self._flags = None
+
+    def _create(self):
+        # the flags are renamed into place last, so their presence means both files are complete
+        tmp = '%s.%d.tmp.npy' % (self.path, os.getpid())
+        np.lib.format.open_memmap(tmp, mode='w+', dtype=np.uint8, shape=(len(self.dataset), self.size, self.size, 3))
+        os.replace(tmp, self.path + '.npy')
+        np.save(tmp, np.zeros(len(self.dataset), dtype=np.uint8))
+        os.replace(tmp, self.path + '.flags.npy')
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_images'] = state['_flags'] = None
+        return state
+
+    def __getitem__(self, index):
+        if self._images is None:
+            self._images = np.load(self.path + '.npy', mmap_mode='r+')
+            self._flags = np.load(self.path + '.flags.npy', mmap_mode='r+')
+        if self._flags[index]:
+            img = self._images[index]
+        else:
+            img, _ = self.dataset[index]
+            img = np.asarray(img, dtype=np.uint8)
+            if img.shape != (self.size, self.size, 3):
+                raise ValueError('DecodedCache expects %dx%d RGB images, got %s' % (self.size, self.size, img.shape))
+            self._images[index] = img
+            self._flags[index] = 1
+            img = self._images[index]
+        top = (self.size - self.crop) // 2
+        img = img[top:top + self.crop, top:top + self.crop]
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, self.targets[index]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def uint8_collate(batch):
+    """Collates (PIL image or HxWx3 uint8 array, label) samples of equal size into one
+    contiguous N x H x W x 3 uint8 tensor, a quarter of the size of ToTensor's floats.
+    DeviceLoader turns it into a normalized float batch on the GPU."""
+    first = np.asarray(batch[0][0], dtype=np.uint8)
+    images = torch.empty((len(batch),) + first.shape, dtype=torch.uint8)
+    images[0].numpy()[...] = first
+    for i, (img, _) in enumerate(batch[1:], 1):
+        images[i].numpy()[...] = np.asarray(img, dtype=np.uint8)
+    targets = torch.tensor([target for _, target in batch], dtype=torch.int64)
+    return images, targets
+
+
+class ThumbnailLoader(object):
+    """Image loader for BatchAugment: shrinks images to fit in size x size, keeping the
+    aspect ratio (JPEGs are decoded at a reduced DCT scale when possible). Smaller images
+    are left as they are."""
+    def __init__(self, size=448):
+        self.size = size
+
+    def __call__(self, path):
+        f = open(path, 'rb') if isinstance(path, str) else path
+        try:
+            img = Image.open(f)
+            img.thumbnail((self.size, self.size))
+            return img.convert('RGB')
+        finally:
+            if f is not path:
+                f.close()
+
+
+class CanvasCollate(object):
+    """Collates images of different sizes (at most size x size) into one N x size x size x 3
+    uint8 tensor, each image in the top-left corner and its last row and column repeated
+    over the rest. Returns (images, sizes, targets), sizes being N x 2 (height, width); the
+    sizes stay on the host (DeviceLoader and PrefetchLoader only move images and targets)."""
+    def __init__(self, size=448):
+        self.size = size
+
+    def __call__(self, batch):
+        images = torch.empty((len(batch), self.size, self.size, 3), dtype=torch.uint8)
+        sizes = torch.empty((len(batch), 2), dtype=torch.int64)
+        for i, (img, _) in enumerate(batch):
+            img = np.asarray(img, dtype=np.uint8)
+            h, w = img.shape[:2]
+            images[i].numpy()[...] = np.pad(img, ((0, self.size - h), (0, self.size - w), (0, 0)), mode='edge')
+            sizes[i, 0], sizes[i, 1] = h, w
+        targets = torch.tensor([target for _, target in batch], dtype=torch.int64)
+        return images, sizes, targets
+
+
+class BatchAugment(object):
+    """RandomResizedCrop + RandomHorizontalFlip + normalization for a whole batch on the GPU,
+    replacing the per-image PIL transforms. Takes the (images, sizes) of CanvasCollate, the
+    images on the device and the sizes on the host, so drawing the crops needs no sync.
+
+    Crop boxes are drawn per image as in torchvision's RandomResizedCrop. All crops are then
+    resized (and flipped) by a single grid_sample. Before that, images whose crop shrinks by
+    a factor r >= 1.5 are low-passed with the package's binomial BlurPool filter of size
+    ~2r-1 (3, 5 or 7), so the bilinear resize does not alias. The randomness of each batch is
+    a function of (seed, epoch, step, rank) only: set_epoch(epoch, step) before each epoch,
+    with step the first batch index when resuming mid-epoch. With the default 448 canvas
+    (twice the output size), crops of more than about half of the image area are low-passed.
+
+    Crops come from images already shrunk to ThumbnailLoader's size, so small crops are
+    upsampled from fewer pixels than with full-resolution PIL crops."""
+    def __init__(self, mean, std, size=224, scale=(0.08, 1.0), ratio=(3./4., 4./3.), flip=True,
+                 seed=0, rank=0, channels_last=False):
+        self.size = size
+        self.scale = scale
+        self.log_ratio = (np.log(ratio[0]), np.log(ratio[1]))
+        self.ratio = ratio
+        self.flip = flip
+        self.seed = seed
+        self.rank = rank
+        self.mean = mean
+        self.std = std
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.blurs = {}
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch, step=0):
+        self.epoch = epoch
+        self.step = step
+
+    def _generator(self):
+        seed = np.random.SeedSequence([self.seed, self.epoch, self.step, self.rank]).generate_state(1)[0]
+        return torch.Generator().manual_seed(int(seed))
+
+    def crop_params(self, sizes, generator, attempts=10):
+        """(top, left, height, width) per image, as RandomResizedCrop.get_params: the first of
+        `attempts` random boxes that fits, else the central crop at the nearest allowed ratio"""
+        n = sizes.shape[0]
+        h, w = sizes[:, 0:1].double(), sizes[:, 1:2].double()
+        area = h*w
+        target_area = area*torch.empty(n, attempts, dtype=torch.float64).uniform_(*self.scale, generator=generator)
+        aspect = torch.exp(torch.empty(n, attempts, dtype=torch.float64).uniform_(*self.log_ratio, generator=generator))
+        cw = torch.round(torch.sqrt(target_area*aspect))
+        ch = torch.round(torch.sqrt(target_area/aspect))
+        ok = (cw > 0) & (cw <= w) & (ch > 0) & (ch <= h)
+        first = torch.where(ok.any(1), ok.double().argmax(1), torch.full((n,), -1, dtype=torch.int64))
+        pick = first.clamp(min=0)[:, None]
+        ch, cw = ch.gather(1, pick), cw.gather(1, pick)
+        u = torch.rand(n, 2, generator=generator, dtype=torch.float64)
+        top = torch.floor(u[:, 0:1]*(h - ch + 1))
+        left = torch.floor(u[:, 1:2]*(w - cw + 1))
+
+        # no attempt fit: central crop, clamped to the allowed aspect ratios
+        in_ratio = w/h
+        fw = torch.where(in_ratio > self.ratio[1], torch.round(h*self.ratio[1]), w)
+        fh = torch.where(in_ratio < self.ratio[0], torch.round(w/self.ratio[0]), h)
+        fallback = (first < 0)[:, None]
+        ch, cw = torch.where(fallback, fh, ch), torch.where(fallback, fw, cw)
+        top = torch.where(fallback, torch.div(h - fh, 2, rounding_mode='floor'), top)
+        left = torch.where(fallback, torch.div(w - fw, 2, rounding_mode='floor'), left)
+        return torch.cat([top, left, ch, cw], dim=1)
+
+    def _blur(self, n, device):
+        if n not in self.blurs:
+            self.blurs[n] = BlurPool(3, pad_type='replicate', filt_size=n, stride=1).to(device)
+        return self.blurs[n]
+
+    def __call__(self, images, sizes):
+        generator = self._generator()
+        self.step += 1
+        n, canvas = images.shape[0], images.shape[1]
+        params = self.crop_params(sizes, generator)
+        flips = torch.rand(n, generator=generator) < 0.5 if self.flip else torch.zeros(n, dtype=torch.bool)
+
+        device = images.device
+        x = images.permute(0, 3, 1, 2).float()
+        # low-pass the images whose crop is shrunk by r >= 1.5, grouped by filter size
+        r = (params[:, 2:4].max(1)[0]/self.size).numpy()
+        filt_sizes = np.clip(1 + 2*np.floor(r - 0.5), 1, 7).astype(int)
+        for filt_size in np.unique(filt_sizes):
+            if filt_size > 1:
+                idx = torch.from_numpy(np.nonzero(filt_sizes == filt_size)[0]).to(device)
+                x[idx] = self._blur(int(filt_size), device)(x[idx])
+
+        # affine map from the output square to each crop box, in grid_sample's [-1, 1] units
+        top, left, ch, cw = [params[:, k].float() for k in range(4)]
+        theta = torch.zeros(n, 2, 3, pin_memory=device.type == 'cuda')
+        theta[:, 0, 0] = torch.where(flips, -cw/canvas, cw/canvas)
+        theta[:, 0, 2] = (2*left + cw)/canvas - 1
+        theta[:, 1, 1] = ch/canvas
+        theta[:, 1, 2] = (2*top + ch)/canvas - 1
+        grid = F.affine_grid(theta.to(device, non_blocking=True), (n, 3, self.size, self.size), align_corners=False)
+        out = F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+        mean = torch.tensor(self.mean, device=device).view(1, 3, 1, 1)
+        std = torch.tensor(self.std, device=device).view(1, 3, 1, 1)
+        return ((out/255. - mean)/std).contiguous(memory_format=self.memory_format)
+
+
+class DeviceLoader(object):
+    """Wraps a DataLoader so batches arrive on device, ready for the model. uint8 batches from
+    uint8_collate are normalized by mean/std (in the 0-1 scale of transforms.Normalize) with
+    one fused pass per batch; with channels_last, the layout change happens in the same pass
+    (an N x H x W x 3 batch already is channels-last). Float batches are only moved, and
+    converted to channels-last if asked. Batches of CanvasCollate go through augment (a
+    BatchAugment) instead. Other attributes (sampler, dataset, ...) are the
+    wrapped loader's."""
+    def __init__(self, loader, device, mean, std, channels_last=False, augment=None):
+        self.loader = loader
+        self.augment = augment
+        self.device = device
+        self.memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self.mean = 255.*torch.tensor(mean, device=device).view(1, 3, 1, 1)
+        self.inv_std = 1./(255.*torch.tensor(std, device=device).view(1, 3, 1, 1))
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['loader'], name)
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield self.prepare(batch)
+
+    def prepare(self, batch):
+        """One batch of the wrapped loader -> (input, target) on device"""
+        input = batch[0].to(self.device, non_blocking=True)
+        target = batch[-1].to(self.device, non_blocking=True)
+        if len(batch) == 3: # (images, sizes, targets) of CanvasCollate
+            input = self.augment(input, batch[1])
+        elif input.dtype == torch.uint8:
+            input = input.permute(0, 3, 1, 2) # N x 3 x H x W view, channels-last strides
+            out = torch.empty(input.shape, device=self.device, memory_format=self.memory_format)
+            torch.sub(input, self.mean, out=out)
+            input = out.mul_(self.inv_std)
+        elif self.memory_format is torch.channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
+        return input, target
+
+    def __len__(self):
+        return len(self.loader)
@@ -0,0 +1,289 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# Evaluates many models in one pass over the ImageNet validation set: each batch is decoded
+# once (to uint8 256 center crops) and fed to every model, either in this process or spread
+# over one worker process per device. Accuracy (of the 224 center crop) and consistency (exact
+# agreement over all distinct pairs of a --stride grid of shifted 224 crops, as main.py
+# --shift-table) of every model go to one JSON file, which plots/make_plots.py and
+# plots/make_plots2.py can plot instead of their built-in numbers.
+#
+# python evaluate_zoo.py --data /PTH/TO/ILSVRC2012 --preset plots --out zoo_plots.json
+# python evaluate_zoo.py --data /PTH/TO/ILSVRC2012 --preset plots2 --devices cuda:0 cuda:1 --out zoo_plots2.json
+# python evaluate_zoo.py --data /PTH/TO/ILSVRC2012 --models resnet50 resnet50_lpf4 --num-images 5000
+
+import argparse
+import json
+import os
+import queue
+import time
+import traceback
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.utils.data
+import torchvision.transforms as transforms
+
+import antialiased_cnns
+from data import DecodedCache, DeviceLoader, IndexedImageFolder, uint8_collate
+from evaluation import accuracy, shift_offsets, pair_consistency, shifted_crops
+
+__all__ = ['PRESETS', 'parse_model', 'create_model', 'ZooStats', 'evaluate_batch', 'evaluate_zoo', 'load_results']
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+# the models behind the plots: baselines and filter sizes 2, 3, 5 (make_plots.py), and
+# baselines and the default filter size 4 of the whole zoo (make_plots2.py)
+PRESETS = {
+    'plots': [arch + suffix
+              for arch in ['alexnet', 'vgg16', 'vgg16_bn', 'resnet18', 'resnet34', 'resnet50', 'resnet101',
+                           'densenet121', 'mobilenet_v2']
+              for suffix in ['', '_lpf2', '_lpf3', '_lpf5']],
+    'plots2': [arch + suffix
+               for arch in ['alexnet', 'vgg11', 'vgg13', 'vgg16', 'vgg19', 'vgg11_bn', 'vgg13_bn', 'vgg16_bn',
+                            'vgg19_bn', 'resnet18', 'resnet34', 'resnet50', 'resnet101', 'resnet152',
+                            'resnext50_32x4d', 'resnext101_32x8d', 'wide_resnet50_2', 'wide_resnet101_2',
+                            'densenet121', 'densenet169', 'densenet201', 'densenet161', 'mobilenet_v2']
+               for suffix in ['', '_lpf4']],
+}
+
+
+def parse_model(name):
+    """'resnet50_lpf3' -> ('resnet50', 3); baselines (torchvision models) have filter size 1"""
+    if name.split('_')[-1][:-1] == 'lpf':
+        return name[:-5], int(name[-1])
+    return name, 1
+
+
+def create_model(name):
+    """Pretrained model named as main.py's --arch"""
+    arch, filter_size = parse_model(name)
+    if filter_size > 1:
+        return antialiased_cnns.__dict__[arch](pretrained=True, filter_size=filter_size)
+    import torchvision.models as models
+    return models.__dict__[arch](pretrained=True)
+
+
+class ZooStats(object):
+    """Running totals of one model"""
+    def __init__(self):
+        self.count = 0
+        self.correct1 = 0.
+        self.correct5 = 0.
+        self.consist = 0.
+        self.seconds = 0.
+
+    def summary(self):
+        return {'acc1': self.correct1/self.count, 'acc5': self.correct5/self.count,
+                'consistency': self.consist/self.count, 'num_images': self.count, 'seconds': self.seconds}
+
+
+def evaluate_batch(model, input, target, stride, stats, channels_last=False):
+    """Classifies the center crop and the shift_offsets(stride) grid of crops of a normalized
+    B x 3 x 256 x 256 batch in one forward and adds the results to stats"""
+    start = time.perf_counter()
+    B, C = input.shape[:2]
+    grid, _ = shifted_crops(input, stride)
+    G = grid.size(1)*grid.size(2)
+    crops = torch.empty((B*(G + 1), C, 224, 224), dtype=input.dtype, device=input.device,
+                        memory_format=torch.channels_last if channels_last else torch.contiguous_format)
+    view = crops.view(B, G + 1, C, 224, 224)
+    view[:, 0].copy_(input[:, :, 16:240, 16:240])
+    view[:, 1:].view(grid.shape).copy_(grid)
+    with torch.no_grad():
+        output = model(crops).reshape(B, G + 1, -1)
+
+    acc1, acc5 = accuracy(output[:, 0], target, topk=(1, 5))
+    preds = output[:, 1:].argmax(dim=2)
+    counts = torch.zeros(B, output.size(2), device=preds.device)
+    counts.scatter_add_(1, preds, torch.ones_like(preds, dtype=counts.dtype))
+    stats.count += B
+    stats.correct1 += acc1.item()*B
+    stats.correct5 += acc5.item()*B
+    stats.consist += pair_consistency(counts).sum().item()
+    if input.is_cuda:
+        torch.cuda.synchronize(input.device)
+    stats.seconds += time.perf_counter() - start
+
+
+def _load_models(names, device, channels_last):
+    models = []
+    for name in names:
+        model = create_model(name).to(device).eval()
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last)
+        models.append((name, model))
+    return models
+
+
+def _worker(names, device, stride, channels_last, inbox, outbox):
+    """Evaluates names on device for every batch put in inbox, until None. Sends ('ready', None)
+    once the models are loaded, then ('done', summaries), or ('error', traceback) on failure."""
+    try:
+        device = torch.device(device)
+        models = _load_models(names, device, channels_last)
+        stats = dict((name, ZooStats()) for name in names)
+        prepare = DeviceLoader(None, device, MEAN, STD, channels_last=channels_last).prepare
+        outbox.put(('ready', None))
+        while True:
+            batch = inbox.get()
+            if batch is None:
+                break
+            input, target = prepare(batch)
+            for name, model in models:
+                evaluate_batch(model, input, target, stride, stats[name], channels_last)
+        outbox.put(('done', dict((name, s.summary()) for name, s in stats.items())))
+    except Exception:
+        outbox.put(('error', traceback.format_exc()))
+
+
+def _check_worker(proc, outbox):
+    """Raises RuntimeError if the worker process has exited, with its traceback if it sent one"""
+    if proc.is_alive():
+        return
+    try:
+        kind, value = outbox.get(timeout=1.)
+    except queue.Empty:
+        kind, value = 'error', 'exit code %s' % proc.exitcode
+    if kind == 'error':
+        raise RuntimeError('evaluate_zoo: worker %s failed:\n%s' % (proc.name, value))
+
+
+def _get(proc, outbox, timeout=1.):
+    """The next message of a worker, checking every timeout seconds that it is still running"""
+    while True:
+        try:
+            kind, value = outbox.get(timeout=timeout)
+        except queue.Empty:
+            _check_worker(proc, outbox)
+            continue
+        if kind == 'error':
+            raise RuntimeError('evaluate_zoo: worker %s failed:\n%s' % (proc.name, value))
+        return value
+
+
+def _put(proc, inbox, outbox, item, timeout=1.):
+    """Queues item for a worker, checking every timeout seconds that it is still running"""
+    while True:
+        try:
+            inbox.put(item, timeout=timeout)
+            return
+        except queue.Full:
+            _check_worker(proc, outbox)
+
+
+def evaluate_zoo(names, loader, devices, stride=8, channels_last=False, print_freq=50):
+    """Runs every model in names over the uint8 batches of loader (uint8_collate). With one
+    device the models run in this process; with several, each device gets a worker process
+    with every len(devices)-th model, and each batch is shared with all of them through shared
+    memory (at most two batches queued per worker). Returns {name: summary}. Raises
+    RuntimeError if a worker fails or dies; the other workers are then terminated."""
+    if len(devices) == 1:
+        device = torch.device(devices[0])
+        models = _load_models(names, device, channels_last)
+        stats = dict((name, ZooStats()) for name in names)
+        prepare = DeviceLoader(None, device, MEAN, STD, channels_last=channels_last).prepare
+        for i, batch in enumerate(loader):
+            input, target = prepare(batch)
+            for name, model in models:
+                evaluate_batch(model, input, target, stride, stats[name], channels_last)
+            if i % print_freq == 0:
+                print('[%d/%d] ' % (i, len(loader)) + '  '.join('%s %.2f' % (name, s.correct1/s.count)
+                                                                for name, s in stats.items()))
+        return dict((name, s.summary()) for name, s in stats.items())
+
+    ctx = mp.get_context('spawn')
+    workers = []
+    try:
+        for k, device in enumerate(devices):
+            share = names[k::len(devices)]
+            if not share:
+                continue
+            inbox, outbox = ctx.Queue(maxsize=2), ctx.Queue()
+            proc = ctx.Process(target=_worker, args=(share, device, stride, channels_last, inbox, outbox),
+                               name='zoo-%s' % device, daemon=True)
+            proc.start()
+            workers.append((proc, inbox, outbox))
+        for proc, _, outbox in workers: # models are loaded before the first batch is decoded
+            _get(proc, outbox)
+        for i, (images, targets) in enumerate(loader):
+            images.share_memory_()
+            targets.share_memory_()
+            for proc, inbox, outbox in workers:
+                _put(proc, inbox, outbox, (images, targets))
+            if i % print_freq == 0:
+                print('[%d/%d]' % (i, len(loader)))
+        results = {}
+        for proc, inbox, outbox in workers:
+            _put(proc, inbox, outbox, None)
+            results.update(_get(proc, outbox))
+            proc.join()
+        return results
+    finally:
+        for proc, _, _ in workers:
+            if proc.is_alive():
+                proc.terminate()
+
+
+def load_results(path):
+    """{(arch, filter_size): result} of a results file, filter size 1 for baselines"""
+    with open(path) as f:
+        return dict((parse_model(r['model']), r) for r in json.load(f)['results'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Accuracy and consistency of many models in one pass over ImageNet val')
+    parser.add_argument('--data', required=True, help='ImageNet root, containing val/')
+    parser.add_argument('--models', nargs='+', default=None, help='models, named as main.py --arch')
+    parser.add_argument('--preset', default=None, choices=sorted(PRESETS.keys()),
+                        help='models behind plots/make_plots.py (plots) or plots/make_plots2.py (plots2)')
+    parser.add_argument('--out', default='zoo_results.json', help='results file (default: zoo_results.json)')
+    parser.add_argument('--stride', default=8, type=int,
+                        help='offset spacing of the consistency grid within 0..31; 1 gives all 1024 offsets (default: 8)')
+    parser.add_argument('--num-images', default=None, type=int, help='evaluate an evenly spaced subset of val')
+    parser.add_argument('-b', '--batch-size', default=32, type=int, help='images per batch; each is 1 + grid crops')
+    parser.add_argument('-j', '--workers', default=8, type=int)
+    parser.add_argument('--devices', nargs='+', default=['cuda' if torch.cuda.is_available() else 'cpu'],
+                        help='one worker process per device when more than one (default: cuda, or cpu)')
+    parser.add_argument('--val-cache', default=None, help="as main.py's --val-cache, e.g. /dev/shm")
+    parser.add_argument('--channels-last', action='store_true')
+    parser.add_argument('--print-freq', default=50, type=int)
+    args = parser.parse_args()
+
+    names = list(args.models or []) + (PRESETS[args.preset] if args.preset else [])
+    if not names:
+        parser.error('give --models and/or --preset')
+
+    decode = transforms.Compose([transforms.Resize(256), transforms.CenterCrop(256)])
+    dataset = IndexedImageFolder(os.path.join(args.data, 'val'), decode)
+    if args.val_cache:
+        dataset = DecodedCache(dataset, args.val_cache)
+    if args.num_images is not None:
+        dataset = torch.utils.data.Subset(dataset, np.linspace(0, len(dataset) - 1, args.num_images).astype(int))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, num_workers=args.workers,
+                                         collate_fn=uint8_collate, pin_memory=torch.cuda.is_available())
+
+    start = time.time()
+    results = evaluate_zoo(names, loader, args.devices, stride=args.stride, channels_last=args.channels_last,
+                           print_freq=args.print_freq)
+    rows = []
+    for name in names:
+        arch, filter_size = parse_model(name)
+        row = {'model': name, 'arch': arch, 'filter_size': filter_size}
+        row.update(results[name])
+        rows.append(row)
+        print('%-24s acc@1 %.3f  acc@5 %.3f  consistency %.3f' % (name, row['acc1'], row['acc5'], row['consistency']))
+    with open(args.out, 'w') as f:
+        json.dump({'data': os.path.abspath(args.data), 'num_images': len(dataset), 'stride': args.stride,
+                   'num_offsets': len(shift_offsets(args.stride)), 'seconds': time.time() - start,
+                   'results': rows}, f, indent=1)
+    print('=> wrote %s' % args.out)
+
+
+if __name__ == '__main__':
+    main()
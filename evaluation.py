@@ -0,0 +1,56 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# Evaluation helpers shared by main.py and evaluate_zoo.py: top-k accuracy, the offsets and
+# crop views of the shift-consistency evaluations, and exact consistency from per-image
+# counts of the predicted classes.
+
+import torch
+
+__all__ = ['accuracy', 'shift_offsets', 'pair_consistency', 'shifted_crops']
+
+
+def accuracy(output, target, topk=(1,)):
+    """Computes the accuracy over the k top predictions for the specified values of k"""
+    with torch.no_grad():
+        maxk = max(topk)
+        batch_size = target.size(0)
+
+        _, pred = output.topk(maxk, 1, True, True)
+        pred = pred.t()
+        correct = pred.eq(target.view(1, -1).expand_as(pred))
+
+        res = []
+        for k in topk:
+            correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
+            res.append(correct_k.mul_(100.0 / batch_size))
+        return res
+
+
+def shift_offsets(stride=1, max_shift=32):
+    """(dy, dx) offsets of the 224 crops main.py's validate_shift draws from a 256 image, every
+    stride-th along each axis"""
+    return [(dy, dx) for dy in range(0, max_shift, stride) for dx in range(0, max_shift, stride)]
+
+
+def pair_consistency(counts):
+    """Per-image agreement (%) over all distinct pairs of an image's n predictions, given the
+    images x classes counts of each predicted class (each row sums to n)"""
+    n = counts.sum(dim=1)
+    return 100.*((counts**2).sum(dim=1) - n)/(n*(n - 1))
+
+
+def shifted_crops(input, stride, size=224):
+    """Views of the crops main.py's validate_all classifies, of input (B x C x 256 x 256),
+    with no copy: the grid of offsets shift_offsets(stride), as (B, n, n, C, size, size), and
+    the 33 diagonal offsets (k, k), k = 0..32, as (B, 33, C, size, size), of which the 17th
+    is the center crop"""
+    B, C, H, W = input.shape
+    sB, sC, sH, sW = input.stride()
+    n = len(range(0, 32, stride))
+    grid = input.as_strided((B, n, n, C, size, size), (sB, stride*sH, stride*sW, sC, sH, sW), input.storage_offset())
+    diag = input.as_strided((B, H - size + 1, C, size, size), (sB, sH + sW, sC, sH, sW), input.storage_offset())
+    return grid, diag
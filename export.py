@@ -0,0 +1,93 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# Image export for main.py --evaluate-save: batches of uint8 images are encoded (PNG or JPEG)
+# and written by a pool of worker processes or threads, with a bounded number of batches in
+# flight so the loader cannot run ahead of the encoders. Files are named by dataset index and
+# renamed into place once complete, so an interrupted export can be resumed.
+
+import collections
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+__all__ = ['ImageExporter', 'denormalize']
+
+# file extension, PIL format, save option set by the compression argument, its default
+FORMATS = {
+    'png': ('png', 'PNG', 'compress_level', 6),
+    'jpg': ('jpg', 'JPEG', 'quality', 95),
+}
+
+
+def denormalize(input, mean, std):
+    """Normalized B x 3 x H x W float batch -> B x H x W x 3 uint8 tensor on the same device"""
+    mean = torch.tensor(mean, device=input.device).view(1, -1, 1, 1)
+    std = torch.tensor(std, device=input.device).view(1, -1, 1, 1)
+    return (255*(input.float()*std + mean).clamp_(0, 1)).to(torch.uint8).permute(0, 2, 3, 1)
+
+
+def _write(images, paths, pil_format, options):
+    for img, path in zip(images, paths):
+        tmp = path + '.tmp'
+        Image.fromarray(img).save(tmp, format=pil_format, **options)
+        os.replace(tmp, path)
+    return len(paths)
+
+
+class ImageExporter(object):
+    """Writes uint8 H x W x 3 images to out_dir/<index>.<ext> on a pool of workers ('process'
+    or 'thread'). compression is the PNG compress level (0-9) or the JPEG quality (1-100).
+    submit() blocks while max_pending batches are still being encoded; images whose file
+    already exists are skipped."""
+    def __init__(self, out_dir, fmt='png', compression=None, workers=8, pool='process', max_pending=None):
+        if fmt not in FORMATS:
+            raise ValueError('unknown image format %r, expected one of %s' % (fmt, ', '.join(sorted(FORMATS))))
+        self.out_dir = out_dir
+        self.ext, self.pil_format, option, default = FORMATS[fmt]
+        self.options = {option: default if compression is None else compression}
+        self.max_pending = max_pending or 2*workers
+        executor = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+        self.pool = executor(max_workers=workers)
+        self.pending = collections.deque()
+        self.written = 0
+        os.makedirs(out_dir, exist_ok=True)
+
+    def path(self, index):
+        return os.path.join(self.out_dir, '%05d.%s' % (index, self.ext))
+
+    def exists(self, index):
+        return os.path.exists(self.path(index))
+
+    def first_missing(self, indices):
+        """Position in indices of the first image not yet written (len(indices) if none)"""
+        for pos, index in enumerate(indices):
+            if not self.exists(index):
+                return pos
+        return len(indices)
+
+    def submit(self, images, indices):
+        """Queues a B x H x W x 3 uint8 array of the images with the given dataset indices"""
+        keep = [k for k, index in enumerate(indices) if not self.exists(index)]
+        if not keep:
+            return
+        while len(self.pending) >= self.max_pending:
+            self.written += self.pending.popleft().result()
+        images = np.ascontiguousarray(images[keep] if len(keep) < len(indices) else images)
+        paths = [self.path(indices[k]) for k in keep]
+        self.pending.append(self.pool.submit(_write, images, paths, self.pil_format, self.options))
+
+    def close(self):
+        """Waits for every queued image; returns the number written"""
+        try:
+            while self.pending:
+                self.written += self.pending.popleft().result()
+        finally:
+            self.pool.shutdown()
+        return self.written
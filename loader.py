@@ -0,0 +1,238 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# Prefetching for main.py --prefetch: batches are copied into a fixed ring of pinned host
+# buffers by a background thread, and their host-to-device copy and preprocessing are issued
+# on a side CUDA stream one step ahead, so they overlap with the previous step's compute.
+#
+# DataLoader tuning for main.py --loader-autotune: worker count and prefetch depth are probed
+# against a consumer that takes as long per batch as the model's training (or evaluation)
+# step, and the cheapest setting that keeps it fed is cached per host, dataset and model.
+
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+
+import torch
+import torch.utils.data
+
+__all__ = ['PrefetchLoader', 'autotune_loader', 'load_loader_settings', 'save_loader_settings']
+
+
+class PrefetchLoader(object):
+    """Wraps a data.DeviceLoader. Its DataLoader (which should not pin memory itself) is read
+    by a background thread into num_buffers preallocated host buffers, pinned on CUDA, that
+    are reused for the whole run; a buffer is refilled once its copy to the device has
+    completed. The main thread issues batch N+1's copy and DeviceLoader.prepare on a side
+    stream before handing out batch N, and the compute stream waits for it only when N+1 is
+    handed out. Time spent waiting for the thread is accumulated in stall_secs (and shows up
+    in the caller's data-loading time). Other attributes are the DeviceLoader's."""
+    def __init__(self, device_loader, num_buffers=3):
+        self.device_loader = device_loader
+        self.num_buffers = num_buffers
+        self.device = torch.device(device_loader.device)
+        self.cuda = self.device.type == 'cuda'
+        self.buffers = [None]*num_buffers
+        self.copied = [None]*num_buffers # event marking the end of each buffer's device copy
+        self.stall_secs = 0.
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['device_loader'], name)
+
+    def __len__(self):
+        return len(self.device_loader)
+
+    def _copy_into(self, slot, batch):
+        """Copies a batch (tuple of tensors) into ring buffer slot, growing it if needed"""
+        buffers = self.buffers[slot]
+        if buffers is None or len(buffers) != len(batch):
+            buffers = [None]*len(batch)
+        views = []
+        for k, t in enumerate(batch):
+            buf = buffers[k]
+            if buf is None or buf.dtype != t.dtype or buf.shape[1:] != t.shape[1:] or buf.shape[0] < t.shape[0]:
+                buf = buffers[k] = torch.empty(t.shape, dtype=t.dtype, pin_memory=self.cuda)
+            view = buf[:t.shape[0]]
+            view.copy_(t)
+            views.append(view)
+        self.buffers[slot] = buffers
+        return views
+
+    def _fill(self, batches, free, ready, stop):
+        try:
+            for batch in batches:
+                slot = free.get()
+                if stop.is_set():
+                    return
+                if self.copied[slot] is not None:
+                    self.copied[slot].synchronize()
+                ready.put((slot, self._copy_into(slot, batch)))
+            ready.put(None)
+        except Exception as e:
+            ready.put(e)
+
+    def _issue(self, ready, free, stream):
+        """Takes the next filled buffer and starts its copy and preprocessing. Returns
+        ((input, target), done event), or None at the end of the epoch."""
+        start = time.perf_counter()
+        item = ready.get()
+        self.stall_secs += time.perf_counter() - start
+        if item is None:
+            return None
+        if isinstance(item, Exception):
+            raise item
+        slot, views = item
+        if not self.cuda: # no copy engine to overlap with; copy out of the ring right away
+            free.put(slot)
+            return self.device_loader.prepare([v.clone() for v in views]), None
+        with torch.cuda.stream(stream):
+            # images and targets; the sizes of CanvasCollate stay on the host for BatchAugment,
+            # which reads them in prepare below, before the slot is refilled
+            batch = [v.to(self.device, non_blocking=True) if k in (0, len(views) - 1) else v
+                     for k, v in enumerate(views)]
+            self.copied[slot] = torch.cuda.Event()
+            self.copied[slot].record(stream)
+            out = self.device_loader.prepare(batch)
+            done = torch.cuda.Event()
+            done.record(stream)
+        free.put(slot)
+        return out, done
+
+    def __iter__(self):
+        free, ready, stop = queue.Queue(), queue.Queue(), threading.Event()
+        for slot in range(self.num_buffers):
+            free.put(slot)
+        thread = threading.Thread(target=self._fill, args=(iter(self.device_loader.loader), free, ready, stop),
+                                  name='PrefetchLoader', daemon=True)
+        thread.start()
+        stream = torch.cuda.Stream(self.device) if self.cuda else None
+        try:
+            pending = self._issue(ready, free, stream)
+            while pending is not None:
+                upcoming = self._issue(ready, free, stream)
+                (input, target), done = pending
+                if done is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(done)
+                    # the tensors were allocated on the side stream but are freed after use on this one
+                    input.record_stream(current)
+                    target.record_stream(current)
+                yield input, target
+                pending = upcoming
+        finally:
+            # on an early exit (break, preemption, error) the thread may be waiting for a free
+            # slot or inside the DataLoader; wake it and wait for it, so it cannot pull from
+            # the (persistent) workers once the next epoch's iterator reuses them
+            stop.set()
+            free.put(None)
+            thread.join()
+
+
+def _probe(dataset, batch_size, num_workers, prefetch_factor, step_secs, sampler, collate_fn, batches):
+    """Reads a DataLoader while simulating a consumer that spends step_secs on each batch.
+    The batches that workers have buffered by the time the first one arrives are skipped, so
+    only the steady state is measured. Returns (secs to the first batch, mean stall per batch)."""
+    kwargs = {'batch_size': batch_size, 'sampler': sampler, 'num_workers': num_workers}
+    if collate_fn is not None:
+        kwargs['collate_fn'] = collate_fn
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = prefetch_factor
+    warmup = max(1, num_workers*prefetch_factor)
+    stalls = []
+    start = time.perf_counter()
+    batch_iter = iter(torch.utils.data.DataLoader(dataset, **kwargs))
+    try:
+        for i in range(warmup + batches):
+            t0 = time.perf_counter()
+            try:
+                next(batch_iter)
+            except StopIteration:
+                break
+            t1 = time.perf_counter()
+            if i == 0:
+                startup = t1 - start
+            elif i >= warmup:
+                stalls.append(t1 - t0)
+            time.sleep(step_secs)
+    finally:
+        del batch_iter # shuts the workers down
+    if not stalls:
+        raise RuntimeError('loader autotune: the dataset has too few batches to probe with %d workers' % num_workers)
+    return startup, sum(stalls)/len(stalls)
+
+
+def autotune_loader(dataset, batch_size, step_secs, sampler=None, collate_fn=None, max_workers=None,
+                    prefetch_factors=(2, 4), max_stall=0.05, batches=20, epoch_batches=None, max_startup=0.02,
+                    verbose=True):
+    """Chooses DataLoader settings for a consumer taking step_secs per batch. Worker counts
+    grow from 1 to max_workers (default: the CPU count) and, for each, the prefetch factors
+    are tried in order; the first setting whose mean stall is at most max_stall of a step is
+    taken, otherwise the cheapest one that comes within max_stall of the least stall. Pass the sampler used for training, so the
+    access pattern (e.g. shard order) is the real one. Workers are kept alive across epochs
+    when restarting them (the probe's time to the first batch) costs more than max_startup
+    of an epoch of epoch_batches steps (default: the length of the sampler or dataset).
+
+    Returns a dict with num_workers, prefetch_factor and persistent_workers (DataLoader
+    keyword arguments), plus the measurements: stall fraction, startup_secs, epoch_secs and
+    all probes."""
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    counts = sorted(set([n for n in [1, 2, 4, 6, 8, 12, 16, 24, 32, 48, 64] if n < max_workers] + [max_workers]))
+    probes = []
+    chosen = None
+    for num_workers in counts:
+        for prefetch_factor in prefetch_factors:
+            startup, stall = _probe(dataset, batch_size, num_workers, prefetch_factor, step_secs, sampler,
+                                    collate_fn, batches)
+            probe = {'num_workers': num_workers, 'prefetch_factor': prefetch_factor,
+                     'stall': stall/max(step_secs, 1e-9), 'startup_secs': startup}
+            probes.append(probe)
+            if verbose:
+                print('=> loader autotune: %d workers, prefetch %d: stall %.1f%% of a %.0f ms step, %.1f s to start'
+                      % (num_workers, prefetch_factor, 100*probe['stall'], 1000*step_secs, startup))
+            if probe['stall'] <= max_stall:
+                chosen = probe
+                break
+        if chosen is not None:
+            break
+    if chosen is None: # nothing keeps up; the cheapest setting within max_stall of the best
+        least = min(p['stall'] for p in probes)
+        chosen = [p for p in probes if p['stall'] <= least + max_stall][0]
+    if epoch_batches is None:
+        epoch_batches = -(-len(sampler if sampler is not None else dataset) // batch_size)
+    epoch_secs = epoch_batches*step_secs
+    settings = dict(chosen)
+    settings.update(persistent_workers=chosen['num_workers'] > 0 and chosen['startup_secs'] > max_startup*epoch_secs,
+                    step_secs=step_secs, epoch_secs=epoch_secs, probes=probes)
+    return settings
+
+
+def load_loader_settings(path, key):
+    """Settings saved by save_loader_settings under key, or None"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f).get(key)
+
+
+def save_loader_settings(path, key, settings):
+    """Stores settings under key in the JSON file at path; concurrent writers (jobs on
+    other hosts sharing a home directory) are serialized by a lock file"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        table = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                table = json.load(f)
+        table[key] = settings
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(table, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
@@ -38,14 +38,21 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 
 import argparse
+import atexit
+import copy
+import json
 import os
 import random
 import shutil
+import signal
 import time
 import warnings
+import socket
 import sys
+import threading
 import numpy as np
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import torch
 import torch.nn as nn
@@ -61,17 +68,65 @@ import torchvision.datasets as datasets
 
 import antialiased_cnns
 import torchvision.models as models
+from metrics import MetricsLogger, StepTimer, Throughput
+from batchsize import find_batch_size, split_batch, step_rate
+from data import SyntheticDataset, IndexedImageFolder, DraftLoader, uint8_collate, DeviceLoader, IMAGENET_TRAIN_SIZE, IMAGENET_VAL_SIZE
+from data import ThumbnailLoader, CanvasCollate, BatchAugment, DecodedCache
+from loader import PrefetchLoader, autotune_loader, load_loader_settings, save_loader_settings
+from shards import open_shards, ArrayShardDataset, ShardSampler, ShardCache
+from export import ImageExporter, denormalize
+from evaluation import accuracy, shift_offsets, pair_consistency, shifted_crops
 
 model_names = sorted(name for name in models.__dict__
     if name.islower() and not name.startswith("__")
     and callable(models.__dict__[name]))
 
+
+def step_range(value):
+    """argparse type for START:END iteration ranges, 0 <= START < END"""
+    try:
+        start, end = [int(v) for v in value.split(':')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected START:END, got %r' % value)
+    if not 0 <= start < end:
+        raise argparse.ArgumentTypeError('expected 0 <= START < END, got %r' % value)
+    return start, end
+
+
 parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
 parser.add_argument('--data', metavar='DIR', default='/datasets01/imagenet_full_size/061417',
                     help='path to dataset')
 parser.add_argument('--dryrun', action='store_true',
                     help='run on a mini dataset so you don\'t have to build the datafolders over the full imagenet \
                     dataset')
+parser.add_argument('--data-format', default='folder', choices=['folder', 'shards'],
+                    help='folder: ImageFolder of JPEGs; shards: --data holds train/val shards written by '
+                         'shards.py (default: folder)')
+parser.add_argument('--uint8-transfer', action='store_true',
+                    help='load workers emit uint8 batches, which are normalized on the GPU (4x less pinned memory '
+                         'and host-to-device traffic than float batches)')
+parser.add_argument('--gpu-aug', action='store_true',
+                    help='do the training RandomResizedCrop, flip and normalization for whole batches on the GPU '
+                         '(implies --uint8-transfer); workers only decode and shrink images to --gpu-aug-canvas')
+parser.add_argument('--gpu-aug-canvas', default=448, type=int, metavar='N',
+                    help='images are shrunk to fit N x N before --gpu-aug crops them; crops shrunk by 1.5x or more '
+                         'are low-passed first, which needs N well above 224 (default: 448)')
+parser.add_argument('--prefetch', default=0, type=int, metavar='N',
+                    help='collate batches into a ring of N reused pinned buffers and copy/normalize the next batch '
+                         'on a side CUDA stream while the current step runs (default: 0, off)')
+parser.add_argument('--channels-last', action='store_true',
+                    help='run the model and its inputs in channels-last memory format')
+parser.add_argument('--jpeg-draft', action='store_true',
+                    help='decode JPEGs at a reduced DCT scale that still covers Resize(256), in the validation '
+                         'and --no-data-aug training pipelines')
+parser.add_argument('--index-cache', default=None, type=str, metavar='DIR',
+                    help='where the cached file list of each ImageFolder is kept, shared by all ranks and jobs '
+                         '(default: ~/.cache/antialiased_cnns/imagefolder; none to scan the directories every time)')
+parser.add_argument('--synthetic', action='store_true',
+                    help='use deterministic random images of the right shapes instead of --data, to measure '
+                         'model and step throughput without the input pipeline')
+parser.add_argument('--synthetic-device', default='cpu', choices=['cpu', 'cuda'],
+                    help='where --synthetic images are kept; cuda also skips the host-to-device copy (default: cpu)')
 parser.add_argument('-l', '--learned-frame', action='store_true',
                     help='If true, we are going to learn a frame by gradient descent on the loss')
 parser.add_argument('--entropy-scale', default=0.0, type=float,
@@ -115,6 +170,14 @@ parser.add_argument('-e', '--evaluate', dest='evaluate', action='store_true',
                     help='evaluate model on validation set')
 parser.add_argument('--evaluate-save', dest='evaluate_save', action='store_true',
                     help='save validation images off')
+parser.add_argument('--save-format', default='png', choices=['png', 'jpg'],
+                    help='image format of --evaluate-save (default: png)')
+parser.add_argument('--save-compression', default=None, type=int,
+                    help='PNG compress level 0-9 (default: 6) or JPEG quality 1-100 (default: 95) of --evaluate-save')
+parser.add_argument('--save-workers', default=8, type=int,
+                    help='processes (or threads, see --save-pool) encoding --evaluate-save images (default: 8)')
+parser.add_argument('--save-pool', default='process', choices=['process', 'thread'],
+                    help='encode --evaluate-save images on a process or a thread pool (default: process)')
 parser.add_argument('--world-size', default=-1, type=int,
                     help='number of nodes for distributed training')
 parser.add_argument('--rank', default=-1, type=int,
@@ -142,8 +205,21 @@ parser.add_argument('-es', '--evaluate-shift', dest='evaluate_shift', action='st
                     help='evaluate model on shift-invariance')
 parser.add_argument('--epochs-shift', default=5, type=int, metavar='N',
                     help='number of total epochs to run for shift-invariance test')
+parser.add_argument('--shift-table', action='store_true',
+                    help='with -es, classify every image at each offset of the 32x32 grid once and compute the '
+                         'consistency over all offset pairs exactly, instead of sampling --epochs-shift random pairs; '
+                         'the per-offset predictions are saved to shift_preds.npy in --out-dir')
+parser.add_argument('--shift-stride', default=1, type=int, metavar='N',
+                    help='with --shift-table, use every N-th offset along each axis (default: 1, all 1024)')
 parser.add_argument('-ed', '--evaluate-diagonal', dest='evaluate_diagonal', action='store_true',
                     help='evaluate model on diagonal')
+parser.add_argument('--evaluate-all', dest='evaluate_all', action='store_true',
+                    help='evaluate accuracy, shift-consistency and the diagonal statistics in one pass: the center '
+                         'crop, a grid of shifted crops and the 33 diagonal crops of each image are classified '
+                         'in batched forwards of at most -b crops, so a batch holds -b / (grid + off-grid diagonal) '
+                         'images')
+parser.add_argument('--evaluate-all-stride', default=8, type=int, metavar='N',
+                    help='offset spacing of the --evaluate-all shift grid within 0..31 (default: 8, 4x4 offsets)')
 parser.add_argument('-ba', '--batch-accum', default=1, type=int,
                     metavar='N',
                     help='number of mini-batches to accumulate gradient over before updating (default: 1)')
@@ -160,7 +236,53 @@ parser.add_argument('-mti', '--max-train-iters', default=np.inf, type=int,
                     help='number of training iterations per epoch before cutting off (default: infinite)')
 
 parser.add_argument('--wandb', action='store_true', help='use wandb logging')
+parser.add_argument('--profile-steps', default=None, type=step_range, metavar='START:END',
+                    help='run torch.profiler over iterations [START, END) of one epoch\'s train and validate, '
+                         'writing Chrome traces and per-op summaries to out-dir (default: off)')
+parser.add_argument('--profile-epoch', default=None, type=int, metavar='N',
+                    help='epoch profiled by --profile-steps (default: the first epoch of the run)')
+parser.add_argument('--metrics-format', default='jsonl', type=str,
+                    help='comma-separated local metrics formats written to out-dir: jsonl | csv | none (default: jsonl)')
+parser.add_argument('--metrics-flush-secs', default=5., type=float,
+                    help='how often the background thread flushes buffered metrics (default: 5)')
+parser.add_argument('--ckpt-freq', default=0, type=int, metavar='N',
+                    help='also checkpoint every N training iterations, so a preempted job can resume '
+                         'mid-epoch (default: 0, only at the end of each epoch)')
+parser.add_argument('--max-pending-saves', default=1, type=int, metavar='N',
+                    help='number of checkpoints that may be serializing in the background at once (default: 1)')
+parser.add_argument('--auto-batch', default='off', choices=['off', 'max', 'throughput'],
+                    help='search the per-device batch size before running: the largest that fits (max) or the '
+                         'fastest (throughput); when training, --batch-accum is raised to keep the effective '
+                         'batch size of --batch-size x --batch-accum (default: off)')
+parser.add_argument('--auto-batch-mem', default=0.9, type=float, metavar='F',
+                    help='fraction of device memory --auto-batch may use (default: 0.9)')
+parser.add_argument('--auto-batch-limit', default=1024, type=int, metavar='N',
+                    help='largest per-device batch size --auto-batch tries (default: 1024)')
+parser.add_argument('--prefetch-factor', default=2, type=int, metavar='N',
+                    help='batches loaded in advance by each data loading worker (default: 2)')
+parser.add_argument('--persistent-workers', action='store_true',
+                    help='keep the data loading workers alive across epochs instead of restarting them')
+parser.add_argument('--loader-autotune', default='off', choices=['off', 'cached', 'probe'],
+                    help='choose --workers and --prefetch-factor by probing data loading against the measured step '
+                         'time of the model, and turn on --persistent-workers if restarting the workers takes over '
+                         '2%% of an epoch: reuse the settings found earlier for this host, dataset, model and batch '
+                         'size if any (cached), or probe again (probe) (default: off)')
+parser.add_argument('--loader-cache', default=None, type=str, metavar='PATH',
+                    help='file of --loader-autotune settings (default: ~/.cache/antialiased_cnns/loader_tuning.json)')
+parser.add_argument('--val-cache', default=None, type=str, metavar='DIR',
+                    help='keep the validation images decoded (256 center crops, uint8) in a memory-mapped file in '
+                         'DIR, e.g. /dev/shm, so they are decoded once for all epochs, evaluation modes, workers '
+                         'and ranks on the node (about 10 GB for ImageNet)')
+parser.add_argument('--shard-cache', default=None, type=str, metavar='DIR',
+                    help='with --data-format shards, copy the training shards to this node-local directory in the '
+                         'background, in the order they are read, and read them from there once copied')
+parser.add_argument('--shard-cache-gb', default=100., type=float, metavar='GB',
+                    help='size budget of --shard-cache; least recently read shards are evicted (default: 100)')
+parser.add_argument('--shard-locality', action='store_true',
+                    help='with --data-format shards, the ranks of each node read a fixed subset of the training '
+                         'shards, shuffled within it, so a node-local --shard-cache only needs that subset')
 best_acc1 = 0
+preempt_requested = False
 
 
 def main():
@@ -194,8 +316,17 @@ def main():
         # needs to be adjusted accordingly
         args.world_size = ngpus_per_node * args.world_size
         # Use torch.multiprocessing.spawn to launch distributed processes: the
-        # main_worker process function
-        mp.spawn(main_worker, nprocs=ngpus_per_node, args=(ngpus_per_node, args))
+        # main_worker process function. The workers handle SIGTERM themselves by
+        # checkpointing, so the parent forwards it to them and outlives them.
+        context = mp.spawn(main_worker, nprocs=ngpus_per_node, args=(ngpus_per_node, args), join=False)
+
+        def forward_signal(signum, frame):
+            for process in context.processes:
+                if process.is_alive():
+                    os.kill(process.pid, signum)
+        signal.signal(signal.SIGTERM, forward_signal)
+        while not context.join():
+            pass
     else:
         # Simply call main_worker function
         main_worker(args.gpu, ngpus_per_node, args)
@@ -204,6 +335,8 @@ def main():
 def main_worker(gpu, ngpus_per_node, args):
     global best_acc1
     args.gpu = gpu
+    # SIGTERM stops setup and evaluation right away; training installs its checkpointing handler
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
     if args.gpu is not None:
         print("Use GPU: {} for training".format(args.gpu))
@@ -227,11 +360,12 @@ def main_worker(gpu, ngpus_per_node, args):
     else: # baseline model
         model = models.__dict__[args.arch](pretrained=args.pretrained)
 
-    # instrumentation
-    if(args.wandb):
+    # instrumentation: local metrics from every rank, wandb from the first rank only
+    is_main_rank = not args.distributed or args.rank == 0
+    metrics = MetricsLogger.from_args(args, rank=args.rank if args.distributed else 0,
+                                      wandb=args.wandb and is_main_rank)
+    if(args.wandb and is_main_rank):
         import wandb
-        wandb.init(project='antialiased-cnns')
-        wandb.config.update(args)
         wandb.watch(model)
 
     if args.finetune: # finetune from baseline "aliased" model
@@ -241,9 +375,12 @@ def main_worker(gpu, ngpus_per_node, args):
 
     if args.weights is not None:
         print("=> using saved weights [%s]"%args.weights)
-        weights = torch.load(args.weights)
+        weights = load_checkpoint(args.weights)
         model.load_state_dict(weights['state_dict'])
 
+    if args.channels_last:
+        model = model.to(memory_format=torch.channels_last)
+
     if args.distributed:
         # For multiprocessing distributed, DistributedDataParallel constructor
         # should always set the single device scope, otherwise,
@@ -327,28 +464,49 @@ def main_worker(gpu, ngpus_per_node, args):
      # define loss function (criterion) and optimizer
     criterion = nn.CrossEntropyLoss().cuda(args.gpu)
 
+    cudnn.benchmark = True
+
+    # searched before resuming, so the optimizer state it perturbs is still the initial one
+    if args.auto_batch != 'off':
+        auto_batch_size(model, criterion, optimizer, frame, args)
+    # so is the step time --loader-autotune tunes against; the loaders are probed once the datasets exist
+    loader_tuning = None
+    if args.loader_autotune != 'off':
+        loader_tuning = start_loader_tuning(model, criterion, optimizer, frame, ngpus_per_node, args)
+
     # optionally resume from a checkpoint
+    args.start_batch = 0
+    resume_accum_track = 0
+    restore_optimizer = lambda: None
     if args.resume:
         if os.path.isfile(args.resume):
             print("=> loading checkpoint '{}'".format(args.resume))
-            checkpoint = torch.load(args.resume)
+            # tensors stay memory-mapped on the host and are copied straight into this
+            # rank's parameters, so no rank materializes the full checkpoint on a GPU
+            checkpoint = load_checkpoint(args.resume)
             model.load_state_dict(checkpoint['state_dict'], strict=False)
             if('optimizer' in checkpoint.keys()): # if no optimizer, then only load weights
                 args.start_epoch = checkpoint['epoch']
-                best_acc1 = checkpoint['best_acc1']
-                if args.gpu is not None:
-                    # best_acc1 may be from a checkpoint from a different GPU
-                    best_acc1 = best_acc1.to(args.gpu)
-                optimizer.load_state_dict(checkpoint['optimizer'])
+                # best_acc1 may be a tensor from a different GPU
+                best_acc1 = float(checkpoint['best_acc1'])
+                restore_optimizer = load_optimizer_state_lazily(optimizer, checkpoint['optimizer'])
+                # mid-epoch checkpoints: skip the batches already trained on
+                args.start_batch = checkpoint.get('batch_idx', 0)
+                resume_accum_track = checkpoint.get('accum_track', 0)
+                if checkpoint.get('accum_grads') is not None:
+                    for p, g in zip(optimizer_params(optimizer), checkpoint['accum_grads']):
+                        p.grad = None if g is None else g.to(p.device)
+                if checkpoint.get('rng_states') is not None:
+                    rng_states = checkpoint['rng_states']
+                    rank = args.rank if args.distributed else 0
+                    set_rng_states(rng_states[rank] if rank < len(rng_states) else rng_states[0])
             else:
                 print('  No optimizer saved')
             print("=> loaded checkpoint '{}' (epoch {})"
-                  .format(args.resume, checkpoint['epoch']))
+                  .format(args.resume, checkpoint.get('epoch')))
         else:
             print("=> no checkpoint found at '{}'".format(args.resume))
 
-    cudnn.benchmark = True
-
     # Data loading code
     traindir = os.path.join(args.data, 'train')
     valdir = os.path.join(args.data, 'val')
@@ -359,48 +517,138 @@ def main_worker(gpu, ngpus_per_node, args):
     mean=[0.485, 0.456, 0.406]
     std=[0.229, 0.224, 0.225]
     normalize = transforms.Normalize(mean=mean, std=std)
+    if args.gpu_aug and (args.synthetic or args.no_data_aug):
+        print('=> --gpu-aug has no effect with --synthetic data or --no-data-aug')
+        args.gpu_aug = False
+    args.uint8_transfer = args.uint8_transfer or args.gpu_aug
+    if args.uint8_transfer and args.synthetic:
+        print('=> --uint8-transfer has no effect with --synthetic data')
+        args.uint8_transfer = False
+    # with --uint8-transfer, ToTensor and normalize run on the GPU, in DeviceLoader
+    to_tensor = [] if args.uint8_transfer else [transforms.ToTensor(), normalize]
+
+    # synthetic images are already "normalized"; on the GPU they cannot go through workers
+    synthetic_device = 'cpu'
+    if args.synthetic and args.synthetic_device == 'cuda':
+        synthetic_device = torch.device('cuda', args.gpu) if args.gpu is not None else torch.device('cuda')
+    loader_kwargs = {'pin_memory': True}
+    if synthetic_device != 'cpu':
+        args.workers = 0
+        loader_kwargs['pin_memory'] = False
+        args.prefetch = 0
+    if args.prefetch > 0: # PrefetchLoader pins into its own buffers
+        loader_kwargs['pin_memory'] = False
+    if args.uint8_transfer:
+        loader_kwargs['collate_fn'] = uint8_collate
 
     if(args.no_data_aug):
-        train_dataset = datasets.ImageFolder(
-            traindir,
-            transforms.Compose([
+        train_transform = transforms.Compose([
                 transforms.Resize(256),
                 transforms.CenterCrop(224),
                 transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                normalize,
-            ]))
+            ] + to_tensor)
     else:
-        train_dataset = datasets.ImageFolder(
-            traindir,
-            transforms.Compose([
+        train_transform = transforms.Compose([
                 transforms.RandomResizedCrop(224),
                 transforms.RandomHorizontalFlip(),
-                transforms.ToTensor(),
-                normalize,
-            ]))
-
-    if args.distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler(train_dataset)
+            ] + to_tensor)
+
+    # reduced-size decoding only suits pipelines that start with Resize(256)
+    val_decode = DraftLoader(256) if args.jpeg_draft else None
+    train_decode = val_decode if args.no_data_aug else None
+    if args.gpu_aug: # workers only decode; cropping happens on the GPU, in train_augment
+        train_transform = None
+        train_decode = ThumbnailLoader(args.gpu_aug_canvas)
+
+    if args.synthetic:
+        train_dataset = SyntheticDataset(IMAGENET_TRAIN_SIZE, 224, seed=args.seed or 0, device=synthetic_device)
+    elif args.data_format == 'shards':
+        shard_cache = None
+        if args.shard_cache:
+            shard_cache = ShardCache.for_split(args.data, 'train', args.shard_cache, int(args.shard_cache_gb*2**30))
+        train_dataset = open_shards(args.data, 'train', train_transform, loader=train_decode, cache=shard_cache)
+    else:
+        train_dataset = image_folder(traindir, train_transform, args, loader=train_decode)
+
+    # the data order is a function of (seed, epoch) so training can resume mid-epoch
+    replicas = {'num_replicas': dist.get_world_size(), 'rank': dist.get_rank()} if args.distributed else {}
+    if args.data_format == 'shards' and not args.synthetic:
+        group_size = None
+        if args.shard_locality and args.distributed: # ranks per node
+            group_size = ngpus_per_node if args.multiprocessing_distributed else int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+        train_sampler = ShardSampler(train_dataset.shard_sizes, seed=args.seed or 0, group_size=group_size, **replicas)
+        train_sampler.cache = train_dataset.cache
     else:
-        train_sampler = None
+        train_sampler = ResumableSampler(train_dataset, seed=args.seed or 0, **replicas)
 
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.batch_size, shuffle=(train_sampler is None),
-        num_workers=args.workers, pin_memory=True, sampler=train_sampler)
+    train_loader_kwargs = dict(loader_kwargs)
+    if args.gpu_aug:
+        train_loader_kwargs['collate_fn'] = CanvasCollate(args.gpu_aug_canvas)
 
-    crop_size = 256 if(args.evaluate_shift or args.evaluate_diagonal or args.evaluate_save) else 224
-    args.batch_size = 1 if (args.evaluate_diagonal or args.evaluate_save) else args.batch_size
+    train_batch_size = args.batch_size
+    crop_size = 256 if(args.evaluate_shift or args.evaluate_diagonal or args.evaluate_save or args.evaluate_all) else 224
 
-    val_loader = torch.utils.data.DataLoader(
-        datasets.ImageFolder(valdir, transforms.Compose([
+    val_transform = transforms.Compose([
             transforms.Resize(256),
             transforms.CenterCrop(crop_size),
-            transforms.ToTensor(),
-            normalize,
-        ])),
-        batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True)
+        ] + to_tensor)
+    if args.synthetic:
+        val_dataset = SyntheticDataset(IMAGENET_VAL_SIZE, crop_size, seed=(args.seed or 0) + 1, device=synthetic_device)
+    elif args.val_cache:
+        # decoded once to the 256 center crop, shared by every epoch, mode and rank on the node
+        decode_256 = transforms.Compose([transforms.Resize(256), transforms.CenterCrop(256)])
+        if args.data_format == 'shards':
+            val_decoded = open_shards(args.data, 'val', decode_256, loader=val_decode)
+        else:
+            val_decoded = image_folder(valdir, decode_256, args, loader=val_decode)
+        val_dataset = DecodedCache(val_decoded, args.val_cache, size=256, crop=crop_size,
+                                   transform=transforms.Compose(to_tensor) if to_tensor else None)
+    elif args.data_format == 'shards':
+        val_dataset = open_shards(args.data, 'val', val_transform, loader=val_decode)
+        if isinstance(val_dataset, ArrayShardDataset) and val_dataset.image_size == 256:
+            # already resized and cropped to 256 by the converter
+            val_dataset.transform = transforms.Compose(val_transform.transforms[1:])
+    else:
+        val_dataset = image_folder(valdir, val_transform, args, loader=val_decode)
+
+    if args.distributed:
+        # shard evaluation across ranks; metrics are all-reduced at the end
+        val_sampler = DistributedEvalSampler(val_dataset)
+    else:
+        val_sampler = DistributedEvalSampler(val_dataset, num_replicas=1, rank=0)
+
+    if loader_tuning is not None and args.workers > 0:
+        if args.evaluate or args.evaluate_shift:
+            finish_loader_tuning(loader_tuning, val_dataset, val_sampler, loader_kwargs.get('collate_fn'), args)
+        else:
+            finish_loader_tuning(loader_tuning, train_dataset, train_sampler, train_loader_kwargs.get('collate_fn'), args)
+    for kwargs in [loader_kwargs, train_loader_kwargs]:
+        kwargs['num_workers'] = args.workers
+        if args.workers > 0:
+            kwargs.update(prefetch_factor=args.prefetch_factor, persistent_workers=args.persistent_workers)
+
+    train_loader = torch.utils.data.DataLoader(
+        train_dataset, batch_size=train_batch_size, shuffle=False, sampler=train_sampler, **train_loader_kwargs)
+    val_batch_size = args.batch_size
+    if args.evaluate_all: # -b counts crops per forward, as in the other modes; each image gives the grid
+        # and the diagonal crops not on it
+        all_crops = len(shift_offsets(args.evaluate_all_stride)) + len(diagonal_layout(args.evaluate_all_stride)[1])
+        val_batch_size = max(1, args.batch_size // all_crops)
+    val_loader = torch.utils.data.DataLoader(
+        val_dataset, batch_size=val_batch_size, shuffle=False, sampler=val_sampler, **loader_kwargs)
+
+    train_augment = None
+    if args.gpu_aug:
+        train_augment = BatchAugment(mean, std, seed=args.seed or 0, rank=args.rank if args.distributed else 0,
+                                     channels_last=args.channels_last)
+    if args.uint8_transfer or args.channels_last or args.prefetch > 0:
+        device = torch.device('cuda', args.gpu) if args.gpu is not None else torch.device('cuda')
+        train_loader = DeviceLoader(train_loader, device, mean, std, channels_last=args.channels_last,
+                                    augment=train_augment)
+        val_loader = DeviceLoader(val_loader, device, mean, std, channels_last=args.channels_last)
+        if args.prefetch > 0:
+            train_loader = PrefetchLoader(train_loader, num_buffers=args.prefetch)
+            val_loader = PrefetchLoader(val_loader, num_buffers=args.prefetch)
 
     if(args.val_debug): # debug mode - train on val set for faster epochs
         train_loader = val_loader
@@ -422,16 +670,29 @@ def main_worker(gpu, ngpus_per_node, args):
                 torch.save({'state_dict': model.module.state_dict()}, args.save_weights, _use_new_zipfile_serialization=False)
         return
 
+    # evaluation records are logged at the training step of the evaluated checkpoint
+    eval_step = args.start_epoch*len(train_loader) + args.start_batch
     if args.evaluate:
-        validate(val_loader, model, criterion, args)
+        validate(val_loader, model, criterion, args, metrics=metrics, step=eval_step, epoch=args.start_epoch)
+        metrics.close()
+        return
+
+    if args.evaluate_all:
+        validate_all(val_loader, model, criterion, args, metrics=metrics, step=eval_step)
+        metrics.close()
         return
 
     if(args.evaluate_shift):
-        validate_shift(val_loader, model, args)
+        if args.shift_table:
+            validate_shift_table(val_loader, model, args, metrics=metrics, step=eval_step)
+        else:
+            validate_shift(val_loader, model, args, metrics=metrics, step=eval_step)
+        metrics.close()
         return
 
     if(args.evaluate_diagonal):
-        validate_diagonal(val_loader, model, args)
+        validate_diagonal(val_loader, model, args, metrics=metrics, step=eval_step)
+        metrics.close()
         return
 
     if(args.evaluate_save):
@@ -443,9 +704,48 @@ def main_worker(gpu, ngpus_per_node, args):
         for epoch in range(args.start_epoch):
             scheduler.step()
 
+    if not args.multiprocessing_distributed or (args.multiprocessing_distributed
+            and args.rank % ngpus_per_node == 0):
+        checkpoint_writer = CheckpointWriter(args.out_dir, max_pending=args.max_pending_saves)
+    else:
+        checkpoint_writer = None
+
+    def save_state(epoch, is_best=False, batch_idx=0, accum_track=0):
+        rng_states = gather_rng_states(args) # collective, so every rank takes part
+        if checkpoint_writer is None:
+            return
+        restore_optimizer() # a checkpoint before the first step after resuming keeps the momentum
+        state = {
+            'epoch': epoch,
+            'arch': args.arch,
+            'state_dict': model.state_dict(),
+            'best_acc1': best_acc1,
+            'optimizer' : optimizer.state_dict(),
+            'rng_states': rng_states,
+        }
+        if batch_idx > 0:
+            # partially accumulated gradients are identical on all ranks after DDP's all-reduce
+            state.update({'batch_idx': batch_idx, 'accum_track': accum_track,
+                          'accum_grads': [p.grad for p in optimizer_params(optimizer)] if accum_track > 0 else None})
+            checkpoint_writer.save(state, False, None)
+        else:
+            checkpoint_writer.save(state, is_best, epoch-1)
+
+    def checkpoint_mid_epoch(epoch, batch_idx, accum_track):
+        save_state(epoch, batch_idx=batch_idx, accum_track=accum_track)
+
+    # on SIGTERM (e.g. cluster preemption), checkpoint at the next iteration and exit
+    signal.signal(signal.SIGTERM, request_preemption_checkpoint)
+
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
-            train_sampler.set_epoch(epoch)
+        train_sampler.set_epoch(epoch)
+        start_batch, accum_track = 0, 0
+        if epoch == args.start_epoch and args.start_batch > 0:
+            start_batch, accum_track = args.start_batch, resume_accum_track
+            train_sampler.skip(start_batch*args.batch_size)
+            print("=> resuming epoch {} at batch {}".format(epoch, start_batch))
+        if train_augment is not None:
+            train_augment.set_epoch(epoch, start_batch)
 
         if(not args.cos_lr):
             adjust_learning_rate(optimizer, epoch, args)
@@ -453,32 +753,122 @@ def main_worker(gpu, ngpus_per_node, args):
             scheduler.step()
             print('[%03d] %.5f'%(epoch, scheduler.get_lr()[0]))
 
-        if(args.wandb):
-            wandb.log({'learning_rate': optimizer.param_groups[0]['lr']},
-                      commit=False)
+        metrics.log('epoch', {'epoch': epoch, 'learning_rate': optimizer.param_groups[0]['lr']},
+                    step=(epoch * (start_batch + len(train_loader))))
 
         # train for one epoch
-        train(train_loader, model, criterion, optimizer, epoch, args, frame)
+        if train(train_loader, model, criterion, optimizer, epoch, args, frame,
+                 checkpoint_fn=checkpoint_mid_epoch, start_batch=start_batch, accum_track=accum_track,
+                 metrics=metrics):
+            print("=> preempted: saved checkpoint at epoch {}".format(epoch))
+            break
 
         # evaluate on validation set
-        acc1 = validate(val_loader, model, criterion, args)
+        acc1 = validate(val_loader, model, criterion, args, metrics=metrics,
+                        step=(epoch + 1)*(start_batch + len(train_loader)), epoch=epoch)
 
         # remember best acc@1 and save checkpoint
         is_best = acc1 > best_acc1
         best_acc1 = max(acc1, best_acc1)
 
-        if not args.multiprocessing_distributed or (args.multiprocessing_distributed
-                and args.rank % ngpus_per_node == 0):
-            save_checkpoint({
-                'epoch': epoch + 1,
-                'arch': args.arch,
-                'state_dict': model.state_dict(),
-                'best_acc1': best_acc1,
-                'optimizer' : optimizer.state_dict(),
-            }, is_best, epoch, out_dir=args.out_dir)
+        save_state(epoch + 1, is_best)
+
+        if preemption_requested(args):
+            break
+
+    if checkpoint_writer is not None:
+        checkpoint_writer.close()
+    metrics.close()
+
 
+def image_folder(root, transform, args, loader=None):
+    kwargs = {} if loader is None else {'loader': loader}
+    if args.index_cache == 'none':
+        return datasets.ImageFolder(root, transform, **kwargs)
+    return IndexedImageFolder(root, transform, cache_dir=args.index_cache, **kwargs)
 
-def train(train_loader, model, criterion, optimizer, epoch, args, frame=None):
+
+def auto_batch_size(model, criterion, optimizer, frame, args):
+    """Sets args.batch_size (and, when training, args.batch_accum) from a search with
+    find_batch_size for the selected mode"""
+    if args.evaluate_save:
+        print('=> auto-batch: the save mode does not run the model')
+        return
+    # each of the 33 forwards of a diagonal batch is an ordinary evaluation batch
+    mode = 'shift' if args.evaluate_shift else 'eval' if (args.evaluate or args.evaluate_diagonal or args.evaluate_all) else 'train'
+    if mode == 'train' and frame is not None:
+        print('=> auto-batch: not supported with --learned-frame, keeping batch size {}'.format(args.batch_size))
+        return
+    # search on the local replica: DistributedDataParallel would all-reduce inside the search
+    module = model.module if isinstance(model, nn.parallel.DistributedDataParallel) else model
+    device = torch.device('cuda', args.gpu) if args.gpu is not None else next(module.parameters()).device
+    max_batch, best_batch, _ = find_batch_size(module, mode, device=device, criterion=criterion, optimizer=optimizer,
+                                               memory_fraction=args.auto_batch_mem, max_batch=args.auto_batch_limit)
+    chosen = max_batch if args.auto_batch == 'max' else best_batch
+
+    if mode == 'train':
+        total = args.batch_size * args.batch_accum
+        args.batch_size, args.batch_accum = split_batch(total, chosen)
+        if args.batch_size * args.batch_accum != total:
+            warnings.warn('auto-batch: effective batch size is %d instead of %d'
+                          % (args.batch_size * args.batch_accum, total))
+    else: # with --evaluate-all, -b is also in crops
+        args.batch_size = chosen
+    print('=> auto-batch [{}]: largest fitting {}, fastest {}; using batch size {} x {} accumulation steps'
+          .format(mode, max_batch, best_batch, args.batch_size, args.batch_accum if mode == 'train' else 1))
+
+
+def start_loader_tuning(model, criterion, optimizer, frame, ngpus_per_node, args):
+    """Looks up the --loader-autotune settings for this run and, if they have to be probed,
+    measures the time per batch of the selected mode. Returns the state finish_loader_tuning
+    needs, or None if loader tuning does not apply."""
+    if args.evaluate_diagonal or args.evaluate_save or args.evaluate_all or args.learned_frame:
+        print('=> loader autotune: not supported with --evaluate-diagonal, --evaluate-save, --evaluate-all or --learned-frame')
+        return None
+    mode = 'shift' if args.evaluate_shift else 'eval' if args.evaluate else 'train'
+    # processes sharing this host's CPUs
+    local_procs = ngpus_per_node if args.multiprocessing_distributed else int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    key = '|'.join(str(v) for v in [socket.gethostname(), os.path.realpath(args.data), args.data_format, args.arch,
+                                    mode, args.batch_size, local_procs, 'synthetic' if args.synthetic else '',
+                                    'uint8' if args.uint8_transfer else '', 'gpu-aug' if args.gpu_aug else '',
+                                    'draft' if args.jpeg_draft else '', 'no-aug' if args.no_data_aug else ''])
+    path = args.loader_cache or os.path.join(os.path.expanduser('~'), '.cache', 'antialiased_cnns', 'loader_tuning.json')
+    tuning = {'key': key, 'path': path, 'local_procs': local_procs, 'step_secs': None,
+              'settings': load_loader_settings(path, key) if args.loader_autotune == 'cached' else None}
+    if tuning['settings'] is None:
+        module = model.module if isinstance(model, nn.parallel.DistributedDataParallel) else model
+        device = torch.device('cuda', args.gpu) if args.gpu is not None else next(module.parameters()).device
+        rate = step_rate(module, args.batch_size, mode, device=device, criterion=criterion, optimizer=optimizer)
+        tuning['step_secs'] = args.batch_size/rate
+    return tuning
+
+
+def finish_loader_tuning(tuning, dataset, sampler, collate_fn, args):
+    """Sets args.workers and args.prefetch_factor, and turns on args.persistent_workers if the
+    tuner chose it, from the cached settings, or probes loaders over dataset and caches the
+    result (one process per host writes it; the others probe at the same time, so the CPUs
+    are as contended as in training)"""
+    settings = tuning['settings']
+    if settings is None:
+        max_workers = max(1, (os.cpu_count() or 1) // tuning['local_procs'])
+        epoch_batches = -(-len(sampler if sampler is not None else dataset) // args.batch_size)
+        settings = autotune_loader(dataset, args.batch_size, tuning['step_secs'], sampler=sampler, collate_fn=collate_fn,
+                                   max_workers=max_workers, epoch_batches=min(epoch_batches, args.max_train_iters))
+        if not args.distributed or args.rank % tuning['local_procs'] == 0:
+            save_loader_settings(tuning['path'], tuning['key'], settings)
+    args.workers = settings['num_workers']
+    args.prefetch_factor = settings['prefetch_factor']
+    # settings cached before persistence was tuned lack the key; an explicit flag always wins
+    args.persistent_workers = args.persistent_workers or settings.get('persistent_workers', False)
+    print('=> loader autotune: {} workers, prefetch factor {}, persistent workers {} (stall {:.1f}% of a step, '
+          '{:.1f} s to start the workers)'.format(args.workers, args.prefetch_factor, args.persistent_workers,
+                                                  100*settings['stall'], settings['startup_secs']))
+
+
+def train(train_loader, model, criterion, optimizer, epoch, args, frame=None,
+          checkpoint_fn=None, start_batch=0, accum_track=0, metrics=None):
+    """Trains for one epoch, starting at batch start_batch (the sampler is expected to have
+    skipped the batches before it). Returns True if it stopped early for preemption."""
     batch_time = AverageMeter()
     data_time = AverageMeter()
     losses = AverageMeter()
@@ -486,43 +876,57 @@ def train(train_loader, model, criterion, optimizer, epoch, args, frame=None):
     top5 = AverageMeter()
 
     output_device = next(model.parameters()).device
+    # time spent per phase of the step, summed since the last print
+    timer = StepTimer(output_device)
+    throughput = Throughput(reduce_device(args) if args.distributed else None)
+    steps_timed = 0
+    prof = start_profiler(model, args, 'train_ep%03d'%epoch, epoch)
     # switch to train mode
     model.train()
 
     end = time.time()
-    accum_track = 0
-    optimizer.zero_grad()
-    for i, (input, target) in enumerate(train_loader):
+    num_batches = start_batch + len(train_loader)
+    if accum_track == 0: # otherwise gradients accumulated before a mid-epoch checkpoint were restored
+        optimizer.zero_grad()
+    for i, (input, target) in enumerate(train_loader, start_batch):
         # measure data loading time
         data_time.update(time.time() - end)
+        timer.add('data', data_time.val)
 
-        if args.gpu is not None:
-            input = input.cuda(args.gpu, non_blocking=True)
-        target = target.cuda(args.gpu, non_blocking=True)
+        with timer.phase('h2d'):
+            if args.gpu is not None:
+                input = input.cuda(args.gpu, non_blocking=True)
+            target = target.cuda(args.gpu, non_blocking=True)
+            if frame is not None:
+                input = input.to(output_device)
 
         # TODO(eugenevinitsky) I think 
         # compute output
         if frame is None:
-            output = model(input)
+            with timer.phase('forward'):
+                output = model(input)
         else:
-            input = input.to(output_device)
-            frame_x = frame(input)
-            cat = torch.distributions.categorical.Categorical(logits=frame_x.view(input.shape[0], -1))
-            # now draw a few samples from the frame map and 
-            frame_phis = torch.zeros(args.num_samples, input.shape[0], 1000, dtype=input.dtype).cuda(args.gpu, non_blocking=True)
-            shift_imgs = torch.zeros_like(input, dtype=input.dtype).cuda(args.gpu, non_blocking=True)
+            with timer.phase('frame_sampling'):
+                frame_x = frame(input)
+                cat = torch.distributions.categorical.Categorical(logits=frame_x.view(input.shape[0], -1))
+                # now draw a few samples from the frame map and 
+                frame_phis = torch.zeros(args.num_samples, input.shape[0], 1000, dtype=input.dtype).cuda(args.gpu, non_blocking=True)
+                shift_imgs = torch.zeros_like(input, dtype=input.dtype).cuda(args.gpu, non_blocking=True)
             # TODO(eugenevinitsky) remove the double four loop
             for j in range(args.num_samples):
-                sample = cat.sample()
-                for k in range(input.shape[0]):
-                    p = sample[k] % 224
-                    q = sample[k] // 224
-                    shift_imgs[k] = inv_shift(input[k], (p,q))
-                frame_phis[j] = model(shift_imgs).detach() * torch.exp(cat.log_prob(sample) - cat.log_prob(sample).detach()).unsqueeze(1)
+                with timer.phase('frame_sampling'):
+                    sample = cat.sample()
+                    for k in range(input.shape[0]):
+                        p = sample[k] % 224
+                        q = sample[k] // 224
+                        shift_imgs[k] = inv_shift(input[k], (p,q))
+                with timer.phase('forward'):
+                    frame_phis[j] = model(shift_imgs).detach() * torch.exp(cat.log_prob(sample) - cat.log_prob(sample).detach()).unsqueeze(1)
             output = frame_phis.mean(dim=0)
-        loss = criterion(output, target)
-        if frame is not None and args.entropy_scale > 0.0:
-            loss = loss -args.entropy_scale * torch.sum(frame_x.exp()*frame_x+1e-6)
+        with timer.phase('forward'):
+            loss = criterion(output, target)
+            if frame is not None and args.entropy_scale > 0.0:
+                loss = loss -args.entropy_scale * torch.sum(frame_x.exp()*frame_x+1e-6)
 
         # measure accuracy and record loss
         acc1, acc5 = accuracy(output, target, topk=(1, 5))
@@ -531,17 +935,21 @@ def train(train_loader, model, criterion, optimizer, epoch, args, frame=None):
         top5.update(acc5[0], input.size(0))
 
         # compute gradient and do SGD step
-        loss.backward()
+        with timer.phase('backward'):
+            loss.backward()
 
         accum_track+=1
         if(accum_track==args.batch_accum):
-            optimizer.step()
-            accum_track = 0
-            optimizer.zero_grad()
+            with timer.phase('optimizer'):
+                optimizer.step()
+                accum_track = 0
+                optimizer.zero_grad()
 
         # measure elapsed time
         batch_time.update(time.time() - end)
         end = time.time()
+        throughput.update(input.size(0))
+        steps_timed += 1
 
         if i % args.print_freq == 0:
             print('Epoch: [{0}][{1}/{2}]\t'
@@ -550,33 +958,58 @@ def train(train_loader, model, criterion, optimizer, epoch, args, frame=None):
                   'Loss {loss.val:.4f} ({loss.avg:.4f})\t'
                   'Acc@1 {top1.val:.3f} ({top1.avg:.3f})\t'
                   'Acc@5 {top5.val:.3f} ({top5.avg:.3f})'.format(
-                   epoch, i, len(train_loader), batch_time=batch_time,
+                   epoch, i, num_batches, batch_time=batch_time,
                    data_time=data_time, loss=losses, top1=top1, top5=top5))
 
-            if(args.wandb):
-                import wandb
-                global_step = i + (epoch * len(train_loader))
-                wandb.log(
-                    {
-                        'train_loss': losses.val,
-                        'train_avg_loss': losses.avg,
-                        'train_acc@1': top1.val,
-                        'train_avg_acc@1': top1.avg,
-                        'train_acc@5': top5.val,
-                        'train_avg_acc@5': top5.avg,
-                        'epoch': 1.*global_step/len(train_loader), 
-                    },
-                    step=global_step)
+            if metrics is not None:
+                global_step = i + (epoch * num_batches)
+                record = {
+                    'train_loss': losses.val,
+                    'train_avg_loss': losses.avg,
+                    'train_acc@1': top1.val,
+                    'train_avg_acc@1': top1.avg,
+                    'train_acc@5': top5.val,
+                    'train_avg_acc@5': top5.avg,
+                    'epoch': 1.*global_step/num_batches,
+                    'batch_time': batch_time.val,
+                }
+                # per-step seconds in each phase, averaged since the last print
+                for phase, seconds in timer.summary().items():
+                    record['time_%s'%phase] = seconds/steps_timed
+                record['images_per_sec_rank'], record['images_per_sec'] = throughput.rate()
+                metrics.log('train', record, step=global_step)
+            timer.reset()
+            steps_timed = 0
+
+        if checkpoint_fn is not None:
+            due = args.ckpt_freq > 0 and (i+1) % args.ckpt_freq == 0 and i+1 < num_batches
+            # agreeing on preemption is a collective and a host sync, so ranks poll every print_freq steps
+            poll = not args.distributed or due or (i+1) % args.print_freq == 0
+            preempted = poll and preemption_requested(args)
+            if preempted or due:
+                checkpoint_fn(epoch, i+1, accum_track)
+            if preempted:
+                stop_profiler(prof)
+                return True
+
+        if prof is not None:
+            prof.step()
 
         if(i > args.max_train_iters):
             break
 
-def validate(val_loader, model, criterion, args):
+    stop_profiler(prof)
+    return False
+
+def validate(val_loader, model, criterion, args, metrics=None, step=None, epoch=None):
     batch_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
     top5 = AverageMeter()
 
+    throughput = Throughput(reduce_device(args) if args.distributed else None)
+    prof = start_profiler(model, args, 'val_ep%03d'%epoch, epoch)
+
     # switch to evaluate mode
     model.eval()
 
@@ -586,6 +1019,7 @@ def validate(val_loader, model, criterion, args):
             if args.gpu is not None:
                 input = input.cuda(args.gpu, non_blocking=True)
             target = target.cuda(args.gpu, non_blocking=True)
+            throughput.update(input.size(0))
 
             # compute output
             output = model(input)
@@ -610,15 +1044,26 @@ def validate(val_loader, model, criterion, args):
                        i, len(val_loader), batch_time=batch_time, loss=losses,
                        top1=top1, top5=top5))
 
-        if args.wandb:
-            import wandb
-            wandb.log(
-                {
-                    'val_avg_loss': losses.avg,
-                    'val_avg_acc@1': top1.avg,
-                    'val_avg_acc@5': top5.avg
-                },
-                commit=False)
+            if prof is not None:
+                prof.step()
+
+        stop_profiler(prof)
+
+        if args.distributed:
+            device = reduce_device(args)
+            losses.all_reduce(device)
+            top1.all_reduce(device)
+            top5.all_reduce(device)
+
+        images_per_sec_rank, images_per_sec = throughput.rate()
+        if metrics is not None:
+            metrics.log('val', {
+                'val_avg_loss': losses.avg,
+                'val_avg_acc@1': top1.avg,
+                'val_avg_acc@5': top5.avg,
+                'images_per_sec_rank': images_per_sec_rank,
+                'images_per_sec': images_per_sec,
+            }, step=step)
 
         print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'
               .format(top1=top1, top5=top5))
@@ -626,7 +1071,7 @@ def validate(val_loader, model, criterion, args):
     return top1.avg
 
 
-def validate_shift(val_loader, model, args):
+def validate_shift(val_loader, model, args, metrics=None, step=None):
     batch_time = AverageMeter()
     consist = AverageMeter()
 
@@ -663,56 +1108,164 @@ def validate_shift(val_loader, model, args):
                           'Consist {consist.val:.4f} ({consist.avg:.4f})\t'.format(
                            ep, args.epochs_shift, i, len(val_loader), batch_time=batch_time, consist=consist))
 
+        if args.distributed:
+            consist.all_reduce(reduce_device(args))
+        if metrics is not None:
+            metrics.log('shift', {'consistency': consist.avg, 'batch_time': batch_time.avg}, step=step)
+
         print(' * Consistency {consist.avg:.3f}'
               .format(consist=consist))
 
     return consist.avg
 
-def validate_diagonal(val_loader, model, args):
+def validate_shift_table(val_loader, model, args, metrics=None, step=None):
+    """Exact counterpart of validate_shift: each image is classified once at every offset of
+    shift_offsets(args.shift_stride). Consistency is the agreement over all distinct pairs of
+    offsets, (sum_k n_k^2 - O)/(O(O-1)) for an image where n_k of the O offsets predict class k;
+    this is computed from the per-image class counts. Top-1 is averaged over the offsets. The int16 images x offsets prediction table is saved to shift_preds.npy, with
+    shift_offsets.npy and shift_targets.npy, in dataset order."""
     batch_time = AverageMeter()
-    prob = AverageMeter()
+    consist = AverageMeter()
     top1 = AverageMeter()
-    top5 = AverageMeter()
+
+    # switch to evaluate mode
+    model.eval()
+
+    offsets = shift_offsets(args.shift_stride)
+    O = len(offsets)
+    N = len(val_loader.sampler) # number of images evaluated by this rank
+    shift_preds = np.zeros((N, O), dtype=np.int16)
+    shift_targets = np.zeros(N, dtype=np.int64)
+
+    with torch.no_grad():
+        end = time.time()
+        row = 0
+        for i, (input, target) in enumerate(val_loader):
+            if args.gpu is not None:
+                input = input.cuda(args.gpu, non_blocking=True)
+            target = target.cuda(args.gpu, non_blocking=True)
+
+            preds = torch.stack([model(input[:,:,dy:dy+224,dx:dx+224]).argmax(dim=1) for (dy, dx) in offsets], dim=1)
+            counts = torch.zeros(preds.size(0), int(preds.max()) + 1, device=preds.device)
+            counts.scatter_add_(1, preds, torch.ones_like(preds, dtype=counts.dtype))
+            cur_consist = pair_consistency(counts).mean()
+            cur_acc1 = 100.*preds.eq(target[:,None]).float().mean()
+
+            B = input.size(0)
+            shift_preds[row:row+B] = preds.cpu().numpy()
+            shift_targets[row:row+B] = target.cpu().numpy()
+            row += B
+            consist.update(cur_consist.item(), B)
+            top1.update(cur_acc1.item(), B)
+
+            # measure elapsed time
+            batch_time.update(time.time() - end)
+            end = time.time()
+
+            if i % args.print_freq == 0:
+                print('Test: [{0}/{1}]\t'
+                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                      'Consist {consist.val:.4f} ({consist.avg:.4f})\t'
+                      'Acc@1 {top1.val:.3f} ({top1.avg:.3f})'.format(
+                       i, len(val_loader), batch_time=batch_time, consist=consist, top1=top1))
+
+    if args.distributed:
+        device = reduce_device(args)
+        consist.all_reduce(device)
+        top1.all_reduce(device)
+        num_images = len(val_loader.dataset)
+        shift_preds = gather_sharded(shift_preds, num_images, device).astype(np.int16)
+        shift_targets = gather_sharded(shift_targets, num_images, device).astype(np.int64)
+        if dist.get_rank() != 0:
+            return consist.avg
+
+    if metrics is not None:
+        metrics.log('shift', {'consistency': consist.avg, 'acc@1': top1.avg, 'num_offsets': O,
+                              'batch_time': batch_time.avg}, step=step)
+
+    print(' * Consistency {consist.avg:.3f} Acc@1 {top1.avg:.3f} ({0} offsets)'
+          .format(O, consist=consist, top1=top1))
+
+    np.save(os.path.join(args.out_dir,'shift_preds'),shift_preds)
+    np.save(os.path.join(args.out_dir,'shift_offsets'),np.array(offsets, dtype=np.int16))
+    np.save(os.path.join(args.out_dir,'shift_targets'),shift_targets)
+    return consist.avg
+
+# validate_diagonal outputs: name -> dtype of the images x 33 arrays in --out-dir
+DIAG_OUTPUTS = [('diag_probs', np.float16), # probability (%) of the ground truth
+                ('diag_probs2', np.float16), # highest probability (%) of any other class
+                ('diag_corrs', np.uint8), # top-1 correct
+                ('diag_corrs5', np.uint8), # top-5 correct
+                ('diag_preds', np.int16)] # predicted class
+
+
+def open_diag_outputs(out_dir, suffix, num_rows, D):
+    """Memory-maps the validate_diagonal arrays (diag_*<suffix>.npy) and returns them with
+    the number of rows already completed, read from diag_progress<suffix>.json. Arrays of
+    another shape are started over."""
+    progress = os.path.join(out_dir, 'diag_progress%s.json' % suffix)
+    done = 0
+    if os.path.exists(progress):
+        with open(progress) as f:
+            state = json.load(f)
+        if state['shape'] == [num_rows, D]:
+            done = state['done']
+    arrays = {}
+    for name, dtype in DIAG_OUTPUTS:
+        path = os.path.join(out_dir, name + suffix + '.npy')
+        if done > 0 and os.path.exists(path):
+            arrays[name] = np.load(path, mmap_mode='r+')
+        else:
+            done = 0
+            arrays[name] = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(num_rows, D))
+    if done > 0:
+        print('=> resuming diagonal evaluation at image {}/{}'.format(done, num_rows))
+    return arrays, progress, done
+
+
+def validate_diagonal(val_loader, model, args, metrics=None, step=None):
+    """Classifies the 33 224-crops along the diagonal of each 256 image, offset (k, k) for
+    k = 0..32, a batch of images at a time. Per-crop results stream into memory-mapped arrays
+    in --out-dir (see DIAG_OUTPUTS), one row per image in dataset order. Progress is recorded
+    after each batch, so an interrupted run continues where it stopped. With several ranks,
+    each writes its own diag_*_rank<r>.npy, which rank 0 merges at the end."""
+    batch_time = AverageMeter()
 
     # switch to evaluate mode
     model.eval()
 
     D = 33
-    diag_probs = np.zeros((len(val_loader.dataset),D))
-    diag_probs2 = np.zeros((len(val_loader.dataset),D)) # save highest probability, not including ground truth
-    diag_corrs = np.zeros((len(val_loader.dataset),D))
-    diag_preds = np.zeros((len(val_loader.dataset),D))
+    N = len(val_loader.sampler) # number of images evaluated by this rank
+    W, rank = (dist.get_world_size(), dist.get_rank()) if args.distributed else (1, 0)
+    suffix = '_rank%d' % rank if W > 1 else ''
+    arrays, progress, done = open_diag_outputs(args.out_dir, suffix, N, D)
+    val_loader.sampler.skip(done)
 
     with torch.no_grad():
         end = time.time()
+        row = done
         for i, (input, target) in enumerate(val_loader):
             if args.gpu is not None:
                 input = input.cuda(args.gpu, non_blocking=True)
             target = target.cuda(args.gpu, non_blocking=True)
 
-            inputs = []
-            for off in range(D):
-                inputs.append(input[:,:,off:off+224,off:off+224])
-            inputs = torch.cat(inputs, dim=0)
-            probs = torch.nn.Softmax(dim=1)(model(inputs))
-            preds = probs.argmax(dim=1).cpu().data.numpy()
-            corrs = preds == target.item()
-            outputs = 100.*probs[:,target.item()]
-            
-            acc1, acc5 = accuracy(probs, target.repeat(D), topk=(1, 5))
-
-            probs[:,target.item()] = 0
-            probs2 = 100.*probs.max(dim=1)[0].cpu().data.numpy()
-
-            diag_probs[i,:] = outputs.cpu().data.numpy()
-            diag_probs2[i,:] = probs2
-            diag_corrs[i,:] = corrs
-            diag_preds[i,:] = preds
-
-            # measure agreement and record
-            prob.update(np.mean(diag_probs[i,:]), input.size(0))
-            top1.update(acc1.item(), input.size(0))
-            top5.update(acc5.item(), input.size(0))
+            results = {name: [] for name, _ in DIAG_OUTPUTS}
+            for off in range(D): # crops are views into the batch; B images per forward
+                probs = torch.softmax(model(input[:,:,off:off+224,off:off+224]), dim=1)
+                results['diag_probs'].append(100.*probs.gather(1, target[:,None])[:,0])
+                results['diag_probs2'].append(100.*probs.scatter(1, target[:,None], 0).max(dim=1)[0])
+                results['diag_preds'].append(probs.argmax(dim=1))
+                results['diag_corrs'].append(results['diag_preds'][-1].eq(target))
+                results['diag_corrs5'].append(probs.topk(5, dim=1)[1].eq(target[:,None]).any(dim=1))
+
+            B = input.size(0)
+            for name, dtype in DIAG_OUTPUTS:
+                arrays[name][row:row+B] = torch.stack(results[name], dim=1).cpu().numpy().astype(dtype)
+                arrays[name].flush()
+            row += B
+            with open(progress + '.tmp', 'w') as f:
+                json.dump({'done': row, 'shape': [N, D]}, f)
+            os.replace(progress + '.tmp', progress)
 
             # measure elapsed time
             batch_time.update(time.time() - end)
@@ -721,33 +1274,373 @@ def validate_diagonal(val_loader, model, args):
             if i % args.print_freq == 0:
                 print('Test: [{0}/{1}]\t'
                       'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                      'Prob {prob.val:.4f} ({prob.avg:.4f})\t'
-                      'Acc@1 {top1.val:.3f} ({top1.avg:.3f})\t'
-                      'Acc@5 {top5.val:.3f} ({top5.avg:.3f})'.format(
-                       i, len(val_loader), batch_time=batch_time, prob=prob, top1=top1, top5=top5))
+                      'Prob {prob:.4f}\t'
+                      'Acc@1 {top1:.3f}'.format(
+                       i, len(val_loader), batch_time=batch_time,
+                       prob=float(arrays['diag_probs'][row-B:row].astype(np.float64).mean()),
+                       top1=100.*arrays['diag_corrs'][row-B:row].mean()))
+    val_loader.sampler.skip(0)
+
+    # totals over every completed row, including those of an earlier, interrupted run
+    totals = torch.tensor([arrays['diag_probs'].astype(np.float64).sum(), arrays['diag_corrs'].sum(),
+                           arrays['diag_corrs5'].sum(), N*D], dtype=torch.float64)
+    if args.distributed:
+        totals = totals.to(reduce_device(args))
+        dist.all_reduce(totals)
+        dist.barrier() # every rank's arrays are complete
+        totals = totals.cpu()
+    prob, top1, top5 = (totals[:3]/totals[3]*torch.tensor([1., 100., 100.], dtype=torch.float64)).tolist()
+    if rank != 0:
+        return
 
-    print(' * Prob {prob.avg:.3f} Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'
-          .format(prob=prob,top1=top1, top5=top5))
+    if W > 1: # rank r evaluated dataset rows r, r+W, ...
+        num_images = len(val_loader.dataset)
+        for name, dtype in DIAG_OUTPUTS:
+            merged = np.lib.format.open_memmap(os.path.join(args.out_dir, name + '.npy'), mode='w+', dtype=dtype,
+                                               shape=(num_images, D))
+            for r in range(W):
+                path = os.path.join(args.out_dir, '%s_rank%d.npy' % (name, r))
+                merged[r::W] = np.load(path, mmap_mode='r')
+            merged.flush()
+            del merged
+        for r in range(W):
+            for name, _ in DIAG_OUTPUTS:
+                os.remove(os.path.join(args.out_dir, '%s_rank%d.npy' % (name, r)))
+            os.remove(os.path.join(args.out_dir, 'diag_progress_rank%d.json' % r))
+
+    if metrics is not None:
+        metrics.log('diagonal', {'prob': prob, 'acc@1': top1, 'acc@5': top5, 'batch_time': batch_time.avg}, step=step)
+
+    print(' * Prob {prob:.3f} Acc@1 {top1:.3f} Acc@5 {top5:.3f}'
+          .format(prob=prob, top1=top1, top5=top5))
+
+def diagonal_layout(stride):
+    """Where validate_all finds the 33 diagonal crops among its outputs, which hold the grid
+    shift_offsets(stride) followed by the diagonal offsets (k, k) not on the grid. Returns the
+    output index of each diagonal crop and the list of those off-grid k."""
+    offsets = shift_offsets(stride)
+    extra = [k for k in range(33) if (k, k) not in offsets]
+    index = [offsets.index((k, k)) if (k, k) in offsets else len(offsets) + extra.index(k) for k in range(33)]
+    return index, extra
+
+
+def validate_all(val_loader, model, criterion, args, metrics=None, step=None):
+    """One pass that reports what validate, validate_shift_table (on a --evaluate-all-stride
+    grid) and validate_diagonal do: the crops of shifted_crops are classified in a single
+    forward per batch, those on both the grid and the diagonal once. Top-1/top-5 and the loss
+    are those of the center crop, consistency is the exact agreement over all distinct pairs
+    of grid offsets, and the diagonal statistics average over the 33 diagonal crops."""
+    batch_time = AverageMeter()
+    losses = AverageMeter()
+    top1 = AverageMeter()
+    top5 = AverageMeter()
+    consist = AverageMeter()
+    diag_prob = AverageMeter()
+    diag_top1 = AverageMeter()
+    diag_top5 = AverageMeter()
 
-    np.save(os.path.join(args.out_dir,'diag_probs'),diag_probs)
-    np.save(os.path.join(args.out_dir,'diag_probs2'),diag_probs2)
-    np.save(os.path.join(args.out_dir,'diag_corrs'),diag_corrs)
-    np.save(os.path.join(args.out_dir,'diag_preds'),diag_preds)
+    throughput = Throughput(reduce_device(args) if args.distributed else None)
+
+    # switch to evaluate mode
+    model.eval()
+
+    G = len(shift_offsets(args.evaluate_all_stride))
+    D = 33
+    diag_index, extra = diagonal_layout(args.evaluate_all_stride)
+    K = G + len(extra)
+    center = diag_index[16]
+
+    with torch.no_grad():
+        end = time.time()
+        for i, (input, target) in enumerate(val_loader):
+            if args.gpu is not None:
+                input = input.cuda(args.gpu, non_blocking=True)
+            target = target.cuda(args.gpu, non_blocking=True)
+            B = input.size(0)
+            throughput.update(B)
+
+            # the crops are copied once, straight from the views into the model's batch
+            grid, diag = shifted_crops(input, args.evaluate_all_stride)
+            crops = torch.empty((B*K,) + diag.shape[2:], dtype=input.dtype, device=input.device,
+                                memory_format=torch.channels_last if args.channels_last else torch.contiguous_format)
+            per_image = crops.view((B, K) + diag.shape[2:])
+            per_image[:, :G].view(grid.shape).copy_(grid)
+            for j, k in enumerate(extra):
+                per_image[:, G + j].copy_(diag[:, k])
+            output = model(crops).reshape(B, K, -1)
+
+            # accuracy of the center crop
+            loss = criterion(output[:, center], target)
+            acc1, acc5 = accuracy(output[:, center], target, topk=(1, 5))
+            losses.update(loss.item(), B)
+            top1.update(acc1[0], B)
+            top5.update(acc5[0], B)
+
+            # exact consistency over the grid
+            preds = output[:, :G].argmax(dim=2)
+            counts = torch.zeros(B, output.size(2), device=preds.device)
+            counts.scatter_add_(1, preds, torch.ones_like(preds, dtype=counts.dtype))
+            consist.update(pair_consistency(counts).mean().item(), B)
+
+            # diagonal
+            probs = torch.softmax(output[:, diag_index].float(), dim=2)
+            diag_prob.update((100.*probs.gather(2, target[:,None,None].expand(B, D, 1)).mean()).item(), B)
+            ranks = probs.topk(5, dim=2)[1].eq(target[:,None,None])
+            diag_top1.update((100.*ranks[:,:,0].float().mean()).item(), B)
+            diag_top5.update((100.*ranks.any(dim=2).float().mean()).item(), B)
+
+            # measure elapsed time
+            batch_time.update(time.time() - end)
+            end = time.time()
+
+            if i % args.print_freq == 0:
+                print('Test: [{0}/{1}]\t'
+                      'Time {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                      'Acc@1 {top1.val:.3f} ({top1.avg:.3f})\t'
+                      'Consist {consist.val:.3f} ({consist.avg:.3f})\t'
+                      'Diag Prob {diag_prob.val:.3f} ({diag_prob.avg:.3f})'.format(
+                       i, len(val_loader), batch_time=batch_time, top1=top1, consist=consist, diag_prob=diag_prob))
+
+    meters = [losses, top1, top5, consist, diag_prob, diag_top1, diag_top5]
+    if args.distributed:
+        device = reduce_device(args)
+        for meter in meters:
+            meter.all_reduce(device)
+    images_per_sec_rank, images_per_sec = throughput.rate()
+    if metrics is not None:
+        metrics.log('all', {
+            'val_avg_loss': losses.avg,
+            'val_avg_acc@1': float(top1.avg),
+            'val_avg_acc@5': float(top5.avg),
+            'consistency': consist.avg,
+            'diag_prob': diag_prob.avg,
+            'diag_acc@1': diag_top1.avg,
+            'diag_acc@5': diag_top5.avg,
+            'images_per_sec_rank': images_per_sec_rank,
+            'images_per_sec': images_per_sec,
+        }, step=step)
+
+    print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f} Consistency {consist.avg:.3f} ({0} offsets) '
+          'Diag Prob {diag_prob.avg:.3f} Acc@1 {diag_top1.avg:.3f} Acc@5 {diag_top5.avg:.3f}'
+          .format(G, top1=top1, top5=top5, consist=consist, diag_prob=diag_prob, diag_top1=diag_top1,
+                  diag_top5=diag_top5))
+    return top1.avg, consist.avg
 
 def validate_save(val_loader, mean, std, args):
-    import matplotlib.pyplot as plt
-    import os
-    for i, (input, target) in enumerate(val_loader):
-        img = (255*np.clip(input[0,...].data.cpu().numpy()*np.array(std)[:,None,None] + mean[:,None,None],0,1)).astype('uint8').transpose((1,2,0))
-        plt.imsave(os.path.join(args.out_dir,'%05d.png'%i),img)
-
-# def save_checkpoint(state, is_best, filename='checkpoint.pth.tar'):
-def save_checkpoint(state, is_best, epoch, out_dir='./'):
-    torch.save(state, os.path.join(out_dir,'checkpoint.pth.tar'))
-    if(epoch % 10 == 0):
-        torch.save(state, os.path.join(out_dir,'checkpoint_%03d.pth.tar'%epoch))
+    """Writes each validation image, as the model would see it, to args.out_dir as
+    <dataset index>.png (or .jpg). Batches are denormalized at once and encoded by an
+    ImageExporter; images already written are skipped, so an interrupted export resumes.
+    Loaders that already produce uint8 crops (--val-cache, --uint8-transfer) are read
+    directly, without the normalize/denormalize round trip."""
+    exporter = ImageExporter(args.out_dir, fmt=args.save_format, compression=args.save_compression,
+                             workers=args.save_workers, pool=args.save_pool)
+    sampler = val_loader.sampler
+    indices = list(sampler)
+    start = exporter.first_missing(indices)
+    if start == len(indices):
+        print('=> all {} images are already in {}'.format(len(indices), args.out_dir))
+        exporter.close()
+        return
+    if start > 0:
+        print('=> resuming the export at image {} of {}'.format(start, len(indices)))
+
+    loader = val_loader
+    if isinstance(val_loader.dataset, DecodedCache):
+        raw = copy.copy(val_loader.dataset)
+        raw.transform = None
+        loader = torch.utils.data.DataLoader(raw, batch_size=args.batch_size, sampler=sampler,
+                                             num_workers=args.workers, collate_fn=uint8_collate)
+    elif args.uint8_transfer:
+        loader = val_loader.loader # the DataLoader under DeviceLoader: N x H x W x 3 uint8 batches
+
+    sampler.skip(start)
+    pos = start
+    try:
+        for i, (input, target) in enumerate(loader):
+            images = input if input.dtype == torch.uint8 else denormalize(input, mean, std)
+            exporter.submit(images.cpu().numpy(), indices[pos:pos + input.size(0)])
+            pos += input.size(0)
+            if i % args.print_freq == 0:
+                print('Save: [{}/{}]'.format(pos, len(indices)))
+    finally:
+        sampler.skip(0)
+        written = exporter.close()
+    print('=> wrote {} images to {}'.format(written, args.out_dir))
+
+
+def load_checkpoint(path):
+    """Loads a checkpoint onto the CPU, memory-mapping it when the file format allows.
+    Tensor storages are then only paged in as they are copied onto a device, and ranks on
+    the same node share the page cache instead of each holding a private copy."""
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except (RuntimeError, TypeError):
+        # legacy (non-zipfile) checkpoints and older torch versions cannot be mmap'd
+        return torch.load(path, map_location='cpu')
+
+
+def load_optimizer_state_lazily(optimizer, state_dict):
+    """Restores the optimizer state right before its first step, so restart does not wait
+    on (or hold device memory for) momentum buffers until they are needed. Hyperparameters
+    set since the restore (e.g. the learning rate for the resumed epoch) are kept.
+
+    Returns a function that applies a still pending restore at once; call it before reading
+    optimizer.state_dict(), e.g. for a checkpoint written before the first step."""
+    if not hasattr(optimizer, 'register_step_pre_hook'):
+        optimizer.load_state_dict(state_dict)
+        return lambda: None
+    pending = [state_dict]
+
+    def restore_now():
+        if not pending:
+            return
+        handle.remove()
+        current = [{k: v for k, v in group.items() if k != 'params'} for group in optimizer.param_groups]
+        optimizer.load_state_dict(pending.pop())
+        for group, hyperparams in zip(optimizer.param_groups, current):
+            group.update(hyperparams)
+
+    handle = optimizer.register_step_pre_hook(lambda opt, args, kwargs: restore_now())
+    return restore_now
+
+
+def snapshot_to_cpu(obj):
+    """Recursively copies every tensor in a (state dict) structure to CPU memory, so the
+    snapshot is unaffected by later optimizer steps on the live tensors"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    return obj
+
+
+def link_or_copy(src, dst):
+    """Atomically points dst at the same file as src (hardlink), copying if the filesystem
+    does not support links. Since checkpoints are always published by rename, an existing
+    link keeps referring to the old contents when src is later replaced."""
+    tmp = dst + '.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def write_checkpoint(state, is_best, epoch, out_dir='./'):
+    filename = os.path.join(out_dir, 'checkpoint.pth.tar')
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename) # readers never see a partially written checkpoint
+    if(epoch is not None and epoch % 10 == 0):
+        link_or_copy(filename, os.path.join(out_dir,'checkpoint_%03d.pth.tar'%epoch))
     if is_best:
-        shutil.copyfile(os.path.join(out_dir,'checkpoint.pth.tar'), os.path.join(out_dir,'model_best.pth.tar'))
+        link_or_copy(filename, os.path.join(out_dir,'model_best.pth.tar'))
+
+
+def optimizer_params(optimizer):
+    return [p for group in optimizer.param_groups for p in group['params']]
+
+
+def get_rng_states():
+    states = {
+        'python': random.getstate(),
+        # keep the numpy state as plain python types so checkpoints load with weights_only
+        'numpy': [v.tolist() if isinstance(v, np.ndarray) else v for v in np.random.get_state()],
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        states['cuda'] = torch.cuda.get_rng_state()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    name, keys, pos, has_gauss, cached_gaussian = states['numpy']
+    np.random.set_state((name, np.asarray(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state(states['cuda'])
+
+
+def gather_rng_states(args):
+    """RNG states of every rank, indexed by rank"""
+    states = get_rng_states()
+    if not args.distributed:
+        return [states]
+    all_states = [None]*dist.get_world_size()
+    dist.all_gather_object(all_states, states)
+    return all_states
+
+
+def request_preemption_checkpoint(signum, frame):
+    global preempt_requested
+    print('=> received signal {}, checkpointing at the next iteration'.format(signum))
+    preempt_requested = True
+
+
+def preemption_requested(args):
+    """Whether any rank was signalled; ranks are signalled at slightly different times, so
+    they agree via an all-reduce and all checkpoint at the same iteration"""
+    if not args.distributed:
+        return preempt_requested
+    flag = torch.tensor([int(preempt_requested)], device=reduce_device(args))
+    dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+    return bool(flag.item())
+
+
+class CheckpointWriter(object):
+    """Saves checkpoints in the background. save() snapshots the state to CPU memory and
+    returns; a worker thread serializes it and publishes it with an atomic rename. At most
+    max_pending saves are in flight, after which save() blocks. Pending saves are flushed
+    on close() and at interpreter exit."""
+    def __init__(self, out_dir='./', max_pending=1):
+        self.out_dir = out_dir
+        self.executor = ThreadPoolExecutor(max_workers=1) # one writer keeps saves ordered
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.futures = []
+        self.closed = False
+        atexit.register(self.close)
+
+    def save(self, state, is_best, epoch):
+        self.slots.acquire()
+        try:
+            state = snapshot_to_cpu(state)
+            future = self.executor.submit(write_checkpoint, state, is_best, epoch, self.out_dir)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+        self._reap()
+
+    def _reap(self):
+        # surface errors from finished saves instead of silently dropping them
+        done = [f for f in self.futures if f.done()]
+        self.futures = [f for f in self.futures if not f.done()]
+        for f in done:
+            f.result()
+
+    def flush(self):
+        futures, self.futures = self.futures, []
+        for f in futures:
+            f.result()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+            atexit.unregister(self.close)
 
 
 class AverageMeter(object):
@@ -767,6 +1660,92 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+    def all_reduce(self, device):
+        """Sums the totals over all ranks so avg covers the whole (sharded) dataset"""
+        t = torch.tensor([float(self.sum), float(self.count)], dtype=torch.float64, device=device)
+        dist.all_reduce(t, op=dist.ReduceOp.SUM)
+        self.sum, self.count = t.tolist()
+        self.avg = self.sum / self.count if self.count > 0 else 0
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """Shuffling sampler whose order depends only on (seed, epoch), optionally sharded across
+    ranks like DistributedSampler. skip(n) drops the first n samples of this rank's order for
+    the current epoch, so a run can resume mid-epoch without loading the data it already saw."""
+    def __init__(self, dataset, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = (len(dataset) + num_replicas - 1) // num_replicas
+        self.total_size = self.num_samples*num_replicas
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start_index = 0
+
+    def skip(self, n):
+        self.start_index = min(n, self.num_samples)
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(len(self.dataset), generator=g).tolist()
+        else:
+            indices = list(range(len(self.dataset)))
+        # pad so every rank gets the same number of samples
+        padding = self.total_size - len(indices)
+        indices += (indices * (padding // len(indices) + 1))[:padding]
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+        return iter(indices[self.start_index:])
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+
+class DistributedEvalSampler(torch.utils.data.Sampler):
+    """Shards a dataset across ranks for evaluation. Unlike DistributedSampler, samples
+    are neither padded nor dropped: rank r gets indices r, r+W, r+2W, ... in order.
+    skip(n) starts at the n-th of them, so an interrupted evaluation can continue."""
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        self.num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+        self.rank = dist.get_rank() if rank is None else rank
+        self.indices = range(self.rank, len(dataset), self.num_replicas)
+        self.start = 0
+
+    def skip(self, n):
+        self.start = n
+
+    def __iter__(self):
+        return iter(self.indices[self.start:])
+
+    def __len__(self):
+        return len(self.indices) - self.start
+
+
+def reduce_device(args):
+    """Device for collective ops: NCCL only supports CUDA tensors"""
+    if args.dist_backend == 'nccl':
+        return torch.device('cuda', torch.cuda.current_device() if args.gpu is None else args.gpu)
+    return torch.device('cpu')
+
+
+def gather_sharded(local, num_total, device):
+    """Reassembles per-rank rows of a DistributedEvalSampler shard into dataset order"""
+    world_size = dist.get_world_size()
+    per_rank = (num_total + world_size - 1) // world_size
+    padded = torch.zeros((per_rank,) + local.shape[1:], dtype=torch.float64, device=device)
+    padded[:local.shape[0]] = torch.from_numpy(local).to(device)
+    gathered = [torch.zeros_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded)
+    # rank r holds dataset rows r, r+W, ..., so interleave ranks row by row
+    out = torch.stack(gathered, dim=1).reshape((per_rank*world_size,) + local.shape[1:])
+    return out[:num_total].cpu().numpy()
+
 
 def adjust_learning_rate(optimizer, epoch, args):
     """Sets the learning rate to the initial LR decayed by 10 every 30 epochs"""
@@ -775,21 +1754,66 @@ def adjust_learning_rate(optimizer, epoch, args):
         param_group['lr'] = lr
 
 
-def accuracy(output, target, topk=(1,)):
-    """Computes the accuracy over the k top predictions for the specified values of k"""
-    with torch.no_grad():
-        maxk = max(topk)
-        batch_size = target.size(0)
-
-        _, pred = output.topk(maxk, 1, True, True)
-        pred = pred.t()
-        correct = pred.eq(target.view(1, -1).expand_as(pred))
-
-        res = []
-        for k in topk:
-            correct_k = correct[:k].reshape(-1).float().sum(0, keepdim=True)
-            res.append(correct_k.mul_(100.0 / batch_size))
-        return res
+def label_module_ranges(model):
+    """Wraps every BlurPool and MaxPool forward in a named record_function range, so their
+    kernels are separable in profiler traces. Returns the hook handles."""
+    labels = [((antialiased_cnns.BlurPool, antialiased_cnns.BlurPool1D), 'BlurPool'),
+              ((nn.MaxPool1d, nn.MaxPool2d), 'MaxPool')]
+    handles = []
+    for module in model.modules():
+        for types, label in labels:
+            if isinstance(module, types):
+                def enter(mod, inp, label=label):
+                    mod._profile_range = torch.profiler.record_function(label)
+                    mod._profile_range.__enter__()
+                def exit(mod, inp, out):
+                    mod._profile_range.__exit__(None, None, None)
+                handles += [module.register_forward_pre_hook(enter), module.register_forward_hook(exit)]
+    return handles
+
+
+def start_profiler(model, args, phase, epoch):
+    """Starts a torch.profiler session recording iterations [START, END) of --profile-steps;
+    call .step() after every iteration and stop_profiler() at the end. None if disabled or
+    epoch is not --profile-epoch."""
+    profile_epoch = args.start_epoch if args.profile_epoch is None else args.profile_epoch
+    if args.profile_steps is None or epoch != profile_epoch:
+        return None
+    start, end = args.profile_steps
+    rank = args.rank if args.distributed else 0
+    prefix = os.path.join(args.out_dir, 'profile_%s_rank%d'%(phase, rank))
+    use_cuda = torch.cuda.is_available()
+
+    def on_trace_ready(prof):
+        prof.export_chrome_trace(prefix + '.trace.json')
+        averages = prof.key_averages(group_by_input_shape=True)
+        sort_by = 'self_cpu_time_total'
+        if use_cuda and len(averages) > 0:
+            sort_by = 'self_device_time_total' if hasattr(averages[0], 'self_device_time_total') else 'self_cuda_time_total'
+        with open(prefix + '.txt', 'w') as f:
+            f.write(averages.table(sort_by=sort_by, row_limit=100))
+        print("=> wrote profile [%s.trace.json]"%prefix)
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if use_cuda:
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    prof = torch.profiler.profile(
+        activities=activities,
+        # warm up for one iteration (when there is one to spare) so startup cost is not recorded
+        schedule=torch.profiler.schedule(wait=max(start-1, 0), warmup=min(start, 1), active=end-start, repeat=1),
+        on_trace_ready=on_trace_ready, record_shapes=True, profile_memory=True)
+    prof._range_handles = label_module_ranges(model)
+    prof.start()
+    return prof
+
+
+def stop_profiler(prof):
+    if prof is None:
+        return
+    prof.stop()
+    for handle in prof._range_handles:
+        handle.remove()
+
 
 def agreement(output0, output1):
     pred0 = output0.argmax(dim=1, keepdim=False)
@@ -0,0 +1,219 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# Structured metrics for main.py: records are buffered in memory and written to local
+# JSONL/CSV files (and optionally wandb) from a background thread, so logging never
+# blocks the training step. StepTimer breaks a training step into phases.
+
+import atexit
+import csv
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+import torch.distributed as dist
+
+__all__ = ['MetricsLogger', 'JsonlSink', 'CsvSink', 'WandbSink', 'StepTimer', 'Throughput']
+
+
+def _to_python(v):
+    if torch.is_tensor(v):
+        return v.item() if v.numel() == 1 else v.tolist()
+    if hasattr(v, 'item') and callable(v.item): # numpy scalars
+        return v.item()
+    return v
+
+
+class JsonlSink(object):
+    """One JSON object per line"""
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CsvSink(object):
+    """One CSV file per record kind ('train', 'val', ...), since kinds have different columns.
+    Columns are fixed by the first record of each kind."""
+    def __init__(self, path_prefix):
+        self.path_prefix = path_prefix
+        self.files = {}
+
+    def _writer(self, record):
+        kind = record.get('kind', 'metrics')
+        if kind not in self.files:
+            path = '%s_%s.csv'%(self.path_prefix, kind)
+            new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+            f = open(path, 'a', newline='')
+            writer = csv.DictWriter(f, fieldnames=list(record.keys()), extrasaction='ignore')
+            if new_file:
+                writer.writeheader()
+            self.files[kind] = (f, writer)
+        return self.files[kind]
+
+    def write(self, records):
+        for record in records:
+            self._writer(record)[1].writerow(record)
+        for f, _ in self.files.values():
+            f.flush()
+
+    def close(self):
+        for f, _ in self.files.values():
+            f.close()
+
+
+class WandbSink(object):
+    def __init__(self, config=None, project='antialiased-cnns'):
+        import wandb
+        self.wandb = wandb
+        wandb.init(project=project)
+        if config is not None:
+            wandb.config.update(config)
+
+    def write(self, records):
+        for record in records:
+            record = dict(record)
+            step = record.pop('step', None)
+            record.pop('time', None)
+            self.wandb.log(record, step=step)
+
+    def close(self):
+        pass
+
+
+class MetricsLogger(object):
+    """Buffers metric records and flushes them to the sinks from a background thread every
+    flush_secs seconds (and on close/exit). log() only appends to a list, so it is cheap
+    enough to call every step."""
+    def __init__(self, sinks, flush_secs=5.):
+        self.sinks = sinks
+        self.flush_secs = flush_secs
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_args(cls, args, rank=0, wandb=False):
+        sinks = []
+        formats = [f for f in args.metrics_format.split(',') if f not in ('', 'none')]
+        prefix = os.path.join(args.out_dir, 'metrics_rank%d'%rank)
+        if 'jsonl' in formats:
+            sinks.append(JsonlSink(prefix + '.jsonl'))
+        if 'csv' in formats:
+            sinks.append(CsvSink(prefix))
+        if wandb:
+            sinks.append(WandbSink(config=args))
+        return cls(sinks, flush_secs=args.metrics_flush_secs)
+
+    def log(self, kind, metrics, step=None):
+        record = {'kind': kind, 'time': time.time(), 'step': step}
+        record.update((k, _to_python(v)) for k, v in metrics.items())
+        with self.lock:
+            self.buffer.append(record)
+
+    def _run(self):
+        while not self.stop.wait(self.flush_secs):
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            records, self.buffer = self.buffer, []
+        if records:
+            for sink in self.sinks:
+                sink.write(records)
+
+    def close(self):
+        if self.stop.is_set():
+            return
+        self.stop.set()
+        self.thread.join()
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+        atexit.unregister(self.close)
+
+
+class StepTimer(object):
+    """Accumulates time per named phase of a step. On CUDA, phases are timed with events
+    so no extra synchronization is added; they are resolved in summary(), by which point
+    the step has synchronized anyway (loss.item()). Host-side waits such as the data
+    loader are added with add(). Phases also appear as named ranges in torch.profiler traces."""
+    def __init__(self, device):
+        self.cuda = device.type == 'cuda'
+        self.reset()
+
+    def reset(self):
+        self.spans = []
+        self.host = {}
+
+    @contextmanager
+    def phase(self, name):
+        with torch.profiler.record_function(name):
+            with self._timed(name):
+                yield
+
+    @contextmanager
+    def _timed(self, name):
+        if self.cuda:
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self.spans.append((name, start, end))
+        else:
+            start = time.perf_counter()
+            yield
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.host[name] = self.host.get(name, 0.) + seconds
+
+    def summary(self):
+        times = dict(self.host)
+        if self.spans:
+            self.spans[-1][2].synchronize()
+        for name, start, end in self.spans:
+            times[name] = times.get(name, 0.) + start.elapsed_time(end)/1000.
+        return times
+
+
+class Throughput(object):
+    """Images/sec since the last call to rate(), for this rank and summed over all ranks.
+    rate() is collective when distributed, so every rank must call it at the same step."""
+    def __init__(self, device=None):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.images = 0
+        self.start = time.perf_counter()
+
+    def update(self, n):
+        self.images += n
+
+    def rate(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        local = self.images/elapsed
+        total = local
+        if dist.is_available() and dist.is_initialized():
+            t = torch.tensor([local], dtype=torch.float64, device=self.device)
+            dist.all_reduce(t, op=dist.ReduceOp.SUM)
+            total = t.item()
+        self.reset()
+        return local, total
@@ -1,4 +1,7 @@
 
+import json
+import sys
+
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -50,6 +53,16 @@ chars = ['','o',[(-.125,-.5),(.125,-.5),(.125,.5),(-.125,.5),(-.125,-.5)]
 	,'^','d','p','h',(7,0,0)] # by filter size
 keys = ['alexnet', 'vgg16', 'vgg16bn', 'resnet18', 'resnet34', 'resnet50', 'resnet101', 'densenet121', 'mobilenet']
 
+# python plots/make_plots.py zoo_plots.json: plot the numbers of evaluate_zoo.py --preset plots instead
+if len(sys.argv) > 1:
+	with open(sys.argv[1]) as f:
+		results = dict(((r['arch'], r['filter_size']), r) for r in json.load(f)['results'])
+	archs = dict(alexnet='alexnet', vgg16='vgg16', vgg16bn='vgg16_bn', resnet18='resnet18', resnet34='resnet34',
+		resnet50='resnet50', resnet101='resnet101', densenet121='densenet121', mobilenet='mobilenet_v2')
+	for key in keys:
+		accs[key] = [results[(archs[key], tap)]['acc1'] for tap in taps]
+		cons[key] = [results[(archs[key], tap)]['consistency'] for tap in taps]
+
 
 fills = ['k','w','w','w']
 sizes = [6,12,10,12]
@@ -1,4 +1,7 @@
 
+import json
+import sys
+
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -54,6 +57,25 @@ cons_aa['wideresnets'] = [92.46, 92.10]
 cons_aa['densenets'] = [90.35, 90.61, 91.32, 91.66]
 cons_aa['mobilenets'] = [87.733, ]
 
+# python plots/make_plots2.py zoo_plots2.json: plot the numbers of evaluate_zoo.py --preset plots2 instead
+if len(sys.argv) > 1:
+	with open(sys.argv[1]) as f:
+		results = dict(((r['arch'], r['filter_size']), r) for r in json.load(f)['results'])
+	archs = {}
+	archs['alexnets'] = ['alexnet']
+	archs['vggs'] = ['vgg11', 'vgg13', 'vgg16', 'vgg19']
+	archs['vggbns'] = ['vgg11_bn', 'vgg13_bn', 'vgg16_bn', 'vgg19_bn']
+	archs['resnets'] = ['resnet18', 'resnet34', 'resnet50', 'resnet101', 'resnet152']
+	archs['resnexts'] = ['resnext50_32x4d', 'resnext101_32x8d']
+	archs['wideresnets'] = ['wide_resnet50_2', 'wide_resnet101_2']
+	archs['densenets'] = ['densenet121', 'densenet169', 'densenet201', 'densenet161']
+	archs['mobilenets'] = ['mobilenet_v2']
+	for key in archs:
+		accs_base[key] = [results[(arch, 1)]['acc1'] for arch in archs[key]]
+		accs_aa[key] = [results[(arch, 4)]['acc1'] for arch in archs[key]]
+		cons_base[key] = [results[(arch, 1)]['consistency'] for arch in archs[key]]
+		cons_aa[key] = [results[(arch, 4)]['consistency'] for arch in archs[key]]
+
 
 ticks_x = []
 ticks_lbl = []
@@ -0,0 +1,459 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+# Sharded dataset format for main.py --data-format shards. An ImageFolder split is packed
+# into a few large files that are memory-mapped, so reading a sample costs no open/stat:
+#   records - the original encoded images back to back, with an (offset, length, label)
+#             index per shard; decoded in the workers as usual
+#   array   - fixed-size uint8 images (Resize(256) + CenterCrop(256)), one N x H x W x 3
+#             array per shard; no decoding at all, meant for validation
+# <split>.json describes the shards of a split.
+#
+# A ShardCache keeps node-local copies of the shard data files on scratch disk, copied in the
+# background in the order the node's ranks will read them.
+#
+# python shards.py --src /PTH/TO/ILSVRC2012 --dst /PTH/TO/SHARDS --split train --format records
+# python shards.py --src /PTH/TO/ILSVRC2012 --dst /PTH/TO/SHARDS --split val --format array
+
+import argparse
+import fcntl
+import hashlib
+import io
+import json
+import os
+import shutil
+import threading
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import torch
+import torch.utils.data
+from PIL import Image
+
+__all__ = ['RecordShardDataset', 'ArrayShardDataset', 'open_shards', 'ShardSampler', 'ShardCache', 'convert']
+
+
+class _ShardDataset(torch.utils.data.Dataset):
+    """Common part of the shard datasets: the manifest, the global index -> (shard, row)
+    mapping and lazily opened memory maps. Maps are opened on first access in each process,
+    so the dataset can be sent to DataLoader workers without copying any data. With a
+    ShardCache, data files are mapped from the node-local copy once it exists; a map of the
+    shared file is swapped for the local one at most once a second."""
+    def __init__(self, root, split, transform=None, target_transform=None, cache=None):
+        self.root = root
+        self.transform = transform
+        self.target_transform = target_transform
+        self.cache = cache
+        with open(os.path.join(root, '%s.json'%split)) as f:
+            self.manifest = json.load(f)
+        self.classes = self.manifest['classes']
+        self.class_to_idx = dict((c, i) for i, c in enumerate(self.classes))
+        self.shard_sizes = [shard['count'] for shard in self.manifest['shards']]
+        self.offsets = np.concatenate([[0], np.cumsum(self.shard_sizes)]).astype(np.int64)
+        self._maps = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_maps'] = None
+        return state
+
+    def _shard(self, shard):
+        if self._maps is None:
+            self._maps = [None]*len(self.shard_sizes)
+            self._paths = [None]*len(self.shard_sizes)
+            self._checked = [0.]*len(self.shard_sizes)
+        name = self.manifest['shards'][shard]['data']
+        if self.cache is not None and self._maps[shard] is not None and time.time() - self._checked[shard] > 1.:
+            self._checked[shard] = time.time()
+            if self.cache.path(name) != self._paths[shard]: # copied in, or evicted
+                self._maps[shard] = None
+        if self._maps[shard] is None:
+            path = self.cache.path(name) if self.cache is not None else os.path.join(self.root, name)
+            self._maps[shard], self._paths[shard] = self._open(path), path
+            self._checked[shard] = time.time()
+        return self._maps[shard]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        shard = int(np.searchsorted(self.offsets, index, side='right')) - 1
+        img, target = self._read(shard, index - int(self.offsets[shard]))
+        if self.transform is not None:
+            img = self.transform(img)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return img, target
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+
+def _pil_open(f):
+    return Image.open(f).convert('RGB')
+
+
+class RecordShardDataset(_ShardDataset):
+    """Encoded images stored back to back, decoded with PIL like ImageFolder. loader is
+    called with a file object over the encoded bytes (e.g. data.DraftLoader)."""
+    def __init__(self, root, split, transform=None, target_transform=None, loader=_pil_open, cache=None):
+        super(RecordShardDataset, self).__init__(root, split, transform, target_transform, cache)
+        self.loader = loader
+        self.index = [np.load(os.path.join(root, shard['index'])) for shard in self.manifest['shards']]
+        self.targets = [int(t) for index in self.index for t in index[:,2]]
+
+    def _open(self, path):
+        return np.memmap(path, dtype=np.uint8, mode='r')
+
+    def _read(self, shard, row):
+        offset, length, target = self.index[shard][row]
+        buf = self._shard(shard)[offset:offset + length]
+        return self.loader(io.BytesIO(buf.tobytes())), int(target)
+
+
+class ArrayShardDataset(_ShardDataset):
+    """Fixed-size uint8 images, returned as PIL images so the usual transforms apply"""
+    def __init__(self, root, split, transform=None, target_transform=None, cache=None):
+        super(ArrayShardDataset, self).__init__(root, split, transform, target_transform, cache)
+        self.labels = [np.load(os.path.join(root, shard['labels'])) for shard in self.manifest['shards']]
+        self.targets = [int(t) for labels in self.labels for t in labels]
+        self.image_size = self.manifest['image_size']
+
+    def _open(self, path):
+        return np.load(path, mmap_mode='r')
+
+    def _read(self, shard, row):
+        return Image.fromarray(np.asarray(self._shard(shard)[row])), int(self.labels[shard][row])
+
+
+def open_shards(root, split, transform=None, loader=None, cache=None):
+    """Dataset for a converted split, of the format recorded in its manifest. loader replaces
+    the image decoder of records shards; array shards hold decoded images. cache is an
+    optional ShardCache over root."""
+    with open(os.path.join(root, '%s.json'%split)) as f:
+        fmt = json.load(f)['format']
+    if fmt == 'records' and loader is not None:
+        return RecordShardDataset(root, split, transform, loader=loader, cache=cache)
+    return {'records': RecordShardDataset, 'array': ArrayShardDataset}[fmt](root, split, transform, cache=cache)
+
+
+class ShardSampler(torch.utils.data.Sampler):
+    """Shuffles at shard granularity: the order of shards and the order within each shard
+    change every epoch, but a shard is read through before the next one, so reads stay
+    sequential within a memory map. Otherwise behaves like main.py's ResumableSampler
+    (set_epoch, skip, padding to a multiple of num_replicas, strided split over ranks).
+
+    With group_size (e.g. the GPUs per node), consecutive ranks form groups that each own a
+    fixed subset of the shards for the whole run, balanced by image count, and only shuffle
+    within it; a node then reads 1/num_groups of the data, which a ShardCache can hold.
+    Set cache to a ShardCache to have it fetch this group's shards in the order they are read."""
+    def __init__(self, shard_sizes, shuffle=True, seed=0, num_replicas=1, rank=0, group_size=None):
+        self.shard_sizes = list(shard_sizes)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.group_size = group_size or num_replicas
+        if num_replicas % self.group_size != 0:
+            raise ValueError('%d replicas do not split into groups of %d' % (num_replicas, self.group_size))
+        self.epoch = 0
+        self.start = 0
+        self.cache = None
+
+        num_groups = num_replicas // self.group_size
+        if num_groups == 1:
+            groups = [list(range(len(self.shard_sizes)))]
+        else: # each shard goes to the group with the fewest images so far
+            groups, totals = [[] for _ in range(num_groups)], [0]*num_groups
+            for shard in np.random.RandomState(seed % 2**32).permutation(len(self.shard_sizes)):
+                g = int(np.argmin(totals))
+                groups[g].append(int(shard))
+                totals[g] += self.shard_sizes[shard]
+        self.shards = groups[rank // self.group_size]
+        most = max(sum(self.shard_sizes[shard] for shard in group) for group in groups)
+        self.num_samples = (most + self.group_size - 1) // self.group_size
+        self.total_size = self.num_samples * self.group_size
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def skip(self, n):
+        self.start = n
+
+    def _epoch_order(self):
+        """(shard order, per-shard row permutations) of this group in the current epoch"""
+        rng = np.random.RandomState((self.seed + self.epoch) % 2**32)
+        order = [self.shards[k] for k in rng.permutation(len(self.shards))] if self.shuffle else list(self.shards)
+        rows = [rng.permutation(self.shard_sizes[shard]) if self.shuffle else np.arange(self.shard_sizes[shard])
+                for shard in order]
+        return order, rows
+
+    def shard_order(self):
+        """Shards this rank's group reads in the current epoch, in order"""
+        return self._epoch_order()[0]
+
+    def __iter__(self):
+        offsets = np.concatenate([[0], np.cumsum(self.shard_sizes)]).astype(np.int64)
+        order, rows = self._epoch_order()
+        indices = np.concatenate([r + offsets[shard] for shard, r in zip(order, rows)]).astype(np.int64)
+        positions = np.repeat(np.arange(len(order)), [len(r) for r in rows])
+        pad = self.total_size - len(indices)
+        indices = np.concatenate([indices, np.resize(indices, pad)])[self.rank % self.group_size::self.group_size]
+        positions = np.concatenate([positions, np.resize(positions, pad)])[self.rank % self.group_size::self.group_size]
+        indices, positions = indices[self.start:].tolist(), positions[self.start:]
+        if self.cache is None:
+            return iter(indices)
+        self.cache.schedule([self.cache.data_file(shard) for shard in order])
+        return self._tracked(indices, positions)
+
+    def _tracked(self, indices, positions):
+        last = None
+        for index, position in zip(indices, positions):
+            if position != last: # tell the cache which shard is being read
+                self.cache.advance(int(position))
+                last = position
+            yield index
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+class ShardCache(object):
+    """Node-local copies of the shard data files under root, kept in cache_dir within
+    budget_bytes. path() returns the local copy of a file if it is complete and the shared one
+    otherwise, so reads never wait for the cache. A background thread, started by schedule(),
+    copies the files in the order they will be read; to make room it evicts, least recently
+    read first, only local files that are not needed again in the scheduled order. All
+    processes of a node may use the same cache_dir: one of them (holding a lock file) copies,
+    the others only read. Copies are written to a temporary name and renamed when complete.
+    The thread is not pickled, so the cache can be passed to DataLoader workers."""
+    def __init__(self, root, cache_dir, budget_bytes, manifest_shards=None):
+        self.root = os.path.abspath(root)
+        self.dir = os.path.join(os.path.abspath(cache_dir), hashlib.sha1(self.root.encode()).hexdigest()[:16])
+        os.makedirs(self.dir, exist_ok=True)
+        self.budget = budget_bytes
+        self.data_files = [shard['data'] for shard in manifest_shards] if manifest_shards is not None else None
+        self._cond = threading.Condition()
+        self._order, self._position = [], 0
+        self._thread = None
+        self._stop = False
+
+    @classmethod
+    def for_split(cls, root, split, cache_dir, budget_bytes):
+        with open(os.path.join(root, '%s.json'%split)) as f:
+            return cls(root, cache_dir, budget_bytes, json.load(f)['shards'])
+
+    def __getstate__(self):
+        return {'root': self.root, 'dir': self.dir, 'budget': self.budget, 'data_files': self.data_files}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._cond, self._order, self._position, self._thread, self._stop = None, [], 0, None, False
+
+    def data_file(self, shard):
+        return self.data_files[shard]
+
+    def path(self, name):
+        local = os.path.join(self.dir, name)
+        return local if os.path.exists(local) else os.path.join(self.root, name)
+
+    def schedule(self, names):
+        """Sets the files to be read next, in order, and starts copying them"""
+        with self._cond:
+            self._order, self._position = list(names), 0
+            self._cond.notify()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def advance(self, position):
+        """Marks the file at position of the scheduled order as being read"""
+        with self._cond:
+            self._position = position
+            self._cond.notify()
+        try:
+            os.utime(os.path.join(self.dir, self._order[position])) # recency for the LRU eviction
+        except (OSError, IndexError):
+            pass
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+
+    def _local_files(self):
+        files = {}
+        for name in os.listdir(self.dir):
+            if not name.startswith('.') and not name.endswith('.tmp'):
+                st = os.stat(os.path.join(self.dir, name))
+                files[name] = (st.st_size, st.st_mtime)
+        return files
+
+    def _next(self):
+        """(file to copy, files to evict first), or None if there is nothing to do now"""
+        with self._cond:
+            upcoming = self._order[self._position:]
+        local = self._local_files()
+        missing = [name for name in upcoming if name not in local]
+        if not missing:
+            return None
+        name = missing[0]
+        need = os.path.getsize(os.path.join(self.root, name))
+        if need > self.budget:
+            return None
+        used = sum(size for size, _ in local.values())
+        needed = set(upcoming)
+        victims = sorted((mtime, n) for n, (_, mtime) in local.items() if n not in needed)
+        evict = []
+        while used + need > self.budget:
+            if not victims:
+                return None # full of files still to be read; wait until some have been
+            _, victim = victims.pop(0)
+            evict.append(victim)
+            used -= local[victim][0]
+        return name, evict
+
+    def _run(self):
+        with open(os.path.join(self.dir, '.copier.lock'), 'w') as lock:
+            while True: # one copier per cache directory
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    with self._cond:
+                        self._cond.wait(10.)
+                        if self._stop:
+                            return
+            for name in os.listdir(self.dir): # left behind by a copier that died
+                if name.endswith('.tmp'):
+                    os.remove(os.path.join(self.dir, name))
+            while True:
+                with self._cond:
+                    if self._stop:
+                        return
+                idle = 5.
+                try:
+                    work = self._next()
+                    if work is not None:
+                        name, evict = work
+                        for victim in evict:
+                            os.remove(os.path.join(self.dir, victim))
+                        tmp = os.path.join(self.dir, name + '.tmp')
+                        shutil.copyfile(os.path.join(self.root, name), tmp)
+                        os.replace(tmp, os.path.join(self.dir, name))
+                        continue
+                except OSError as e: # e.g. scratch disk full; reads keep going to shared storage
+                    print('=> shard cache: %s' % e)
+                    idle = 60.
+                with self._cond:
+                    self._cond.wait(idle)
+
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _decode_fixed(args):
+    path, image_size = args
+    from torchvision import transforms
+    img = Image.open(path).convert('RGB')
+    img = transforms.CenterCrop(image_size)(transforms.Resize(image_size)(img))
+    return np.asarray(img, dtype=np.uint8)
+
+
+def convert(samples, classes, dst, split, fmt='records', shard_bytes=2**30, shard_images=10000,
+            image_size=256, workers=8):
+    """Packs samples, a list of (path, label) as in ImageFolder.samples, into shards under dst.
+    Records shards are cut at shard_bytes, array shards at shard_images images."""
+    if not os.path.exists(dst):
+        os.makedirs(dst)
+    shards = []
+
+    def finish(name, **files):
+        shard = dict(files)
+        shard['count'] = count
+        shards.append(shard)
+        print('=> wrote %s (%d images)'%(name, count))
+
+    pool = Pool(workers)
+    if fmt == 'records':
+        data, rows, count = None, [], 0
+        for (path, label), buf in zip(samples, pool.imap(_read_bytes, [path for path, _ in samples], chunksize=64)):
+            if data is None:
+                name = '%s-%05d'%(split, len(shards))
+                data, offset, rows, count = open(os.path.join(dst, name + '.bin'), 'wb'), 0, [], 0
+            data.write(buf)
+            rows.append((offset, len(buf), label))
+            offset += len(buf)
+            count += 1
+            if offset >= shard_bytes:
+                data.close()
+                np.save(os.path.join(dst, name + '.idx.npy'), np.array(rows, dtype=np.int64).reshape(-1, 3))
+                finish(name, data=name + '.bin', index=name + '.idx.npy')
+                data = None
+        if data is not None:
+            data.close()
+            np.save(os.path.join(dst, name + '.idx.npy'), np.array(rows, dtype=np.int64).reshape(-1, 3))
+            finish(name, data=name + '.bin', index=name + '.idx.npy')
+    elif fmt == 'array':
+        for start in range(0, len(samples), shard_images):
+            chunk = samples[start:start + shard_images]
+            name = '%s-%05d'%(split, len(shards))
+            count = len(chunk)
+            data = np.lib.format.open_memmap(os.path.join(dst, name + '.npy'), mode='w+', dtype=np.uint8,
+                                             shape=(count, image_size, image_size, 3))
+            for i, img in enumerate(pool.imap(_decode_fixed, [(path, image_size) for path, _ in chunk], chunksize=16)):
+                data[i] = img
+            data.flush()
+            del data
+            np.save(os.path.join(dst, name + '.labels.npy'), np.array([label for _, label in chunk], dtype=np.int64))
+            finish(name, data=name + '.npy', labels=name + '.labels.npy')
+    else:
+        raise ValueError('unknown shard format [%s]'%fmt)
+    pool.close()
+    pool.join()
+
+    manifest = {'format': fmt, 'split': split, 'classes': classes, 'num_samples': len(samples), 'shards': shards}
+    if fmt == 'array':
+        manifest['image_size'] = image_size
+    # written last, so a split without a manifest is known to be incomplete
+    tmp = os.path.join(dst, '%s.json.tmp'%split)
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, os.path.join(dst, '%s.json'%split))
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack an ImageFolder split into shards for main.py --data-format shards')
+    parser.add_argument('--src', required=True, help='ImageNet root, containing train/ and val/')
+    parser.add_argument('--dst', required=True, help='output directory')
+    parser.add_argument('--split', default='train', help='subdirectory of --src to convert (default: train)')
+    parser.add_argument('--format', default='records', choices=['records', 'array'],
+                        help='records: encoded images + index; array: decoded uint8 --image-size crops (default: records)')
+    parser.add_argument('--shard-mb', default=1024, type=int, help='records shard size in MB (default: 1024)')
+    parser.add_argument('--shard-images', default=10000, type=int, help='images per array shard (default: 10000)')
+    parser.add_argument('--image-size', default=256, type=int, help='array image size (default: 256)')
+    parser.add_argument('--shuffle', default=None, type=int, metavar='SEED',
+                        help='pack samples in a random order, so shards mix classes (default: on with seed 0 '
+                             'for train, off otherwise; -1 to disable)')
+    parser.add_argument('-j', '--workers', default=8, type=int)
+    args = parser.parse_args()
+
+    from data import IndexedImageFolder
+    folder = IndexedImageFolder(os.path.join(args.src, args.split))
+    samples = list(folder.samples)
+    seed = args.shuffle if args.shuffle is not None else (0 if args.split == 'train' else -1)
+    if seed >= 0: # ImageFolder order is sorted by class; shard-level shuffling needs mixed shards
+        samples = [samples[i] for i in np.random.RandomState(seed).permutation(len(samples))]
+    convert(samples, folder.classes, args.dst, args.split, fmt=args.format, shard_bytes=args.shard_mb*2**20,
+            shard_images=args.shard_images, image_size=args.image_size, workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
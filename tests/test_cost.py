@@ -0,0 +1,17 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+import pytest
+
+import antialiased_cnns
+
+
+@pytest.mark.parametrize('arch', ['resnet18', 'mobilenet_v2'])
+@pytest.mark.parametrize('filter_size', [2, 4])
+def test_cost_model_matches_forward(arch, filter_size):
+    model = antialiased_cnns.__dict__[arch](filter_size=filter_size)
+    results = antialiased_cnns.check_cost_model(model, (1, 3, 224, 224), rtol=0.)
+    assert set(results) == {'params', 'conv_macs'}
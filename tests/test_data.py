@@ -0,0 +1,38 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+import numpy as np
+import torch
+
+from data import BatchAugment, CanvasCollate
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def canvas_batch(num, shape):
+    rng = np.random.RandomState(0)
+    return CanvasCollate()([(rng.randint(0, 256, shape + (3,)).astype(np.uint8), k % 10) for k in range(num)])
+
+
+def test_batch_augment_low_passes_shrinking_crops():
+    images, sizes, targets = canvas_batch(64, (448, 400))
+    augment = BatchAugment(MEAN, STD, seed=0)
+    blur = augment._blur
+    filt_sizes = []
+    augment._blur = lambda n, device: filt_sizes.append(n) or blur(n, device)
+
+    out = augment(images, sizes)
+    assert out.shape == (64, 3, 224, 224)
+    assert 3 in filt_sizes
+    assert sizes.device.type == 'cpu'
+
+
+def test_batch_augment_is_reproducible():
+    images, sizes, _ = canvas_batch(8, (300, 448))
+    first, second = BatchAugment(MEAN, STD, seed=1), BatchAugment(MEAN, STD, seed=1)
+    assert torch.equal(first(images, sizes), second(images, sizes))
+    assert not torch.equal(first(images, sizes), BatchAugment(MEAN, STD, seed=2)(images, sizes))
@@ -0,0 +1,48 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+import itertools
+
+import pytest
+import torch
+import torch.nn as nn
+
+from evaluate_zoo import ZooStats, evaluate_batch, evaluate_zoo
+from evaluation import pair_consistency, shift_offsets
+
+
+def brute_force_consistency(preds):
+    """Mean over images of the agreement (%) of every distinct pair of an images x offsets table"""
+    pairs = list(itertools.combinations(range(preds.size(1)), 2))
+    return sum(100.*sum(float(row[a] == row[b]) for a, b in pairs)/len(pairs) for row in preds)/preds.size(0)
+
+
+def test_pair_consistency_counts_distinct_pairs():
+    preds = torch.tensor([[0, 0, 0, 0], [0, 0, 1, 1], [2, 0, 1, 3], [1, 1, 1, 3]])
+    counts = torch.zeros(4, 4).scatter_add_(1, preds, torch.ones(4, 4))
+    assert pair_consistency(counts).tolist() == pytest.approx([100., 100./3, 0., 50.])
+    assert pair_consistency(counts).mean().item() == pytest.approx(brute_force_consistency(preds))
+
+
+def test_evaluate_batch_matches_pairwise_agreement():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Conv2d(3, 3, 16, stride=16), nn.Flatten(), nn.Linear(588, 5)).eval()
+    input, target = torch.randn(6, 3, 256, 256), torch.randint(5, (6,))
+    stats = ZooStats()
+    evaluate_batch(model, input, target, 8, stats)
+
+    with torch.no_grad():
+        preds = torch.stack([model(input[:, :, dy:dy+224, dx:dx+224]).argmax(1) for dy, dx in shift_offsets(8)], 1)
+        center = model(input[:, :, 16:240, 16:240]).argmax(1)
+    assert len(set(preds.flatten().tolist())) > 1 # not a degenerate table
+    assert stats.summary()['consistency'] == pytest.approx(brute_force_consistency(preds), rel=1e-5)
+    assert stats.summary()['acc1'] == pytest.approx(100.*center.eq(target).float().mean().item())
+
+
+def test_failing_worker_raises_instead_of_hanging():
+    batches = [(torch.zeros(2, 256, 256, 3, dtype=torch.uint8), torch.zeros(2, dtype=torch.int64))]*4
+    with pytest.raises(RuntimeError, match='nosuchnet'):
+        evaluate_zoo(['nosuchnet'], batches, ['cpu', 'cpu'])
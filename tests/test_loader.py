@@ -0,0 +1,54 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+import threading
+
+import torch
+import torch.utils.data
+
+from data import DeviceLoader
+from loader import PrefetchLoader, autotune_loader
+
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+
+def prefetch_loader(num_images=40, batch_size=4):
+    dataset = torch.utils.data.TensorDataset(torch.randn(num_images, 3, 8, 8), torch.arange(num_images))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=2, persistent_workers=True)
+    return PrefetchLoader(DeviceLoader(loader, 'cpu', MEAN, STD), num_buffers=2)
+
+
+def test_prefetch_loader_break_then_next_epoch():
+    loader = prefetch_loader()
+    for i, (input, target) in enumerate(loader):
+        if i == 1:
+            break
+    # the fill thread has stopped and cannot take batches from the next epoch
+    assert not [t for t in threading.enumerate() if t.name == 'PrefetchLoader']
+    targets = torch.cat([target for _, target in loader])
+    assert targets.tolist() == list(range(40))
+
+
+def test_prefetch_loader_exception_then_next_epoch():
+    loader = prefetch_loader()
+    try:
+        for i, (input, target) in enumerate(loader):
+            if i == 2:
+                raise KeyboardInterrupt
+    except KeyboardInterrupt:
+        pass
+    assert not [t for t in threading.enumerate() if t.name == 'PrefetchLoader']
+    assert torch.cat([target for _, target in loader]).tolist() == list(range(40))
+
+
+def test_autotune_keeps_workers_alive_when_restarts_are_costly():
+    dataset = torch.utils.data.TensorDataset(torch.randn(200, 3, 8, 8), torch.arange(200))
+    short = autotune_loader(dataset, 4, 1e-3, max_workers=1, batches=5, epoch_batches=1, verbose=False)
+    assert short['persistent_workers'] and short['startup_secs'] > 0.02*short['epoch_secs']
+    # restarting takes well under 2% of a very long epoch
+    long = autotune_loader(dataset, 4, 1e-3, max_workers=1, batches=5, epoch_batches=10**7, verbose=False)
+    assert not long['persistent_workers']
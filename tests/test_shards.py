@@ -0,0 +1,126 @@
+# Copyright (c) 2019, Adobe Inc. All rights reserved.
+#
+# This work is licensed under the Creative Commons Attribution-NonCommercial-ShareAlike
+# 4.0 International Public License. To view a copy of this license, visit
+# https://creativecommons.org/licenses/by-nc-sa/4.0/legalcode.
+
+import os
+import time
+
+import numpy as np
+
+from shards import ShardCache, ShardSampler
+
+NAMES = ['train-%05d.bin' % k for k in range(6)]
+
+
+def make_root(path, size=100):
+    """A shared-storage directory of shard data files of size bytes each"""
+    os.makedirs(str(path))
+    for k, name in enumerate(NAMES):
+        with open(os.path.join(str(path), name), 'wb') as f:
+            f.write(bytes([k])*size)
+    return [{'data': name} for name in NAMES]
+
+
+def local(cache):
+    return set(name for name in os.listdir(cache.dir) if not name.startswith('.') and not name.endswith('.tmp'))
+
+
+def wait_for(condition, timeout=10.):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def test_cache_copies_in_order_and_serves_local_copies(tmp_path):
+    shards = make_root(tmp_path/'shared')
+    cache = ShardCache(str(tmp_path/'shared'), str(tmp_path/'scratch'), 1000, shards)
+    assert cache.path(NAMES[0]) == os.path.join(cache.root, NAMES[0]) # nothing copied yet
+    try:
+        cache.schedule(NAMES[:4])
+        assert wait_for(lambda: local(cache) == set(NAMES[:4]))
+    finally:
+        cache.close()
+    for k, name in enumerate(NAMES[:4]):
+        assert cache.path(name) == os.path.join(cache.dir, name)
+        with open(cache.path(name), 'rb') as f:
+            assert f.read() == bytes([k])*100
+    assert cache.path(NAMES[4]) == os.path.join(cache.root, NAMES[4])
+
+
+def test_cache_evicts_least_recently_read_and_keeps_upcoming(tmp_path):
+    shards = make_root(tmp_path/'shared')
+    cache = ShardCache(str(tmp_path/'shared'), str(tmp_path/'scratch'), 300, shards)
+    try:
+        cache.schedule(NAMES[:4])
+        # the budget holds three files, all still to be read: nothing can be evicted
+        assert wait_for(lambda: local(cache) == set(NAMES[:3]))
+        time.sleep(0.2)
+        assert local(cache) == set(NAMES[:3])
+
+        # file 0 was read more recently than file 1, and file 2 is read again next
+        now = time.time()
+        os.utime(os.path.join(cache.dir, NAMES[1]), (now - 100, now - 100))
+        os.utime(os.path.join(cache.dir, NAMES[0]), (now, now))
+        os.utime(os.path.join(cache.dir, NAMES[2]), (now - 200, now - 200))
+        cache.schedule([NAMES[2], NAMES[3]])
+        assert wait_for(lambda: local(cache) == set([NAMES[0], NAMES[2], NAMES[3]]))
+
+        # file 2 is being read, so it stays until the reader has moved past it
+        cache.schedule([NAMES[2], NAMES[3], NAMES[4], NAMES[5]])
+        assert wait_for(lambda: local(cache) == set(NAMES[2:5]))
+        time.sleep(0.2)
+        assert local(cache) == set(NAMES[2:5])
+        cache.advance(1)
+        assert wait_for(lambda: local(cache) == set(NAMES[3:6]))
+    finally:
+        cache.close()
+
+
+def test_sampler_groups_own_disjoint_balanced_shards():
+    sizes = [30, 10, 25, 5, 20, 15, 40, 8]
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    shard_of = dict((i, s) for s in range(len(sizes)) for i in range(offsets[s], offsets[s + 1]))
+    samplers = [ShardSampler(sizes, seed=3, num_replicas=4, rank=rank, group_size=2) for rank in range(4)]
+
+    groups = [samplers[0].shards, samplers[2].shards]
+    assert samplers[1].shards == groups[0] and samplers[3].shards == groups[1]
+    assert sorted(groups[0] + groups[1]) == list(range(len(sizes)))
+    assert abs(sum(sizes[s] for s in groups[0]) - sum(sizes[s] for s in groups[1])) <= max(sizes)
+
+    assert len(set(len(list(s)) for s in samplers)) == 1 # every rank takes the same number of steps
+    for g in range(2):
+        indices = list(samplers[2*g]) + list(samplers[2*g + 1])
+        assert set(shard_of[i] for i in indices) == set(groups[g])
+        # the group reads every image of its shards (plus padding)
+        assert set(indices) == set(i for s in groups[g] for i in range(offsets[s], offsets[s + 1]))
+
+
+def test_sampler_skip_resumes_the_same_order():
+    sizes = [30, 10, 25, 5, 20, 15, 40, 8]
+    sampler = ShardSampler(sizes, seed=1, num_replicas=4, rank=1, group_size=2)
+    sampler.set_epoch(2)
+    full = list(sampler)
+    sampler.skip(7)
+    assert list(sampler) == full[7:]
+    assert len(sampler) == len(full) - 7
+    sampler.set_epoch(3)
+    assert len(list(sampler)) == len(full)
+
+
+def test_sampler_schedules_its_group_shards_on_the_cache(tmp_path):
+    shards = make_root(tmp_path/'shared')
+    cache = ShardCache(str(tmp_path/'shared'), str(tmp_path/'scratch'), 1000, shards)
+    sampler = ShardSampler([10]*len(NAMES), seed=0, num_replicas=2, rank=1, group_size=1)
+    sampler.cache = cache
+    try:
+        indices = iter(sampler)
+        first = next(indices) # the group's shards are now scheduled, in the order they are read
+        assert wait_for(lambda: local(cache) == set(NAMES[s] for s in sampler.shards))
+        assert set(i // 10 for i in [first] + list(indices)) == set(sampler.shards)
+    finally:
+        cache.close()